@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+"""Microbenchmark of pendant.get_commands for the PS3/Shapeoko mapping.
+
+Compares ticks per second of the original name based walk over the mapped
+commands (kept here as a reference) with the compiled dispatch table, for an
+idle pad, a held stick and a stick that moves between every tick.
+
+Usage: python3 benchmarks/dispatch_benchmark.py [--ticks N]
+"""
+
+import argparse
+import collections
+import dataclasses
+import pathlib
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import command_dispatch  # noqa: E402
+import command_mapping  # noqa: E402
+import gamepad  # noqa: E402
+import pendant  # noqa: E402
+
+
+@dataclasses.dataclass
+class _Move:
+  direction: int = 0
+  magnitude_axis: command_mapping.MagnitudeAxis = command_mapping.MagnitudeAxis()
+
+
+def legacy_get_commands(config):
+  """get_commands as it was before the dispatch table was introduced."""
+  moves = collections.defaultdict(_Move)
+  for action in config.mapped_commands:
+    if action.button:
+      pressed = (config.gamepad.is_pressed(action.button) if action.repeat_if_pressed
+                 else config.gamepad.been_pressed(action.button))
+      if pressed:
+        if action.commands:
+          return action.commands
+        if action.movement_axis and action.direction:
+          moves[action.movement_axis].direction += action.direction.value
+          moves[action.movement_axis].magnitude_axis = action.magnitude_axis
+    if action.axis:
+      axis_value = config.gamepad.axis(action.axis.label)
+      if action.axis.has_triggered(axis_value):
+        moves[action.movement_axis].direction += (
+          int(axis_value / abs(axis_value)) * action.axis_direction_multiplier())
+        moves[action.movement_axis].magnitude_axis = action.axis
+  gcode_moves = []
+  for axis, move in moves.items():
+    if move.direction:
+      distance = move.magnitude_axis.travel_distance(
+        config.gamepad.axis(move.magnitude_axis.label))
+      gcode_moves.append(f'{axis.value}{distance * move.direction}')
+  if gcode_moves:
+    gcode_moves = ['G91'] + gcode_moves
+    return (command_mapping.Command(('gcode', ' '.join(gcode_moves)),),
+            command_mapping.Command(('gcode', 'G90'),))
+  return ()
+
+
+@dataclasses.dataclass
+class _Config:
+  gamepad: gamepad.Gamepad
+  mapped_commands: tuple
+  dispatch: command_dispatch.DispatchTable
+  jog_mode: str = 'step'
+
+
+def _make_config() -> _Config:
+  pad = gamepad.PS3()
+  pad._apply_events(
+    [(0, 0, gamepad.Gamepad.EVENT_CODE_INIT_BUTTON, index) for index in pad.button_names]
+    + [(0, 0, gamepad.Gamepad.EVENT_CODE_INIT_AXIS, index) for index in pad.axis_names])
+  mapping = command_mapping.get_mapping(gamepad='PS3', cnc='Shapeoko')
+  return _Config(gamepad=pad, mapped_commands=mapping,
+                 dispatch=command_dispatch.DispatchTable(mapping, pad))
+
+
+def _ticks_per_second(get_commands, scenario: str, ticks: int) -> float:
+  config = _make_config()
+  pad = config.gamepad
+  left_x = pad.axis_index['LEFT-X']
+  if scenario != 'idle':
+    pad._apply_events(((0, 30000, gamepad.Gamepad.EVENT_CODE_AXIS, left_x),))
+  start = time.perf_counter()
+  for tick in range(ticks):
+    if scenario == 'moving':
+      pad._apply_events(((tick, 20000 + tick % 10000, gamepad.Gamepad.EVENT_CODE_AXIS, left_x),))
+    get_commands(config)
+  return ticks / (time.perf_counter() - start)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--ticks', type=int, default=100000)
+  args = parser.parse_args()
+  for scenario in ('idle', 'held', 'moving'):
+    before = _ticks_per_second(legacy_get_commands, scenario, args.ticks)
+    after = _ticks_per_second(pendant.get_commands, scenario, args.ticks)
+    print(f'{scenario:>6}: before {before:10.0f} ticks/s, after {after:10.0f} ticks/s '
+          f'({after / before:.1f}x)')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+"""Moves seen for diagonal stick flicks through the joystick and the evdev api.
+
+A writer thread flicks the left stick from the center to a diagonal and back,
+--flicks times at --rate reports per second, into a pipe standing in for the
+device. The joystick api delivers the X and Y change of each report as two
+events, written one after the other like joydev queues them, while the evdev
+api writes each report as a single frame ended by SYN_REPORT. The gamepad is
+read by the selected reader and the dispatch table of the default config is
+evaluated on every update, as the pendant does.
+
+For each api the script reports how many evaluations asked for a diagonal
+move, and how many only saw one of the axes moved.
+
+Usage: python3 benchmarks/evdev_benchmark.py [--flicks N] [--rate HZ]
+           [--reader thread|asyncio]
+"""
+
+import argparse
+import asyncio
+import collections
+import os
+import pathlib
+import struct
+import sys
+import threading
+import time
+
+from typing import Dict, Tuple
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import evdev_input  # noqa: E402
+import gamepad  # noqa: E402
+
+import harness  # noqa: E402
+
+_DEFLECTION = int(0.7 * gamepad.Gamepad.MAX_AXIS)
+# evdev ABS_X and ABS_Y, the axes joydev numbers 0 and 1
+_ABS_X = 0
+_ABS_Y = 1
+_EV_SYN = 0
+_EV_ABS = 3
+
+
+class PipeDevice(evdev_input.EvdevDevice):
+  """Left stick of an event device, read from a pipe centered."""
+
+  def __init__(self, fd: int):
+    axes = {code: evdev_input.Axis(code, -gamepad.Gamepad.MAX_AXIS, gamepad.Gamepad.MAX_AXIS)
+            for code in (_ABS_X, _ABS_Y)}
+    super().__init__(fd, {}, axes)
+
+  def _current_values(self) -> Tuple[Dict[int, int], Dict[int, int]]:
+    return {}, {axis.number: 0 for axis in self.axes.values()}
+
+
+def _joystick_report(value: int) -> Tuple[bytes, ...]:
+  timestamp = int(time.monotonic() * 1000) & 0xFFFFFFFF
+  return tuple(struct.pack(gamepad.Gamepad.EVENT_FORMAT, timestamp, value,
+                           gamepad.Gamepad.EVENT_CODE_AXIS, axis)
+               for axis in (0, 1))
+
+
+def _evdev_report(value: int) -> Tuple[bytes, ...]:
+  now = time.clock_gettime(time.CLOCK_MONOTONIC)
+  seconds, microseconds = int(now), int(now % 1 * 1e6)
+  return (b''.join(evdev_input.EVENT_STRUCT.pack(seconds, microseconds, event_type, code, value)
+                   for event_type, code, value in ((_EV_ABS, _ABS_X, value),
+                                                   (_EV_ABS, _ABS_Y, value),
+                                                   (_EV_SYN, 0, 0))),)
+
+
+def _writer(fd: int, api: str, flicks: int, rate: float, done: threading.Event):
+  report = _evdev_report if api == 'evdev' else _joystick_report
+  next_time = time.perf_counter()
+  for value in [_DEFLECTION, 0] * flicks:
+    next_time += 1 / rate
+    delay = next_time - time.perf_counter()
+    if delay > 0:
+      time.sleep(delay)
+    for chunk in report(value):
+      os.write(fd, chunk)
+  done.set()
+
+
+async def _run(api: str, reader: str, flicks: int, rate: float) -> collections.Counter:
+  config = harness.pendant_config('127.0.0.1:0')
+  pad = config.gamepad
+  read_fd, write_fd = os.pipe()
+  pad.joystick_file = os.fdopen(read_fd, 'rb', buffering=0)
+  pad.attach_event_loop()
+  if api == 'evdev':
+    pad.joystick_api = 'evdev'
+    pad._open_evdev(PipeDevice(read_fd))
+  else:
+    for _, value, event_type, index in harness.init_events(pad):
+      os.write(write_fd, struct.pack(gamepad.Gamepad.EVENT_FORMAT, 0, value, event_type, index))
+  if reader == 'asyncio':
+    pad.start_event_loop_updates()
+  else:
+    pad.start_background_updates(wait_for_ready=False)
+  done = threading.Event()
+  writer = threading.Thread(target=_writer, args=(write_fd, api, flicks, rate, done))
+  writer.start()
+  moves: collections.Counter = collections.Counter()
+  while True:
+    if not await pad.wait_for_update(0.05):
+      if done.is_set():
+        break
+      continue
+    _, evaluated = config.dispatch.evaluate()
+    if evaluated:
+      moves[''.join(sorted(axis.value for axis, _ in evaluated))] += 1
+  writer.join()
+  pad.stop_background_updates()
+  # Wake up the update thread so it can observe that it was stopped.
+  os.write(write_fd, b''.join(_evdev_report(0) if api == 'evdev' else _joystick_report(0)))
+  if pad.update_thread:
+    pad.update_thread.join()
+  os.close(write_fd)
+  return moves
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--flicks', type=int, default=500)
+  parser.add_argument('--rate', type=float, default=250.0, help='reports per second')
+  parser.add_argument('--reader', choices=('thread', 'asyncio'), default='thread')
+  args = parser.parse_args()
+  for api in gamepad.Gamepad.JOYSTICK_APIS:
+    moves = asyncio.run(_run(api, args.reader, args.flicks, args.rate))
+    single = moves['X'] + moves['Y']
+    print(f'{api:>9}: {moves["XY"]:5} diagonal moves, {single:5} single axis moves '
+          f'(X {moves["X"]}, Y {moves["Y"]}) for {args.flicks} flicks')
+
+
+if __name__ == '__main__':
+  main()
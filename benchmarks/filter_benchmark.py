@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+"""Commands sent for noisy stick input, with and without the axis filters.
+
+Replays the same recording through pendant.run_pendant twice, once with the
+axis filters disabled and once with the given filter options, and counts the
+commands and jog lines the pendant sends, and how often the jog distance
+changed between consecutive jogs. Commands are answered in process
+right away, so only the input side is measured.
+
+Without --recording, a noisy recording is generated for each scenario:
+  trigger: the left stick resting right at its trigger threshold (0.1).
+  boundary: the left stick held where the mid and fast steps meet (0.8).
+  drift: the left stick resting slightly off center, in a diagonal.
+  diagonal: the left stick pushed halfway in a diagonal, whose jogs must
+    survive the filters.
+
+Usage: python3 benchmarks/filter_benchmark.py [--recording FILE]
+           [--seconds S] [--noise N] [--option 'hysteresis=0.05' ...]
+"""
+
+import argparse
+import asyncio
+import collections
+import pathlib
+import sys
+import tempfile
+
+from typing import Dict
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import pendant  # noqa: E402
+
+import harness  # noqa: E402
+
+_SCENARIOS = ('trigger', 'boundary', 'drift', 'diagonal')
+_DEFAULT_FILTERS = {'hysteresis': '0.05', 'smoothing': '0.5', 'radial deadzone': '0.15'}
+_NO_FILTERS = {'hysteresis': '0', 'smoothing': '0', 'radial deadzone': '0'}
+
+
+def write_scenario(path: pathlib.Path, name: str, seconds: float, noise: float) -> None:
+  pad = harness.pendant_config('127.0.0.1:0').gamepad
+  left_x = pad.axis_index['LEFT-X']
+  left_y = pad.axis_index['LEFT-Y']
+  if name == 'trigger':
+    script = list(harness.noisy_hold(left_x, 0.1, noise, seconds))
+  elif name == 'boundary':
+    script = list(harness.noisy_hold(left_x, 0.8, noise, seconds))
+  else:
+    deflection = 0.08 if name == 'drift' else 0.5
+    script = (list(harness.noisy_hold(left_x, deflection, noise, seconds))
+              + list(harness.noisy_hold(left_y, -deflection, noise, seconds, seed=1)))
+  harness.write_recording(path, pad, script)
+
+
+async def count_commands(recording: pathlib.Path, seconds: float,
+                         device_options: Dict[str, str]) -> dict:
+  config = harness.pendant_config('127.0.0.1:0', device_options)
+  sio = harness.StandInSIO()
+  task = asyncio.ensure_future(pendant.run_pendant(config, sio, replay=recording))
+  await asyncio.sleep(seconds + 0.5)
+  task.cancel()
+  jogs = [line for line in sio.lines if line.startswith(('G91', '$J'))]
+  moves = [' '.join(word for word in line.split()[1:] if not word.startswith('F'))
+           for line in jogs]
+  changes = sum(1 for previous, move in zip(moves, moves[1:]) if move != previous)
+  return {'commands': len(sio.emitted), 'jogs': len(jogs), 'changes': changes,
+          'steps': collections.Counter(moves)}
+
+
+def print_results(name: str, results: Dict[str, dict]) -> None:
+  print(name)
+  for label, counts in results.items():
+    steps = ' '.join(f'{step}x{count}' for step, count in counts['steps'].most_common(6))
+    print(f'  {label:<10} commands={counts["commands"]:<5} jogs={counts["jogs"]:<5} '
+          f'changes={counts["changes"]:<4} {steps}')
+  for count in ('commands', 'jogs', 'changes'):
+    before, after = results['unfiltered'][count], results['filtered'][count]
+    if before:
+      print(f'  {count} {(after - before) / before:+.0%}')
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--recording', type=pathlib.Path,
+                      help='replay a recording made with pendant.py --record instead')
+  parser.add_argument('--seconds', type=float, default=3.0,
+                      help='length of the generated scenarios, or of the recording')
+  parser.add_argument('--noise', type=float, default=0.03,
+                      help='standard deviation of the generated stick noise')
+  parser.add_argument('--option', action='append', default=[],
+                      help='filter config option, as "name=value"')
+  args = parser.parse_args()
+  filters = dict(_DEFAULT_FILTERS)
+  filters.update(option.split('=', 1) for option in args.option)
+
+  with tempfile.TemporaryDirectory() as directory:
+    if args.recording:
+      recordings = {args.recording.name: args.recording}
+    else:
+      recordings = {}
+      for name in _SCENARIOS:
+        recordings[name] = pathlib.Path(directory) / f'{name}.rec'
+        write_scenario(recordings[name], name, args.seconds, args.noise)
+    for name, path in recordings.items():
+      print_results(name, {
+        label: asyncio.run(count_commands(path, args.seconds, options))
+        for label, options in (('unfiltered', _NO_FILTERS), ('filtered', filters))})
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,319 @@
+"""Building blocks to run the pendant without a real gamepad or CNCjs server.
+
+SyntheticJoystick is a FIFO that stands in for /dev/input/js0 and plays
+scripted joystick events into it. FakeCNCjsServer runs a socket.io server in a
+separate process that accepts the 'open', 'command' and 'write' events sent by
+CNCjs_SIO, echoes every line with serialport:write and answers it with "ok"
+through serialport:read, like CNCjs does with a Grbl controller. Real-time
+commands are not answered, like Grbl does; the server records when they arrive.
+StandInSIO answers the same way in process, without a server, for the
+benchmarks that only measure the pendant and for the tests.
+"""
+
+import asyncio
+import configparser
+import io
+import math
+import multiprocessing
+import os
+import pathlib
+import random
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import cncjs_sio  # noqa: E402
+import command_queue  # noqa: E402
+import config_manager  # noqa: E402
+import gamepad  # noqa: E402
+import latency  # noqa: E402
+import machine_state  # noqa: E402
+import recording  # noqa: E402
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple  # noqa: E402
+
+# (seconds since the start of the script, value, event type, index)
+ScriptEvent = Tuple[float, int, int, int]
+
+# CNCjs commands and raw writes of Grbl real-time commands, which get no answer
+REALTIME_COMMANDS = frozenset(('feedhold', 'cyclestart', 'reset'))
+REALTIME_WRITES = frozenset(('!', '~', '\x18', '\x85'))
+
+
+def init_events(pad: gamepad.Gamepad) -> Iterator[ScriptEvent]:
+  """Events the joystick driver sends when a device is opened."""
+  for index in pad.button_names:
+    yield 0.0, 0, gamepad.Gamepad.EVENT_CODE_INIT_BUTTON, index
+  for index in pad.axis_names:
+    yield 0.0, 0, gamepad.Gamepad.EVENT_CODE_INIT_AXIS, index
+
+
+def stick_sweep(axis: int, seconds: float, rate: float = 500.0,
+                period: float = 2.0, start: float = 0.0) -> Iterator[ScriptEvent]:
+  """A stick continuously swept from one end to the other."""
+  for sample in range(int(seconds * rate)):
+    at = sample / rate
+    value = int(gamepad.Gamepad.MAX_AXIS * math.sin(2 * math.pi * at / period))
+    yield start + at, value, gamepad.Gamepad.EVENT_CODE_AXIS, axis
+  yield start + seconds, 0, gamepad.Gamepad.EVENT_CODE_AXIS, axis
+
+
+def button_taps(button: int, count: int, period: float = 0.2,
+                hold: float = 0.05, start: float = 0.0) -> Iterator[ScriptEvent]:
+  """A button pressed and released count times."""
+  for tap in range(count):
+    yield start + tap * period, 1, gamepad.Gamepad.EVENT_CODE_BUTTON, button
+    yield start + tap * period + hold, 0, gamepad.Gamepad.EVENT_CODE_BUTTON, button
+
+
+def noisy_hold(axis: int, level: float, noise: float, seconds: float, rate: float = 500.0,
+               start: float = 0.0, seed: int = 0) -> Iterator[ScriptEvent]:
+  """A stick held at level (-1 to 1) with gaussian noise, as a worn stick reports it."""
+  generator = random.Random(seed)
+  for sample in range(int(seconds * rate)):
+    value = min(max(level + generator.gauss(0, noise), -1.0), 1.0)
+    yield start + sample / rate, int(value * gamepad.Gamepad.MAX_AXIS), \
+        gamepad.Gamepad.EVENT_CODE_AXIS, axis
+  yield start + seconds, 0, gamepad.Gamepad.EVENT_CODE_AXIS, axis
+
+
+def write_recording(path: pathlib.Path, pad: gamepad.Gamepad,
+                    script: Iterable[ScriptEvent]) -> None:
+  """Writes a script as a recording, after the init events of pad, for --replay."""
+  with path.open('wb') as output:
+    recorder = recording.Recorder(output)
+    for at, value, event_type, index in sorted(
+        list(init_events(pad)) + list(script), key=lambda event: event[0]):
+      recorder.write(struct.pack(gamepad.Gamepad.EVENT_FORMAT,
+                                 int(at * 1000) & 0xFFFFFFFF, value, event_type, index))
+
+
+def recorded_script(path: pathlib.Path, speed: float = 1.0) -> Iterator[ScriptEvent]:
+  """Events of a recording made with pendant.py --record, init events excluded."""
+  with path.open('rb') as recorded:
+    events = list(recording.read_events(recorded))
+  first_timestamp = events[0][0] if events else 0
+  for timestamp, value, event_type, index in events:
+    if event_type not in (gamepad.Gamepad.EVENT_CODE_BUTTON, gamepad.Gamepad.EVENT_CODE_AXIS):
+      continue
+    at = ((timestamp - first_timestamp) & 0xFFFFFFFF) / 1000
+    yield (at / speed if speed else 0.0), value, event_type, index
+
+
+class SyntheticJoystick:
+  """FIFO standing in for a joystick device.
+
+  Attributes:
+    path: path to give to Gamepad as joystick_path.
+  """
+
+  def __init__(self):
+    self._directory = tempfile.TemporaryDirectory(prefix='cncjs-py-pendant-')
+    self.path = pathlib.Path(self._directory.name) / 'js0'
+    os.mkfifo(self.path)
+    # Opening read/write keeps the FIFO open without waiting for a reader, and
+    # keeps readers from seeing an end of file between writes.
+    self._fd = os.open(self.path, os.O_RDWR)
+    self._start = time.monotonic()
+
+  def write(self, events: Iterable[Tuple[int, int, int]]) -> None:
+    """Writes (value, event type, index) events right away."""
+    timestamp = int((time.monotonic() - self._start) * 1000) & 0xFFFFFFFF
+    os.write(self._fd, b''.join(
+      struct.pack(gamepad.Gamepad.EVENT_FORMAT, timestamp, value, event_type, index)
+      for value, event_type, index in events))
+
+  def play(self, script: Iterable[ScriptEvent]) -> int:
+    """Writes the events of a script at their times, returns the number of events."""
+    start = time.perf_counter()
+    count = 0
+    for at, value, event_type, index in sorted(script, key=lambda event: event[0]):
+      delay = start + at - time.perf_counter()
+      if delay > 0:
+        time.sleep(delay)
+      self.write(((value, event_type, index),))
+      count += 1
+    return count
+
+  def close(self) -> None:
+    os.close(self._fd)
+    self._directory.cleanup()
+
+
+def stop_gamepad(pad: gamepad.Gamepad, joystick: SyntheticJoystick) -> None:
+  """Stops the gamepad readers, waking up the update thread if needed."""
+  pad.stop_background_updates()
+  if pad.update_thread and pad.update_thread.is_alive():
+    joystick.write(((0, gamepad.Gamepad.EVENT_CODE_AXIS, 0),))
+    pad.update_thread.join()
+
+
+def _serve(port: int, ack_delay: float, ready) -> None:
+  import aiohttp.web
+  import socketio
+
+  server = socketio.AsyncServer(async_mode='aiohttp')
+  app = aiohttp.web.Application()
+  server.attach(app)
+  # realtime: (command, time.perf_counter on arrival) of each real-time command
+  stats: Dict[str, Any] = {'opens': 0, 'commands': 0, 'lines': 0, 'writes': 0,
+                           'realtime': []}
+  # Loop time the last line of each client is answered at
+  answered_at: Dict[str, float] = {}
+
+  @server.on('open')
+  async def on_open(sid, port, options):
+    stats['opens'] += 1
+
+  @server.on('command')
+  async def on_command(sid, port, command, *args):
+    stats['commands'] += 1
+    if command in REALTIME_COMMANDS:
+      stats['realtime'].append((command, time.perf_counter()))
+      return
+    lines = args[0].splitlines() if command == 'gcode' else [command]
+    loop = asyncio.get_event_loop()
+    for line in lines:
+      stats['lines'] += 1
+      await server.emit('serialport:write', line + '\n', room=sid)
+      if ack_delay:
+        # Events are handled concurrently, but a controller answers its lines in
+        # order, one at a time
+        answered_at[sid] = max(answered_at.get(sid, 0.0), loop.time()) + ack_delay
+        await asyncio.sleep(answered_at[sid] - loop.time())
+      await server.emit('serialport:read', 'ok', room=sid)
+
+  @server.on('write')
+  async def on_write(sid, port, data, *args):
+    stats['writes'] += 1
+    if data in REALTIME_WRITES:
+      stats['realtime'].append((data, time.perf_counter()))
+
+  @server.on('benchmark:stats')
+  async def on_stats(sid):
+    return stats
+
+  async def run():
+    runner = aiohttp.web.AppRunner(app)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, '127.0.0.1', port).start()
+    ready.set()
+    while True:
+      await asyncio.sleep(3600)
+
+  asyncio.run(run())
+
+
+class FakeCNCjsServer:
+  """Stand-in CNCjs server running in its own process.
+
+  Attributes:
+    address: host:port to use as the server address of the pendant.
+    ack_delay: seconds the server waits before answering each line, to simulate a
+    slow serial link or a busy controller. The lines of a client are answered
+    in order, one every ack_delay seconds.
+  """
+
+  def __init__(self, ack_delay: float = 0.0):
+    with socket.socket() as probe:
+      probe.bind(('127.0.0.1', 0))
+      port = probe.getsockname()[1]
+    self.address = f'127.0.0.1:{port}'
+    self.ack_delay = ack_delay
+    ready = multiprocessing.Event()
+    self._process = multiprocessing.Process(
+      target=_serve, args=(port, ack_delay, ready), daemon=True)
+    self._process.start()
+    if not ready.wait(timeout=30):
+      raise RuntimeError('Fake CNCjs server did not start')
+
+  def close(self) -> None:
+    self._process.terminate()
+    self._process.join()
+
+
+class StandInSIO(cncjs_sio.CNCjs_SIO):
+  """CNCjs_SIO without a server, recording what is emitted and answering G-code lines.
+
+  Lines are answered with "ok" in order, right away or one every ack_delay
+  seconds as a serial controller does, and not at all when answer is not set.
+
+  Attributes:
+    emitted: (event, arguments) of everything emitted, in order.
+    lines: G-code lines emitted, in order.
+    arrivals: (command, time.perf_counter when emitted) of each real-time command.
+  """
+
+  def __init__(self, ack_delay: float = 0.0, answer: bool = True):
+    # Stands in for the socket.io client too, see emit
+    self.client = self
+    self.connected = asyncio.Event()
+    self.connected.set()
+    self.queue = command_queue.CommandQueue()
+    self.macros = None
+    self.latency = latency.LatencyTracker()
+    self.state = machine_state.MachineState()
+    self.ports: List[str] = []
+    self.emitted: List[Tuple[str, tuple]] = []
+    self.lines: List[str] = []
+    self.arrivals: List[Tuple[str, float]] = []
+    self._ack_delay = ack_delay
+    self._answer = answer
+    self._answered_at = 0.0
+
+  async def emit(self, event: str, arguments: tuple) -> None:
+    self.emitted.append((event, arguments))
+    command = arguments[1]
+    if command in REALTIME_COMMANDS or (event == 'write' and command in REALTIME_WRITES):
+      self.arrivals.append((command, time.perf_counter()))
+    elif command == 'gcode':
+      self.lines.extend(arguments[2].splitlines())
+      if not self._answer:
+        return
+      if not self._ack_delay:
+        for _ in arguments[2].splitlines():
+          self.queue.serial_read('ok')
+        return
+      loop = asyncio.get_event_loop()
+      for _ in arguments[2].splitlines():
+        self._answered_at = max(self._answered_at, loop.time()) + self._ack_delay
+        loop.call_at(self._answered_at, self.queue.serial_read, 'ok')
+
+
+def pendant_configs(address: Optional[str], count: int = 1,
+                    device_options: Optional[Dict[str, str]] = None,
+                    server_options: Optional[Dict[str, str]] = None
+                    ) -> Tuple[config_manager.ConfigObjects, ...]:
+  """Returns count pendants of the default config pointed at address, with overrides.
+
+  address None keeps the one of the default config. With more than one, each
+  pendant is defined in its own "pendant N" section with its own CNC port.
+  """
+  config_file = io.StringIO()
+  config_manager.write_default_config(config_file)
+  config_file.seek(0)
+  parser = configparser.ConfigParser()
+  parser.read_file(config_file)
+  if address is not None:
+    parser['server']['address'] = address
+  parser['server'].update(server_options or {})
+  parser['device'].update(device_options or {})
+  if count > 1:
+    for number in range(count):
+      parser[f'pendant {number}'] = {'cnc port': f'/dev/ttyACM{number}',
+                                     'joystick': f'/dev/input/js{number}'}
+  config_file = io.StringIO()
+  parser.write(config_file)
+  config_file.seek(0)
+  return config_manager.get_configs(config_file)
+
+
+def pendant_config(address: Optional[str], device_options: Optional[Dict[str, str]] = None,
+                   server_options: Optional[Dict[str, str]] = None
+                   ) -> config_manager.ConfigObjects:
+  """Returns the default pendant config pointed at address, with overrides."""
+  return pendant_configs(address, 1, device_options, server_options)[0]
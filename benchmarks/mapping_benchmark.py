@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+"""Load time of a large mapping file, parsed and validated versus cached.
+
+Writes a mapping file with the bundled mappings repeated for many CNC
+machines, then times mapping_file.load_mappings on it with an empty cache
+(parse, validate and write the cache) and with the cache in place.
+
+Usage: python3 benchmarks/mapping_benchmark.py [--machines N] [--runs N]
+"""
+
+import argparse
+import json
+import pathlib
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import mapping_file  # noqa: E402
+
+
+def write_mapping_file(path: pathlib.Path, machines: int) -> int:
+  """Writes the bundled mappings once for each of machines CNC machines."""
+  bundled = json.loads(mapping_file.DEFAULT_MAPPING_FILE.read_bytes())['mappings']
+  mappings = [dict(mapping, cnc=f'Machine {number}')
+              for number in range(machines) for mapping in bundled]
+  path.write_text(json.dumps({'mappings': mappings}))
+  return len(mappings)
+
+
+def time_load(path: pathlib.Path, cache: pathlib.Path, cold: bool) -> float:
+  if cold:
+    for cached in cache.glob('*'):
+      cached.unlink()
+  start = time.perf_counter()
+  mapping_file.load_mappings(path, cache)
+  return time.perf_counter() - start
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--machines', type=int, default=100)
+  parser.add_argument('--runs', type=int, default=20)
+  args = parser.parse_args()
+  with tempfile.TemporaryDirectory() as directory:
+    path = pathlib.Path(directory) / 'mappings.json'
+    cache = pathlib.Path(directory) / 'cache'
+    count = write_mapping_file(path, args.machines)
+    print(f'{count} mappings, {path.stat().st_size / 1024:.0f} KiB')
+    for label, cold in (('parsed', True), ('cached', False)):
+      times = [time_load(path, cache, cold) for _ in range(args.runs)]
+      print(f'{label:>8}: median {statistics.median(times) * 1e3:.2f} ms, '
+            f'max {max(times) * 1e3:.2f} ms')
+
+
+if __name__ == '__main__':
+  main()
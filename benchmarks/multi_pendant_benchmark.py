@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+"""Per pendant latency of several pendants served by one process.
+
+For each pendant count, runs that many pendants on one event loop, each with
+its own CNC port, its own connection to a stand-in CNCjs server (see
+pendant.create_clients) and its own synthetic joystick swept continuously.
+Reports the total latency (events read until the resulting emit finishes, see
+latency.py) of every pendant and the commands per second received by the
+server, counted over all connections.
+
+Usage: python3 benchmarks/multi_pendant_benchmark.py [--counts 1,2,4,8]
+           [--seconds S] [--ack-delay S] [--option 'jog mode=continuous' ...]
+"""
+
+import argparse
+import asyncio
+import pathlib
+import sys
+import time
+
+from typing import Dict, List
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import latency  # noqa: E402
+import pendant  # noqa: E402
+
+import harness  # noqa: E402
+
+
+async def run_benchmark(server: harness.FakeCNCjsServer, count: int, seconds: float,
+                        device_options: Dict[str, str]) -> dict:
+  """Runs count pendants sweeping their sticks for seconds, returns the measurements."""
+  configs = harness.pendant_configs(server.address, count, device_options)
+  joysticks = [harness.SyntheticJoystick() for _ in configs]
+  for config, joystick in zip(configs, joysticks):
+    config.gamepad.joystick_path = joystick.path
+  clients = pendant.create_clients(configs)
+  await asyncio.gather(*(sio.connect(server.address, 'benchmark') for sio in clients.values()),
+                       *(config.gamepad.open() for config in configs))
+  trackers = []
+  tasks = []
+  for config, joystick in zip(configs, joysticks):
+    sio = clients[config.address, config.cnc_port]
+    await sio.open_port(config.cnc_port, config.baudrate, config.controller_type)
+    joystick.play(harness.init_events(config.gamepad))
+    trackers.append(latency.LatencyTracker())
+    tasks.append(asyncio.ensure_future(pendant.run_pendant(config, sio, tracker=trackers[-1])))
+  await asyncio.sleep(0.2)
+
+  loop = asyncio.get_event_loop()
+  stats_before = await sio.client.call('benchmark:stats')
+  start = time.perf_counter()
+  # Sticks are swept out of phase, so the pendants do not move in lockstep
+  await asyncio.gather(*(
+    loop.run_in_executor(None, joystick.play, harness.stick_sweep(
+      config.gamepad.axis_index['LEFT-X'], seconds, start=number * 0.05))
+    for number, (config, joystick) in enumerate(zip(configs, joysticks))))
+  # Let the last commands reach the server
+  await asyncio.sleep(0.5)
+  elapsed = time.perf_counter() - start
+  stats = await sio.client.call('benchmark:stats')
+
+  for task in tasks:
+    task.cancel()
+  for config, joystick in zip(configs, joysticks):
+    harness.stop_gamepad(config.gamepad, joystick)
+  await asyncio.gather(*(sio.client.disconnect() for sio in clients.values()))
+  for joystick in joysticks:
+    joystick.close()
+  return {
+    'commands_per_second': (stats['commands'] - stats_before['commands']) / elapsed,
+    'total': [tracker.report()['total'] for tracker in trackers],
+  }
+
+
+def print_results(count: int, results: dict) -> None:
+  totals: List[dict] = results['total']
+  print(f'{count} pendant(s), {results["commands_per_second"]:.1f} commands/s')
+  for number, total in enumerate(totals):
+    print(f'  pendant {number:<3} n={total["count"]:<6.0f} p50={total["p50"]:.3f} ms '
+          f'p99={total["p99"]:.3f} ms max={total["max"]:.3f} ms')
+  worst = max(total['p99'] for total in totals)
+  print(f'  worst p99 {worst:.3f} ms')
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--counts', default='1,2,4,8',
+                      help='comma separated numbers of pendants to run')
+  parser.add_argument('--seconds', type=float, default=5.0)
+  parser.add_argument('--ack-delay', type=float, default=0.0,
+                      help='seconds the server waits before answering each line')
+  parser.add_argument('--option', action='append', default=[],
+                      help='device config option, as "name=value"')
+  args = parser.parse_args()
+  device_options = dict(option.split('=', 1) for option in args.option)
+  device_options.setdefault('reader', 'asyncio')
+
+  server = harness.FakeCNCjsServer(ack_delay=args.ack_delay)
+  try:
+    for count in (int(count) for count in args.counts.split(',')):
+      print_results(count, asyncio.run(run_benchmark(server, count, args.seconds, device_options)))
+  finally:
+    server.close()
+
+
+if __name__ == '__main__':
+  main()
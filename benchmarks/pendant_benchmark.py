@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+"""End to end benchmark of the pendant, from joystick events to server commands.
+
+Plays a scripted joystick session into a FIFO standing in for /dev/input/js0,
+runs pendant.run_pendant against a stand-in CNCjs server and reports:
+  - joystick events handled per second,
+  - commands per second received by the server,
+  - CPU time of the pendant process per event,
+  - latency percentiles of each stage, see latency.py.
+
+Usage: python3 benchmarks/pendant_benchmark.py [--scenario sweep|taps|mixed]
+           [--recording FILE [--speed X]] [--seconds S] [--ack-delay S]
+           [--option 'jog mode=continuous' ...]
+"""
+
+import argparse
+import asyncio
+import pathlib
+import sys
+import time
+
+from typing import Callable
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import cncjs_sio  # noqa: E402
+import gamepad  # noqa: E402
+import pendant  # noqa: E402
+
+import harness  # noqa: E402
+
+
+def scenario_script(name: str, pad, seconds: float):
+  left_x = pad.axis_index['LEFT-X']
+  right_y = pad.axis_index['RIGHT-Y']
+  dpad_up = pad.button_index['DPAD-UP']
+  if name == 'sweep':
+    return list(harness.stick_sweep(left_x, seconds))
+  if name == 'taps':
+    return list(harness.button_taps(dpad_up, int(seconds / 0.2)))
+  return (list(harness.stick_sweep(left_x, seconds))
+          + list(harness.stick_sweep(right_y, seconds, period=3.0))
+          + list(harness.button_taps(dpad_up, int(seconds / 0.2))))
+
+
+async def run_benchmark(server: harness.FakeCNCjsServer,
+                        make_script: Callable[[gamepad.Gamepad], list],
+                        device_options) -> dict:
+  """Runs the script returned by make_script through the pendant, returns the measurements."""
+  config = harness.pendant_config(server.address, device_options)
+  joystick = harness.SyntheticJoystick()
+  pad = config.gamepad
+  pad.joystick_path = joystick.path
+  sio = cncjs_sio.CNCjs_SIO(max_in_flight=config.max_in_flight)
+  await asyncio.gather(sio.connect(config.address, 'benchmark'), pad.open())
+  await sio.open_port(config.cnc_port, config.baudrate, config.controller_type)
+  joystick.play(harness.init_events(pad))
+  task = asyncio.ensure_future(pendant.run_pendant(config, sio))
+  await asyncio.sleep(0.2)
+
+  script = make_script(pad)
+  sio.latency.reset()
+  stats_before = await sio.client.call('benchmark:stats')
+  applied = pad.events_applied
+  cpu = time.process_time()
+  start = time.perf_counter()
+  events = await asyncio.get_event_loop().run_in_executor(None, joystick.play, script)
+  # Let the last commands reach the server
+  await asyncio.sleep(0.5)
+  elapsed = time.perf_counter() - start
+  cpu = time.process_time() - cpu
+  # Coalesced axis events change the generation once per read, count the events instead
+  handled = pad.events_applied - applied
+  stats = await sio.client.call('benchmark:stats')
+
+  task.cancel()
+  harness.stop_gamepad(pad, joystick)
+  await sio.client.disconnect()
+  joystick.close()
+  return {
+    'events': events,
+    'handled': handled,
+    'events_per_second': handled / elapsed,
+    'commands_per_second': (stats['commands'] - stats_before['commands']) / elapsed,
+    'lines': stats['lines'] - stats_before['lines'],
+    'cpu_per_event': cpu / max(handled, 1),
+    'latency': sio.latency.report(),
+  }
+
+
+def print_results(results: dict) -> None:
+  print(f'events played        {results["events"]}')
+  print(f'events handled       {results["handled"]}')
+  print(f'events/s handled     {results["events_per_second"]:.0f}')
+  print(f'commands/s emitted   {results["commands_per_second"]:.1f} '
+        f'({results["lines"]} lines)')
+  print(f'CPU per event        {results["cpu_per_event"] * 1e6:.1f} us')
+  for stage, stats in results['latency'].items():
+    print(f'latency {stage:>8}     n={stats["count"]:<6.0f} p50={stats["p50"]:.3f} ms '
+          f'p99={stats["p99"]:.3f} ms max={stats["max"]:.3f} ms')
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--scenario', choices=('sweep', 'taps', 'mixed'), default='mixed')
+  parser.add_argument('--recording', type=pathlib.Path,
+                      help='play a recording made with pendant.py --record instead of a scenario')
+  parser.add_argument('--speed', type=float, default=1.0,
+                      help='recording speed multiplier, 0 plays it as fast as possible')
+  parser.add_argument('--seconds', type=float, default=5.0)
+  parser.add_argument('--ack-delay', type=float, default=0.0,
+                      help='seconds the server waits before answering each line')
+  parser.add_argument('--option', action='append', default=[],
+                      help='device config option, as "name=value"')
+  args = parser.parse_args()
+  device_options = dict(option.split('=', 1) for option in args.option)
+  device_options.setdefault('reader', 'asyncio')
+
+  if args.recording:
+    def make_script(pad):
+      return list(harness.recorded_script(args.recording, args.speed))
+  else:
+    def make_script(pad):
+      return scenario_script(args.scenario, pad, args.seconds)
+
+  server = harness.FakeCNCjsServer(ack_delay=args.ack_delay)
+  try:
+    print_results(asyncio.run(run_benchmark(server, make_script, device_options)))
+  finally:
+    server.close()
+
+
+if __name__ == '__main__':
+  main()
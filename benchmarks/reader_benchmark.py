@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+"""Compares the threaded and the asyncio gamepad readers, with and without axis coalescing.
+
+A writer thread plays a continuous stick sweep into a pipe that stands in for
+/dev/input/js0, --burst events at a time. For each reader mode the script
+reports the process CPU time used per event, the number of moved callbacks
+run, and the latency between writing an event and a coroutine waiting in
+Gamepad.wait_for_update observing it.
+
+Usage: python3 benchmarks/reader_benchmark.py [--events N] [--rate HZ]
+           [--burst N] [--callback-interval S]
+"""
+
+import argparse
+import asyncio
+import os
+import pathlib
+import statistics
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import gamepad  # noqa: E402
+
+_AXIS = 0
+
+
+def _pack(value: int, event_type: int) -> bytes:
+  return struct.pack(gamepad.Gamepad.EVENT_FORMAT,
+                     int(time.monotonic() * 1000) & 0xFFFFFFFF, value, event_type, _AXIS)
+
+
+def _writer(fd: int, events: int, rate: float, burst: int, sent: dict):
+  os.write(fd, _pack(0, gamepad.Gamepad.EVENT_CODE_INIT_AXIS))
+  period = burst / rate
+  next_time = time.perf_counter()
+  for first in range(1, events + 1, burst):
+    next_time += period
+    delay = next_time - time.perf_counter()
+    if delay > 0:
+      time.sleep(delay)
+    sequences = range(first, min(first + burst, events + 1))
+    now = time.perf_counter()
+    for sequence in sequences:
+      sent[sequence] = now
+    os.write(fd, b''.join(_pack(sequence, gamepad.Gamepad.EVENT_CODE_AXIS)
+                          for sequence in sequences))
+
+
+async def _run(mode: str, coalesce: bool, events: int, rate: float, burst: int,
+               callback_interval: float):
+  read_fd, write_fd = os.pipe()
+  pad = gamepad.PS3()
+  pad.joystick_file = os.fdopen(read_fd, 'rb', buffering=0)
+  pad.attach_event_loop()
+  pad.coalesce_axes = coalesce
+  pad.moved_callback_interval = callback_interval
+  callbacks = 0
+
+  def moved(value):
+    nonlocal callbacks
+    callbacks += 1
+  pad.moved_event_map[_AXIS] = [moved]
+  sent = {}
+  latencies = []
+  writer = threading.Thread(target=_writer, args=(write_fd, events, rate, burst, sent))
+
+  cpu_start = time.process_time()
+  if mode == 'asyncio':
+    pad.start_event_loop_updates()
+  else:
+    pad.start_background_updates(wait_for_ready=False)
+  writer.start()
+  last_sequence = 0
+  while last_sequence < events:
+    await pad.wait_for_update()
+    sequence = round(pad.axis(_AXIS) * gamepad.Gamepad.MAX_AXIS)
+    if sequence > last_sequence:
+      latencies.append(time.perf_counter() - sent[sequence])
+      last_sequence = sequence
+  cpu = time.process_time() - cpu_start
+  writer.join()
+  pad.stop_background_updates()
+  # Wake up the update thread so it can observe that it was stopped.
+  os.write(write_fd, _pack(0, gamepad.Gamepad.EVENT_CODE_AXIS))
+  if pad.update_thread:
+    pad.update_thread.join()
+  os.close(write_fd)
+
+  latencies.sort()
+  label = f'{mode} {"coalesced" if coalesce else "every event"}'
+  print(f'{label:>20}: {cpu / events * 1e6:8.1f} us CPU/event, {callbacks:6} callbacks, '
+        f'latency p50 {statistics.median(latencies) * 1e3:.3f} ms, '
+        f'p99 {latencies[int(len(latencies) * 0.99)] * 1e3:.3f} ms, '
+        f'max {latencies[-1] * 1e3:.3f} ms ({len(latencies)} samples)')
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--events', type=int, default=2000)
+  parser.add_argument('--rate', type=float, default=500.0, help='events per second')
+  parser.add_argument('--burst', type=int, default=1,
+                      help='events written together, as a reader that fell behind finds them')
+  parser.add_argument('--callback-interval', type=float, default=0.0,
+                      help='Gamepad.moved_callback_interval of the readers')
+  args = parser.parse_args()
+  # Sequence numbers travel in the int16 event value.
+  args.events = min(args.events, int(gamepad.Gamepad.MAX_AXIS))
+  for mode in ('thread', 'asyncio'):
+    for coalesce in (False, True):
+      asyncio.run(_run(mode, coalesce, args.events, args.rate, args.burst,
+                       args.callback_interval))
+
+
+if __name__ == '__main__':
+  main()
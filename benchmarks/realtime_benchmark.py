@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+"""Latency of feed hold and cycle start presses while jogs keep the controller busy.
+
+The left stick is held all along, so the pendant keeps sending jogs to a
+stand-in server answering each line after --ack-delay seconds, like a busy
+controller. SELECT (feed hold) and START (cycle start) are pressed in turns
+every --period seconds. For each press the script measures the time from
+writing it into the FIFO standing in for the joystick to the server receiving
+the command, with the priority lane of realtime.py and without it
+("realtime lane = no"), where the commands wait behind the jogs.
+
+By default the server runs in its own process and is reached through
+socket.io, see harness.FakeCNCjsServer. With --in-process, commands are
+received by a CNCjs_SIO standing in for the client and the server, so the
+network is left out.
+
+The script exits with status 1 when a press through the lane was not
+received, or took longer than --budget, by default realtime.LATENCY_BUDGET.
+
+Usage: python3 benchmarks/realtime_benchmark.py [--presses N] [--period S]
+           [--ack-delay S] [--budget S] [--reader thread|asyncio] [--in-process]
+"""
+
+import argparse
+import asyncio
+import collections
+import pathlib
+import statistics
+import sys
+import time
+
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import cncjs_sio  # noqa: E402
+import gamepad  # noqa: E402
+import pendant  # noqa: E402
+import realtime  # noqa: E402
+
+import harness  # noqa: E402
+
+_BUTTON_COMMANDS = (('SELECT', 'feedhold'), ('START', 'cyclestart'))
+# Seconds to wait for the commands still queued behind jogs after the last press
+_DRAIN_TIMEOUT = 2.0
+
+
+async def _connect(config, server, ack_delay: float):
+  if server is None:
+    return harness.StandInSIO(ack_delay)
+  sio = cncjs_sio.CNCjs_SIO(max_in_flight=config.max_in_flight)
+  await sio.connect(config.address, 'benchmark')
+  await sio.open_port(config.cnc_port, config.baudrate, config.controller_type)
+  return sio
+
+
+async def _arrivals(sio, server) -> List[Tuple[str, float]]:
+  if server is None:
+    return list(sio.arrivals)
+  return [tuple(arrival) for arrival in (await sio.client.call('benchmark:stats'))['realtime']]
+
+
+async def measure(lane: bool, args, server) -> Dict[str, List[float]]:
+  """Returns the latencies of the presses of each command, inf for the ones not received."""
+  device_options = {'realtime lane': 'yes' if lane else 'no', 'reader': args.reader}
+  config = harness.pendant_config(server.address if server else '127.0.0.1:0', device_options)
+  joystick = harness.SyntheticJoystick()
+  pad = config.gamepad
+  pad.joystick_path = joystick.path
+  sio = await _connect(config, server, args.ack_delay)
+  await pad.open()
+  joystick.play(harness.init_events(pad))
+  task = asyncio.ensure_future(pendant.run_pendant(config, sio))
+  pressed_at: Dict[str, List[float]] = collections.defaultdict(list)
+  try:
+    await asyncio.sleep(0.2)
+    already_arrived = len(await _arrivals(sio, server))
+    joystick.write(((int(gamepad.Gamepad.MAX_AXIS), gamepad.Gamepad.EVENT_CODE_AXIS,
+                     pad.axis_index['LEFT-X']),))
+    await asyncio.sleep(args.period)
+    for press in range(args.presses):
+      button, command = _BUTTON_COMMANDS[press % len(_BUTTON_COMMANDS)]
+      pressed_at[command].append(time.perf_counter())
+      joystick.write(((1, gamepad.Gamepad.EVENT_CODE_BUTTON, pad.button_index[button]),))
+      await asyncio.sleep(args.period / 2)
+      joystick.write(((0, gamepad.Gamepad.EVENT_CODE_BUTTON, pad.button_index[button]),))
+      await asyncio.sleep(args.period / 2)
+    joystick.write(((0, gamepad.Gamepad.EVENT_CODE_AXIS, pad.axis_index['LEFT-X']),))
+
+    deadline = time.perf_counter() + _DRAIN_TIMEOUT
+    while True:
+      arrivals = (await _arrivals(sio, server))[already_arrived:]
+      if len(arrivals) >= args.presses or time.perf_counter() > deadline:
+        break
+      await asyncio.sleep(0.05)
+  finally:
+    task.cancel()
+    harness.stop_gamepad(pad, joystick)
+    if server is not None:
+      await sio.client.disconnect()
+    joystick.close()
+
+  arrived_at: Dict[str, List[float]] = collections.defaultdict(list)
+  for command, at in arrivals:
+    arrived_at[command].append(at)
+  return {command: [arrived - pressed if arrived is not None else float('inf')
+                    for pressed, arrived in zip(
+                      times, arrived_at[command] + [None] * (len(times) - len(arrived_at[command])))]
+          for command, times in pressed_at.items()}
+
+
+def print_results(label: str, latencies: Dict[str, List[float]]) -> None:
+  for command, values in latencies.items():
+    received = sorted(value for value in values if value != float('inf'))
+    if not received:
+      print(f'{label:>8} {command:>10}: none of {len(values)} received')
+      continue
+    p99 = received[min(len(received) - 1, int(len(received) * 0.99))]
+    print(f'{label:>8} {command:>10}: n={len(received)}/{len(values)} '
+          f'p50={statistics.median(received) * 1e3:.3f} ms p99={p99 * 1e3:.3f} ms '
+          f'max={received[-1] * 1e3:.3f} ms')
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--presses', type=int, default=50)
+  parser.add_argument('--period', type=float, default=0.2,
+                      help='seconds between presses')
+  parser.add_argument('--ack-delay', type=float, default=0.2,
+                      help='seconds the server waits before answering each line')
+  parser.add_argument('--budget', type=float, default=realtime.LATENCY_BUDGET,
+                      help='seconds a press through the lane may take')
+  parser.add_argument('--reader', choices=('thread', 'asyncio'), default='thread')
+  parser.add_argument('--in-process', action='store_true',
+                      help='receive commands in process instead of through socket.io')
+  args = parser.parse_args()
+
+  server = None if args.in_process else harness.FakeCNCjsServer(ack_delay=args.ack_delay)
+  try:
+    results = {label: asyncio.run(measure(lane, args, server))
+               for label, lane in (('lane', True), ('no lane', False))}
+  finally:
+    if server is not None:
+      server.close()
+  for label, latencies in results.items():
+    print_results(label, latencies)
+  worst = max(max(values) for values in results['lane'].values())
+  print(f'worst press through the lane {worst * 1e3:.3f} ms, '
+        f'budget {args.budget * 1e3:.3f} ms')
+  if worst > args.budget:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
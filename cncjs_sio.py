@@ -1,23 +1,39 @@
 import asyncio
+import importlib
 import json
 import logging
-import requests
-from typing import Any, Callable, List, TextIO
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, TextIO
 
-import jwt
-import socketio
+import command_mapping
+import command_queue
+import latency
+import machine_state
 
 
+# aiohttp, jwt and socketio take a large part of the startup time on small
+# boards, they are imported on first use. See import_dependencies.
+if TYPE_CHECKING:
+    import aiohttp
+
 _logger = logging.getLogger('cncjs-py-pendant')
 
+# Seconds between connection attempts, doubled after each failure
+CONNECT_RETRY_START = 0.05
+CONNECT_RETRY_MAX = 2.0
+
 
-def debug_log_handler_factory(prefix: str) -> Callable[..., None]:
-    def debug_log_handler(*args) -> None:
-        _logger.debug(f'{prefix}: {args}')
-    return debug_log_handler
+def import_dependencies() -> None:
+    """Imports the networking libraries used by this module.
+
+    They are otherwise imported on first use. Running this in a thread lets the
+    imports overlap with other startup work."""
+    for name in ('aiohttp', 'jwt', 'socketio'):
+        importlib.import_module(name)
 
 
 def generate_access_token_from_cncrc(cncrc: TextIO) -> str:
+    import jwt
     config = json.loads(cncrc.read())
     token = jwt.encode(
         payload={'id': '', 'name': 'cncjs-py-pendant'},
@@ -27,53 +43,130 @@ def generate_access_token_from_cncrc(cncrc: TextIO) -> str:
     return token if isinstance(token, str) else token.decode()
 
 
-async def get_macro_ids(address: str, token: str):
-    response = requests.get(
-        url=f'http://{address}/api/macros',
-        headers={
-            'Authorization': f'Bearer {token}',
-            'content-type': 'application/json'
-        }
-    )
-
-    if response.status_code != requests.codes.ok:
-      response.raise_for_status()
+async def get_macro_ids(address: str, token: str,
+                        session: Optional['aiohttp.ClientSession'] = None) -> Dict[str, str]:
+    """Returns the name to id mapping of the macros defined in CNCjs.
+
+    Pass a session to reuse its pooled connections across calls."""
+    import aiohttp
+    own_session = session is None
+    if own_session:
+        session = aiohttp.ClientSession()
+    try:
+        async with session.get(
+                url=f'http://{address}/api/macros',
+                headers={
+                    'Authorization': f'Bearer {token}',
+                    'content-type': 'application/json'
+                }) as response:
+            response.raise_for_status()
+            records = (await response.json())['records']
+    finally:
+        if own_session:
+            await session.close()
 
     return {
-      macro['name']: macro['id'] for macro in response.json()['records']
+      macro['name']: macro['id'] for macro in records
     }
 
 
+class MacroCache:
+    """Macro name to id mapping of a CNCjs server, refreshed in the background.
+
+    Lookups never wait for the server: they use the last fetched mapping.
+    """
+
+    def __init__(self, address: str, token: str, ttl: float = 60.0):
+        self.address = address
+        self.token = token
+        self.ttl = ttl
+        self.ids: Dict[str, str] = {}
+        self._session: Optional['aiohttp.ClientSession'] = None
+        self._task: Optional[asyncio.Future] = None
+
+    def get(self, name: str) -> Optional[str]:
+        """Returns the id of the macro with the given name, if known."""
+        return self.ids.get(name)
+
+    async def refresh(self):
+        """Fetches the macros from the server, reusing the pooled connection."""
+        import aiohttp
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        self.ids = await get_macro_ids(self.address, self.token, self._session)
+
+    def start(self):
+        """Starts refreshing the cache every ttl seconds."""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._refresh_loop())
+
+    async def _refresh_loop(self):
+        import aiohttp
+        while True:
+            try:
+                await self.refresh()
+                _logger.debug(f'Macro cache refreshed: {self.ids}')
+            except (aiohttp.ClientError, KeyError, ValueError) as e:
+                _logger.warning(f'Unable to refresh the macro list: {e}')
+            await asyncio.sleep(self.ttl)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
 class CNCjs_SIO:
     """Socket IO object with pre-defined methods to communicate with CNCjs.
 
+    Attributes:
+      state: mirror of the machine state, fed by controller:state and
+      workflow:state events and status reports. CNCjs does not say which port
+      those come from, so a client opens a single port, see
+      pendant.create_clients.
+      ports: ports opened with open_port.
     """
 
-    def __init__(self):
+    def __init__(self, max_in_flight: int = 4):
+        import socketio
         self.client = socketio.AsyncClient()
         self.connected = asyncio.Event()
+        self.queue = command_queue.CommandQueue(max_in_flight=max_in_flight)
+        self.macros: Optional[MacroCache] = None
+        self.latency = latency.LatencyTracker()
+        self.state = machine_state.MachineState()
+        self.ports: List[str] = []
 
         self.client.on('connect', self._connect_handler)
         self.client.on('disconnect', self._disconnect_handler)
-        for handler in ('serialport:read', 'serialport:write'):
-            self._set_debug_handler(handler)
-
-    def _set_debug_handler(self, handler: str):
-        self.client.on(handler, debug_log_handler_factory(handler))
+        self.client.on('serialport:read', self._serial_read_handler)
+        self.client.on('serialport:write', self._serial_write_handler)
+        self.client.on('controller:state', self._controller_state_handler)
+        self.client.on('workflow:state', self._workflow_state_handler)
 
     async def connect(self, address: str, token: str):
+        """Connects to the server, retrying with an exponential backoff.
+
+        The first retries come quickly, for a server that is still starting
+        when the pendant starts, then slow down to CONNECT_RETRY_MAX."""
+        import socketio
         full_address = fr'ws://{address}/socket.io/\?token={token}'
         _logger.info(f'Attempting to connect to {full_address}')
+        retry_interval = CONNECT_RETRY_START
         while True:
             try:
                 await self.client.connect(full_address)
                 break
             except socketio.exceptions.ConnectionError:
-                _logger.info('Unable to connect, will retry in 1 second')
-                await asyncio.sleep(1)
+                _logger.info(f'Unable to connect, will retry in {retry_interval} seconds')
+                await asyncio.sleep(retry_interval)
+                retry_interval = min(retry_interval * 2, CONNECT_RETRY_MAX)
         _logger.info('Connection requested, waiting for confirmation')
         await self.connected.wait()
-        _logger.info(f'Connected')
+        _logger.info('Connected')
 
     async def _connect_handler(self):
         _logger.info('Server reported connection')
@@ -82,3 +175,49 @@ class CNCjs_SIO:
     async def _disconnect_handler(self):
         _logger.info('Server reported disconnection')
         self.connected.clear()
+        self.queue.clear()
+
+    async def _serial_read_handler(self, data: str, *args):
+        _logger.debug(f'serialport:read: {data}')
+        if not self.state.status_report(data):
+            self.queue.serial_read(data)
+
+    async def _controller_state_handler(self, controller_type: str, state: Dict[str, Any], *args):
+        self.state.controller_state(controller_type, state)
+
+    async def _workflow_state_handler(self, workflow_state: str, *args):
+        self.state.workflow(workflow_state)
+
+    async def open_port(self, port: str, baudrate: int, controller_type: str):
+        """Asks the server to open a serial port and send its events here."""
+        await self.client.emit('open', (port, {'baudrate': baudrate, 'controllerType': controller_type}))
+        self.ports.append(port)
+
+    async def _serial_write_handler(self, data: str, *args):
+        _logger.debug(f'serialport:write: {data}')
+        self.latency.serial_write(data)
+
+    async def send_realtime(self, port: str, command: command_mapping.Command):
+        """Sends a real-time command right away, ahead of any command waiting for room.
+
+        The controller acts on real-time commands as soon as they arrive and
+        does not answer them, see realtime.py."""
+        await self.client.emit(command.event, (port,) + command.arguments)
+
+    async def send(self, port: str, command: command_mapping.Command):
+        """Sends a command, waiting until the controller has room for it.
+
+        Macros are referenced by name in commands and sent by id."""
+        if command.arguments[:1] == (command_mapping.MACRO_RUN,):
+            macro_id = self.macros.get(command.arguments[1]) if self.macros else None
+            if macro_id is None:
+                _logger.warning(f'Unknown macro {command.arguments[1]}, not running it')
+                return
+            command = command_mapping.Command(
+                (command_mapping.MACRO_RUN, macro_id) + command.arguments[2:],
+                event=command.event)
+        await self.queue.wait_for_room(command_queue.expected_acks(command))
+        await self.client.emit(command.event, (port,) + command.arguments)
+        self.queue.sent(command)
+        if command.arguments[0] == 'gcode':
+            self.latency.emitted(command.arguments[1].splitlines(), time.perf_counter())
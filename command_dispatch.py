@@ -0,0 +1,234 @@
+"""Runtime form of the command mappings.
+
+The MappedCommand tuples from command_mapping are convenient to write, but
+resolving button and axis names on every tick is wasteful. DispatchTable
+compiles them once against a gamepad into flat, index based entries and only
+re-evaluates them when the gamepad state changed. Each evaluation reads a
+single snapshot of the gamepad state, so it never sees half of a batch of
+events, and indexes its arrays directly.
+
+Axis values go through the input filters of the mapping before they are used:
+radial deadzones of the sticks, then the smoothing of each magnitude axis.
+Hysteresis is applied when comparing them to the thresholds.
+"""
+
+import array
+import dataclasses
+
+import command_mapping
+import gamepad
+
+from typing import Dict, List, Optional, Tuple
+
+
+# Order in which movement axes are emitted in G-code moves
+MOVEMENT_AXES: Tuple[command_mapping.MovementAxis, ...] = tuple(command_mapping.MovementAxis)
+_AXIS_SLOT = {axis: slot for slot, axis in enumerate(MOVEMENT_AXES)}
+
+Moves = Tuple[Tuple[command_mapping.MovementAxis, float], ...]
+
+# Smoothed values closer than this to the input are snapped to it
+_SMOOTHING_TOLERANCE = 1e-3
+
+
+@dataclasses.dataclass(frozen=True)
+class _CommandEntry:
+  button: int
+  repeat_if_pressed: bool
+  commands: Tuple[command_mapping.Command, ...]
+
+
+@dataclasses.dataclass(frozen=True)
+class _MoveEntry:
+  """Movement triggered either by a button (button set) or by an axis (axis set)."""
+  slot: int
+  magnitude_axis: command_mapping.MagnitudeAxis
+  magnitude_index: Optional[int]
+  button: Optional[int] = None
+  repeat_if_pressed: bool = False
+  direction: int = 0
+  axis: Optional[int] = None
+  multiplier: int = 1
+
+
+def _axis_index(pad: gamepad.Gamepad, axis_name: str) -> int:
+  try:
+    if axis_name in pad.axis_index:
+      return pad.axis_index[axis_name]
+    return int(axis_name)
+  except ValueError:
+    raise ValueError(f'Axis name {axis_name} was not found')
+
+
+class DispatchTable:
+  """Mapped commands compiled against the button and axis indices of a gamepad.
+
+  Attributes:
+    gamepad: gamepad whose state is read by evaluate.
+    mapped_commands: mapping the table was compiled from, in the original order.
+  """
+
+  def __init__(self, mapped_commands: Tuple[command_mapping.MappedCommand, ...],
+               pad: gamepad.Gamepad,
+               deadzones: Tuple[command_mapping.RadialDeadzone, ...] = (),
+               exclude_realtime: bool = False):
+    """exclude_realtime leaves out the buttons sent by realtime.RealtimeLane."""
+    self.gamepad = pad
+    self.mapped_commands = mapped_commands
+    self._command_entries: List[_CommandEntry] = []
+    self._move_entries: List[_MoveEntry] = []
+    for action in mapped_commands:
+      if exclude_realtime and action.is_realtime():
+        continue
+      if action.button:
+        button = pad._get_button_index(action.button)
+        if action.commands:
+          self._command_entries.append(_CommandEntry(
+            button=button, repeat_if_pressed=action.repeat_if_pressed,
+            commands=action.commands))
+        elif action.movement_axis and action.direction:
+          magnitude = action.magnitude_axis or command_mapping.MagnitudeAxis()
+          self._move_entries.append(_MoveEntry(
+            slot=_AXIS_SLOT[action.movement_axis],
+            magnitude_axis=magnitude,
+            magnitude_index=_axis_index(pad, magnitude.label) if magnitude.label else None,
+            button=button,
+            repeat_if_pressed=action.repeat_if_pressed,
+            direction=action.direction.value))
+      if action.axis:
+        axis = _axis_index(pad, action.axis.label)
+        self._move_entries.append(_MoveEntry(
+          slot=_AXIS_SLOT[action.movement_axis],
+          magnitude_axis=action.axis,
+          magnitude_index=axis,
+          axis=axis,
+          multiplier=action.axis_direction_multiplier()))
+    self._deadzones = tuple(
+      (_axis_index(pad, deadzone.x), _axis_index(pad, deadzone.y), deadzone)
+      for deadzone in deadzones)
+    # Smoothed axes, with the magnitude axis telling when they are released
+    smoothing: Dict[int, command_mapping.MagnitudeAxis] = {
+      entry.magnitude_index: entry.magnitude_axis for entry in self._move_entries
+      if entry.magnitude_axis.smoothing and entry.magnitude_index is not None}
+    self._smoothing = tuple(smoothing.items())
+    self._smoothed: List[Optional[float]] = [None] * len(self._smoothing)
+    self._filtered = bool(self._deadzones or self._smoothing)
+    # Hysteresis state: whether each move entry triggered, and the last distance
+    # of each movement axis (None while not moving).
+    self._triggered = [False] * len(self._move_entries)
+    self._distances: List[Optional[float]] = [None] * len(MOVEMENT_AXES)
+    self._generation = -1
+    # Press counts of the gamepad state consumed so far, see GamepadState.presses
+    self._presses_seen = array.array('L', (0,)) * gamepad.INPUT_COUNT
+    # Set when the last evaluation depended on something other than held inputs
+    # (press edges or commands), so the next call must evaluate again.
+    self._dirty = True
+    self._moves: Moves = ()
+
+  @property
+  def moves(self) -> Moves:
+    """Moves returned by the last call to evaluate."""
+    return self._moves
+
+  def take_over(self, previous: 'DispatchTable') -> None:
+    """Continues from where previous left, when it is replaced by this table.
+
+    Presses already consumed by previous are not seen again, and the moves it
+    returned last are kept, so jogs running when the table is replaced are
+    cancelled when released. Both tables must read the same gamepad.
+    """
+    self._presses_seen = previous._presses_seen[:]
+    self._moves = previous._moves
+
+  def _consume_press(self, state: gamepad.GamepadState, button: int) -> bool:
+    presses = state.presses[button]
+    if presses != self._presses_seen[button]:
+      self._presses_seen[button] = presses
+      return True
+    return False
+
+  def _axis_values(self, axes: 'array.array[float]') -> 'array.array[float]':
+    """Returns a copy of axes after the radial deadzones and smoothing."""
+    values = axes[:]
+    for x, y, deadzone in self._deadzones:
+      values[x], values[y] = deadzone.apply(values[x], values[y])
+    for slot, (index, magnitude_axis) in enumerate(self._smoothing):
+      value = values[index]
+      if not value or not magnitude_axis.has_triggered(value):
+        # Released axes are not smoothed, so the machine stops right away, and
+        # the next push starts from its own value instead of from the center
+        self._smoothed[slot] = None
+        continue
+      previous = self._smoothed[slot]
+      if previous is not None:
+        smoothed = previous + (1 - magnitude_axis.smoothing) * (value - previous)
+        if abs(smoothed - value) > _SMOOTHING_TOLERANCE:
+          # Still converging, the next tick must evaluate again
+          self._dirty = True
+          value = smoothed
+      self._smoothed[slot] = value
+      values[index] = value
+    return values
+
+  def evaluate(self) -> Tuple[Tuple[command_mapping.Command, ...], Moves]:
+    """Returns the commands or the moves requested by the current gamepad state.
+
+    Commands take precedence: when a command button was pressed its commands are
+    returned and moves are empty. Moves are (movement axis, signed distance) pairs
+    in MOVEMENT_AXES order. While the gamepad state does not change, the moves from
+    the previous call are returned without looking at any input.
+    """
+    state = self.gamepad.snapshot()
+    if state.generation == self._generation and not self._dirty:
+      return (), self._moves
+    self._generation = state.generation
+    self._dirty = False
+    pressed = state.pressed
+
+    for entry in self._command_entries:
+      if (pressed[entry.button] if entry.repeat_if_pressed
+          else self._consume_press(state, entry.button)):
+        # Other presses may still be pending, and held commands repeat.
+        self._dirty = True
+        self._moves = ()
+        return entry.commands, ()
+
+    directions = [0] * len(MOVEMENT_AXES)
+    magnitudes: List[Optional[command_mapping.MagnitudeAxis]] = [None] * len(MOVEMENT_AXES)
+    magnitude_indices: List[Optional[int]] = [None] * len(MOVEMENT_AXES)
+    axes = self._axis_values(state.axes) if self._filtered else state.axes
+    for number, entry in enumerate(self._move_entries):
+      if entry.axis is not None:
+        value = axes[entry.axis]
+        triggered = bool(value) and entry.magnitude_axis.has_triggered(
+          value, self._triggered[number])
+        self._triggered[number] = triggered
+        if not triggered:
+          continue
+        directions[entry.slot] += (1 if value > 0 else -1) * entry.multiplier
+      else:
+        if entry.repeat_if_pressed:
+          if not pressed[entry.button]:
+            continue
+        elif self._consume_press(state, entry.button):
+          # Single shot moves must not be repeated from the cache.
+          self._dirty = True
+        else:
+          continue
+        directions[entry.slot] += entry.direction
+      # As in the mapping order, the last triggered entry sets the magnitude.
+      magnitudes[entry.slot] = entry.magnitude_axis
+      magnitude_indices[entry.slot] = entry.magnitude_index
+
+    moves = []
+    for slot, direction in enumerate(directions):
+      if not direction:
+        self._distances[slot] = None
+        continue
+      index = magnitude_indices[slot]
+      distance = magnitudes[slot].travel_distance(
+        axes[index] if index is not None else 0.0, self._distances[slot])
+      self._distances[slot] = distance
+      moves.append((MOVEMENT_AXES[slot], distance * direction))
+    self._moves = tuple(moves)
+    return (), self._moves
@@ -1,10 +1,13 @@
 #!/usr/bin/python3
 
+import array
+import bisect
 import dataclasses
 import enum
+import functools
 import math
 
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 
 
 @dataclasses.dataclass(frozen=True)
@@ -16,8 +19,28 @@ class Command:
 
        Attributes:
        arguments: a tuple of arguments to be sent to the server, ordered
+       event: socket.io event used to send the arguments. "command" runs a CNCjs
+       controller command, "write" sends the arguments raw to the serial port.
     """
     arguments: Tuple[str, ...]
+    event: str = 'command'
+
+
+# Grbl real-time command to cancel the current jog and flush queued jog moves
+JOG_CANCEL = Command(('\x85',), event='write')
+# CNCjs controller commands writing Grbl real-time commands: feed hold (!),
+# cycle start (~) and soft reset (0x18). CNCjs also pauses or stops the program
+# it is sending for them.
+FEED_HOLD = Command(('feedhold',))
+CYCLE_START = Command(('cyclestart',))
+SOFT_RESET = Command(('reset',))
+# Commands Grbl acts on as soon as they arrive, without answering them. Buttons
+# mapped only to these are sent by the priority lane, see realtime.py.
+REALTIME_COMMANDS = frozenset((FEED_HOLD, CYCLE_START, SOFT_RESET, JOG_CANCEL))
+
+# CNCjs command running a macro. Mappings reference macros by name, the name is
+# replaced by the macro id when the command is sent.
+MACRO_RUN = 'macro:run'
 
 
 class MovementAxis(enum.Enum):
@@ -27,12 +50,119 @@ class MovementAxis(enum.Enum):
     Z = 'Z'
 
 
+# Position of each axis in (x, y, z) tuples
+AXIS_INDEX = {axis: index for index, axis in enumerate(MovementAxis)}
+
+
 class Direction(enum.Enum):
     """Direction of the movement (increasing or decreasing"""
     POSITIVE = 1
     NEGATIVE = -1
 
 
+@dataclasses.dataclass(frozen=True)
+class ResponseCurve:
+    """Continuous response of an axis, replacing the slow/mid/fast steps.
+
+    The curve maps the axis deflection, between 0 (just triggered) and 1 (fully
+    pressed), into a travel distance between slow_move_step and fast_move_step of
+    the MagnitudeAxis using it.
+
+    Attributes:
+      shape: "linear", "exponential" or "piecewise". Exponential curves multiply
+      the distance by the same factor for equal increments of the deflection, which
+      gives fine control close to the center and fast moves at the end.
+      points: for piecewise curves, (deflection, fraction) pairs with both values
+      between 0 and 1. fraction is the position between slow_move_step and
+      fast_move_step, and is linearly interpolated between points.
+    """
+    shape: str = 'linear'
+    points: Tuple[Tuple[float, float], ...] = ()
+
+    def __post_init__(self):
+        if self.shape not in ('linear', 'exponential', 'piecewise'):
+            raise ValueError(f'Unknown response curve shape {self.shape}')
+        if self.shape == 'piecewise' and len(self.points) < 2:
+            raise ValueError('Piecewise response curves need at least two points')
+        # Sorted deflections and fractions of the points, and the slope of each
+        # segment between them, see steps
+        points = sorted(self.points)
+        object.__setattr__(self, '_xs', tuple(x for x, _ in points))
+        object.__setattr__(self, '_ys', tuple(y for _, y in points))
+        object.__setattr__(self, '_slopes', tuple(
+            (y1 - y0) / (x1 - x0) if x1 > x0 else 0.0
+            for (x0, y0), (x1, y1) in zip(points, points[1:])))
+
+    def steps(self, deflections: Sequence[float], slow_step: float,
+              fast_step: float) -> List[float]:
+        """Returns the travel distance for each deflection.
+
+        Deflections must be between 0 and 1, in increasing order."""
+        span = fast_step - slow_step
+        if self.shape == 'exponential' and slow_step > 0:
+            ratio = fast_step / slow_step
+            return [slow_step * ratio ** deflection for deflection in deflections]
+        if self.shape == 'piecewise':
+            xs, ys = self._xs, self._ys
+            # Deflections up to the first point, then those of each segment up
+            # to its end point, then those after the last point.
+            end = bisect.bisect_right(deflections, xs[0])
+            steps = [slow_step + span * ys[0]] * end
+            for x0, y0, x1, slope in zip(xs, ys, xs[1:], self._slopes):
+                start, end = end, bisect.bisect_right(deflections, x1, end)
+                base = slow_step + span * (y0 - slope * x0)
+                factor = span * slope
+                steps += [base + factor * deflection for deflection in deflections[start:end]]
+            steps += [slow_step + span * ys[-1]] * (len(deflections) - end)
+            return steps
+        return [slow_step + span * deflection for deflection in deflections]
+
+    def step(self, deflection: float, slow_step: float, fast_step: float) -> float:
+        """Returns the travel distance for a deflection between 0 and 1."""
+        return self.steps((min(max(deflection, 0.0), 1.0),), slow_step, fast_step)[0]
+
+
+# Joystick drivers report axes as signed 16 bit integers
+_RAW_AXIS_MIN = -32768
+_RAW_AXIS_SCALE = 32767
+
+
+@functools.lru_cache(maxsize=None)
+def _distance_table(curve: ResponseCurve, slow_step: float, fast_step: float,
+                    start: float, use_absolute_input: bool) -> array.array:
+    """Travel distance for every raw axis value, indexed by raw value - _RAW_AXIS_MIN.
+
+    The curve is evaluated for the whole table at once, and only between the
+    raw values where the deflection leaves 0 and reaches 1. Absolute axes are
+    symmetric, so only the values from 0 to -_RAW_AXIS_MIN are evaluated."""
+    scale = 1 / (_RAW_AXIS_SCALE * (1 - start))
+    if use_absolute_input:
+        # Absolute axes rest at 0
+        first, end = 0, -_RAW_AXIS_MIN + 1
+        offset = -start / (1 - start)
+    else:
+        # Others (like triggers) rest at -1
+        first, end = _RAW_AXIS_MIN, -_RAW_AXIS_MIN
+        scale /= 2
+        offset = (0.5 - start) / (1 - start)
+    # Deflections grow with the raw value: 0 before low, 1 from high on
+    low = min(max(math.floor(-offset / scale), first), end)
+    while low < end and low * scale + offset <= 0:
+        low += 1
+    high = min(max(math.floor((1 - offset) / scale), low), end)
+    while high < end and high * scale + offset < 1:
+        high += 1
+    rest, full = curve.steps((0.0, 1.0), slow_step, fast_step)
+    steps = ([rest] * (low - first)
+             + curve.steps([raw * scale + offset for raw in range(low, high)],
+                           slow_step, fast_step)
+             + [full] * (end - high))
+    if use_absolute_input:
+        # Negative values, from _RAW_AXIS_MIN to -1, then the positive ones
+        steps = steps[:0:-1] + steps[:-1]
+    return array.array('d', steps)
+
+
 @dataclasses.dataclass(frozen=True)
 class MagnitudeAxis:
     """Describes how to convert an axis input into movement steps
@@ -56,6 +186,16 @@ class MagnitudeAxis:
       value. Should be set for directional axis, where the signal is used to indicate
       the direction of the movement and the value represents the "intensity" of the
       movement.
+      curve: if set, the travel distance follows this curve from slow_move_step to
+      fast_move_step instead of the three steps. The curve starts where the axis
+      triggers and is precomputed for every raw axis value.
+      hysteresis: how far back below trigger_if_above, slow_when_below or
+      fast_when_above the input must go to leave the state it reached by crossing
+      them, so noise around a threshold does not make the axis flicker between
+      states. Crossing a threshold forward is not delayed.
+      smoothing: weight of the previous value in an exponential moving average of
+      the input, between 0 (no smoothing) and 1. Applied each time the mapping is
+      evaluated, and never delays pushing or releasing the axis.
     """
     label: str = ''
     slow_move_step: float = 0.1
@@ -65,28 +205,56 @@ class MagnitudeAxis:
     fast_when_above: float = 0.8
     trigger_if_above: float = -math.inf
     use_absolute_input: bool = False
-
-    def has_triggered(self, input: float) -> bool:
+    curve: Optional[ResponseCurve] = None
+    hysteresis: float = 0.0
+    smoothing: float = 0.0
+
+    def __post_init__(self):
+        if not 0 <= self.smoothing < 1:
+            raise ValueError(f'Smoothing must be between 0 and 1, not {self.smoothing}')
+        if self.curve:
+            start = max(self.trigger_if_above, 0.0) if self.use_absolute_input else 0.0
+            object.__setattr__(self, '_distance_table', _distance_table(
+                self.curve, self.slow_move_step, self.fast_move_step, start,
+                self.use_absolute_input))
+
+    def has_triggered(self, input: float, was_triggered: bool = False) -> bool:
         """Determines whether the axis has triggered.
 
            Args:
              input: numerical value returned by the joystick axis.
+             was_triggered: whether the axis had triggered the previous time, used
+             with hysteresis.
         """
         if self.use_absolute_input:
             input = abs(input)
+        if was_triggered:
+            return input > self.trigger_if_above - self.hysteresis
         return input > self.trigger_if_above
 
-    def travel_distance(self, input: float) -> float:
+    def travel_distance(self, input: float, previous: Optional[float] = None) -> float:
         """Transforms Joystick axis input into the travel distance for the CNC head.
 
            Args:
            input: numerical value returned by the joystick axis.
+           previous: distance returned the previous time while the axis was
+           triggered, used with hysteresis.
         """
+        if self.curve:
+            return self._distance_table[round(input * _RAW_AXIS_SCALE) - _RAW_AXIS_MIN]
         if self.use_absolute_input:
             input = abs(input)
-        if input < self.slow_when_below:
+        slow_when_below = self.slow_when_below
+        fast_when_above = self.fast_when_above
+        if previous is not None and self.hysteresis:
+            # Going back to a slower step takes hysteresis more
+            if previous != self.slow_move_step:
+                slow_when_below -= self.hysteresis
+            if previous == self.fast_move_step:
+                fast_when_above -= self.hysteresis
+        if input < slow_when_below:
             return self.slow_move_step
-        if input > self.fast_when_above:
+        if input > fast_when_above:
             return self.fast_move_step
         return self.mid_move_step
 
@@ -125,6 +293,11 @@ class MappedCommand:
         """Returns the axis direction multiplier based on whether the movement is inverted or not."""
         return -1 if self.reverse_axis_direction else 1
 
+    def is_realtime(self) -> bool:
+        """Whether this is a button sending only real-time commands."""
+        return bool(self.button and self.commands) and all(
+            command in REALTIME_COMMANDS for command in self.commands)
+
 
 # Command mapping factories
 def homing(button: str) -> MappedCommand:
@@ -144,6 +317,26 @@ def set_zero(button: str) -> MappedCommand:
         Command(('gcode', 'G10 L20 P1 X0 Y0 Z0')),))
 
 
+def macro(button: str, name: str) -> MappedCommand:
+    return MappedCommand(button=button, commands=(Command((MACRO_RUN, name)),))
+
+
+def feed_hold(button: str) -> MappedCommand:
+    return MappedCommand(button=button, commands=(FEED_HOLD,))
+
+
+def cycle_start(button: str) -> MappedCommand:
+    return MappedCommand(button=button, commands=(CYCLE_START,))
+
+
+def soft_reset(button: str) -> MappedCommand:
+    return MappedCommand(button=button, commands=(SOFT_RESET,))
+
+
+def jog_cancel(button: str) -> MappedCommand:
+    return MappedCommand(button=button, commands=(JOG_CANCEL,))
+
+
 def directional_buttons(*,
                         movement_axis: MovementAxis,
                         positive_button: str,
@@ -210,6 +403,65 @@ def z_joystick_axis(label: str) -> MagnitudeAxis:
         use_absolute_input=True,
     )
 
+@dataclasses.dataclass(frozen=True)
+class WorkEnvelope:
+    """Travel limits of a machine, in machine coordinates.
+
+    Attributes:
+      minimum: lowest reachable (x, y, z) machine position.
+      maximum: highest reachable (x, y, z) machine position.
+    """
+    minimum: Tuple[float, float, float]
+    maximum: Tuple[float, float, float]
+
+    def __post_init__(self):
+        if any(low > high for low, high in zip(self.minimum, self.maximum)):
+            raise ValueError(f'Envelope minimum {self.minimum} above maximum {self.maximum}')
+
+    def limit(self, axis: MovementAxis, start: float, distance: float) -> float:
+        """Returns distance shortened so that moving it from start stays inside.
+
+        Shortened distances are rounded towards start to a thousandth, the
+        resolution of jog G-code, so rounding them for G-code cannot cross the
+        limit. Never moves further out of the envelope when start is already
+        outside."""
+        index = AXIS_INDEX[axis]
+        if distance > 0:
+            room = self.maximum[index] - start
+            return distance if distance <= room else max(0.0, math.floor(room * 1000) / 1000)
+        room = self.minimum[index] - start
+        return distance if distance >= room else min(0.0, math.ceil(room * 1000) / 1000)
+
+
+@dataclasses.dataclass(frozen=True)
+class RadialDeadzone:
+    """Deadzone applied to the length of a stick position instead of each axis.
+
+    Positions closer to the center than radius are centered, and the others are
+    left unchanged, so the thresholds of the axes apply to the real deflection.
+    Unlike per axis thresholds, this does not favour the diagonals.
+
+    Attributes:
+      x: label of the horizontal axis of the stick.
+      y: label of the vertical axis of the stick.
+      radius: radius of the deadzone, between 0 and 1.
+    """
+    x: str
+    y: str
+    radius: float
+
+    def __post_init__(self):
+        if not 0 <= self.radius < 1:
+            raise ValueError(f'Deadzone radius must be between 0 and 1, not {self.radius}')
+
+    def apply(self, x: float, y: float) -> Tuple[float, float]:
+        """Returns the stick position after the deadzone."""
+        length = math.hypot(x, y)
+        if length <= self.radius:
+            return 0.0, 0.0
+        return x, y
+
+
 # Default mapping for combination of CNC machines and gamepads
 @dataclasses.dataclass(frozen=True)
 class GamepadAndCNCMachine:
@@ -222,6 +474,8 @@ _MAPS: Dict[GamepadAndCNCMachine, Tuple[MappedCommand, ...]] = {
         homing('PS'),
         zero('R1'),
         set_zero('L1'),
+        feed_hold('SELECT'),
+        cycle_start('START'),
         MappedCommand(axis=xy_joystick_axis('LEFT-X'),
                       movement_axis=MovementAxis.X),
         MappedCommand(axis=xy_joystick_axis('LEFT-Y'), movement_axis=MovementAxis.Y,
@@ -246,5 +500,60 @@ _MAPS: Dict[GamepadAndCNCMachine, Tuple[MappedCommand, ...]] = {
     )
 }
 
+# Default work envelope of each mapping. Grbl puts the origin where homing
+# ends, at the top right back corner of a Shapeoko 3, so the envelope is
+# -travel..0 on each axis, as for Grbl's own soft limits.
+_ENVELOPES: Dict[GamepadAndCNCMachine, WorkEnvelope] = {
+    GamepadAndCNCMachine(gamepad='PS3', cnc='Shapeoko'): WorkEnvelope(
+        minimum=(-425, -425, -75), maximum=(0, 0, 0)),
+}
+
 def get_mapping(gamepad: str, cnc: str) -> Tuple[MappedCommand, ...]:
   return _MAPS[GamepadAndCNCMachine(gamepad=gamepad, cnc=cnc)]
+
+
+# Axes of the sticks used by each mapping, as (x, y) labels, for radial deadzones
+_STICKS: Dict[GamepadAndCNCMachine, Tuple[Tuple[str, str], ...]] = {
+    GamepadAndCNCMachine(gamepad='PS3', cnc='Shapeoko'): (
+        ('LEFT-X', 'LEFT-Y'), ('RIGHT-X', 'RIGHT-Y')),
+}
+
+def get_envelope(gamepad: str, cnc: str) -> Optional[WorkEnvelope]:
+    """Returns the default work envelope of a mapping, None if it has none."""
+    return _ENVELOPES.get(GamepadAndCNCMachine(gamepad=gamepad, cnc=cnc))
+
+
+def get_sticks(gamepad: str, cnc: str) -> Tuple[Tuple[str, str], ...]:
+    """Returns the (x, y) axis labels of the sticks used by a mapping."""
+    return _STICKS.get(GamepadAndCNCMachine(gamepad=gamepad, cnc=cnc), ())
+
+
+def with_response_curve(mapping: Tuple[MappedCommand, ...],
+                        curve: ResponseCurve) -> Tuple[MappedCommand, ...]:
+    """Returns mapping with every magnitude axis following the given curve."""
+    def replace(axis: Optional[MagnitudeAxis]) -> Optional[MagnitudeAxis]:
+        return dataclasses.replace(axis, curve=curve) if axis else None
+    return tuple(
+        dataclasses.replace(action, axis=replace(action.axis),
+                            magnitude_axis=replace(action.magnitude_axis))
+        for action in mapping)
+
+
+def with_filters(mapping: Tuple[MappedCommand, ...], hysteresis: float = 0.0,
+                 smoothing: float = 0.0) -> Tuple[MappedCommand, ...]:
+    """Returns mapping with every magnitude axis using the given input filters."""
+    def replace(axis: Optional[MagnitudeAxis]) -> Optional[MagnitudeAxis]:
+        return (dataclasses.replace(axis, hysteresis=hysteresis, smoothing=smoothing)
+                if axis else None)
+    return tuple(
+        dataclasses.replace(action, axis=replace(action.axis),
+                            magnitude_axis=replace(action.magnitude_axis))
+        for action in mapping)
+
+
+def get_deadzones(sticks: Tuple[Tuple[str, str], ...],
+                  radius: float) -> Tuple[RadialDeadzone, ...]:
+    """Returns radial deadzones of the given radius for sticks, see get_sticks."""
+    if not radius:
+        return ()
+    return tuple(RadialDeadzone(x=x, y=y, radius=radius) for x, y in sticks)
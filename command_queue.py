@@ -0,0 +1,217 @@
+"""Flow control for commands sent to the CNC controller.
+
+Grbl answers every line it receives with either "ok" or "error:N", which CNCjs
+forwards as serialport:read events. CommandQueue counts lines that were sent
+but not answered yet and lets the pendant hold back new commands while that
+count is at the configured limit, so held jogs cannot pile up moves in the
+CNCjs feeder and the serial buffers that keep running after the release.
+
+Commands waiting for room are kept in PendingCommands, which merges jog moves
+that were not sent yet instead of sending them one by one.
+"""
+
+import asyncio
+import collections
+import dataclasses
+import time
+
+import command_mapping
+
+from typing import Callable, Deque, Dict, List, Optional, Tuple, Union
+
+
+# CNCjs controller commands that write a single line expecting an answer
+_SINGLE_LINE_COMMANDS = ('homing', 'unlock')
+
+
+def expected_acks(command: command_mapping.Command) -> int:
+  """Returns how many "ok"/"error" answers the controller sends for a command."""
+  if command.event != 'command' or not command.arguments:
+    return 0
+  if command.arguments[0] == 'gcode':
+    return len([line for line in command.arguments[1].splitlines() if line.strip()])
+  if command.arguments[0] in _SINGLE_LINE_COMMANDS:
+    return 1
+  return 0
+
+
+def is_ack(line: str) -> bool:
+  """Whether a line read from the controller answers a previously sent line."""
+  line = line.strip()
+  return line == 'ok' or line.startswith('error')
+
+
+class CommandQueue:
+  """Outstanding (sent but not answered) controller lines.
+
+  Attributes:
+    max_in_flight: maximum number of unanswered lines.
+    ack_timeout: seconds after which an unanswered line is forgotten. Protects
+    against answers that never arrive, like lines flushed by a reset.
+    ack_listeners: called on every answer, least recently served first.
+  """
+
+  def __init__(self, max_in_flight: int = 4, ack_timeout: float = 5.0):
+    self.max_in_flight = max_in_flight
+    self.ack_timeout = ack_timeout
+    self._sent_times: Deque[float] = collections.deque()
+    self._acked = asyncio.Event()
+    self.ack_listeners: List[Callable[[], None]] = []
+
+  @property
+  def depth(self) -> int:
+    """Number of lines sent and not answered yet."""
+    self._expire()
+    return len(self._sent_times)
+
+  def has_room(self, lines: int = 1) -> bool:
+    """Whether the given number of lines can be sent without exceeding the limit.
+
+    A command larger than the limit can be sent once nothing is outstanding.
+    """
+    return self.depth + min(lines, self.max_in_flight) <= self.max_in_flight
+
+  def sent(self, command: command_mapping.Command) -> None:
+    """Records a command that was just sent to the controller."""
+    now = time.monotonic()
+    self._sent_times.extend([now] * expected_acks(command))
+
+  def serial_read(self, line: str) -> None:
+    """Handler for lines read from the controller."""
+    if is_ack(line) and self._sent_times:
+      self._sent_times.popleft()
+      self._acked.set()
+      for listener in self.ack_listeners:
+        listener()
+
+  def served(self, listener: Callable[[], None]) -> None:
+    """Moves the listener of a sender that just sent commands last.
+
+    Senders sharing the queue are woken up least recently served first, so
+    the one registered first does not always take the room freed by an answer.
+    """
+    self.ack_listeners.remove(listener)
+    self.ack_listeners.append(listener)
+
+  def clear(self) -> None:
+    """Forgets every outstanding line, for instance after a disconnection."""
+    self._sent_times.clear()
+    self._acked.set()
+
+  async def wait_for_room(self, lines: int = 1) -> None:
+    """Waits until the given number of lines can be sent."""
+    while not self.has_room(lines):
+      self._acked.clear()
+      timeout = self._sent_times[0] + self.ack_timeout - time.monotonic()
+      try:
+        await asyncio.wait_for(self._acked.wait(), max(timeout, 0))
+      except asyncio.TimeoutError:
+        pass
+
+  def _expire(self) -> None:
+    expire_before = time.monotonic() - self.ack_timeout
+    while self._sent_times and self._sent_times[0] < expire_before:
+      self._sent_times.popleft()
+
+
+@dataclasses.dataclass
+class PendingJog:
+  """Jog moves merged while waiting to be sent.
+
+  Attributes:
+    distances: relative distance to travel on each axis.
+    duration: seconds of jogging the merged moves were generated for.
+  """
+  distances: Dict[command_mapping.MovementAxis, float]
+  duration: float
+
+
+PendingItem = Union[Tuple[command_mapping.Command, ...], PendingJog]
+
+
+@dataclasses.dataclass
+class _Entry:
+  item: PendingItem
+  # time.perf_counter of the first put and of the input that caused it
+  queued_at: float
+  input_at: float
+
+
+class PendingCommands:
+  """Commands produced by the pendant and not sent to the controller yet.
+
+  Consecutive jog moves are merged into a single PendingJog, with the distance
+  on each axis limited to max_distance. Any other command is kept in order and
+  acts as a barrier: moves are never merged across it, and it is never merged
+  or reordered itself.
+
+  Attributes:
+    max_distance: maximum distance of a merged jog on each axis.
+    changed: set whenever items are added or removed, or room may be available.
+  """
+
+  def __init__(self, max_distance: float = 10):
+    self.max_distance = max_distance
+    self.changed = asyncio.Event()
+    self._entries: Deque[_Entry] = collections.deque()
+
+  def __len__(self) -> int:
+    return len(self._entries)
+
+  def _append(self, item: PendingItem, input_at: Optional[float]) -> None:
+    now = time.perf_counter()
+    self._entries.append(_Entry(item=item, queued_at=now,
+                                input_at=now if input_at is None else input_at))
+
+  def wake(self) -> None:
+    """Wakes up the sender, for instance because the controller answered a line."""
+    self.changed.set()
+
+  def put_commands(self, commands: Tuple[command_mapping.Command, ...],
+                   input_at: Optional[float] = None) -> None:
+    """Queues commands to be sent in order.
+
+    input_at is the time.perf_counter of the input that generated the commands.
+    A jog cancel makes any jog that was not sent yet pointless, those are dropped.
+    """
+    if command_mapping.JOG_CANCEL in commands:
+      self.discard_moves()
+    self._append(commands, input_at)
+    self.changed.set()
+
+  def put_moves(self, moves: Tuple[Tuple[command_mapping.MovementAxis, float], ...],
+                duration: float, input_at: Optional[float] = None) -> None:
+    """Queues jog moves, merging them with a jog that was not sent yet."""
+    if self._entries and isinstance(self._entries[-1].item, PendingJog):
+      jog = self._entries[-1].item
+      limited = False
+      for axis, distance in moves:
+        total = jog.distances.get(axis, 0) + distance
+        if abs(total) > self.max_distance:
+          total = self.max_distance if total > 0 else -self.max_distance
+          limited = True
+        jog.distances[axis] = total
+      if not limited:
+        jog.duration += duration
+    else:
+      self._append(PendingJog(distances=dict(moves), duration=duration), input_at)
+    self.changed.set()
+
+  def discard_moves(self) -> None:
+    """Drops every jog that was not sent yet."""
+    self._entries = collections.deque(
+      entry for entry in self._entries if not isinstance(entry.item, PendingJog))
+    self.changed.set()
+
+  def peek(self) -> PendingItem:
+    """Returns the next item to be sent, either a tuple of commands or a PendingJog."""
+    return self._entries[0].item
+
+  def peek_times(self) -> Tuple[float, float]:
+    """Returns when the next item was queued and when its input was read."""
+    entry = self._entries[0]
+    return entry.queued_at, entry.input_at
+
+  def pop(self) -> PendingItem:
+    """Removes and returns the next item to be sent."""
+    return self._entries.popleft().item
@@ -1,10 +1,13 @@
 import configparser
 import dataclasses
+import pathlib
 
 import gamepad
+import command_dispatch
 import command_mapping
+import mapping_file
 
-from typing import TextIO, Tuple
+from typing import Mapping, Optional, TextIO, Tuple
 
 
 class NoValidConfigError(Exception):
@@ -15,10 +18,23 @@ class NoValidConfigError(Exception):
 class ConfigObjects:
   gamepad: gamepad.Gamepad
   mapped_commands: command_mapping.Tuple[command_mapping.MappedCommand, ...]
+  dispatch: command_dispatch.DispatchTable
   address: str
   cnc_port: str
   baudrate: int
   controller_type: str
+  repeat_interval: float = 0.1
+  reader: str = 'thread'
+  jog_mode: str = 'step'
+  max_in_flight: int = 4
+  max_jog_distance: float = 10
+  macro_refresh: float = 60
+  latency_report: float = 0
+  name: str = 'default'
+  envelope: Optional[command_mapping.WorkEnvelope] = None
+  coalesce_axes: bool = False
+  moved_callback_interval: float = 0.02
+  realtime_lane: bool = False
 
 # Strings used in the config file
 _SERVER_SECTION = 'server'
@@ -29,6 +45,31 @@ _BAUDRATE_OPTION = 'baudrate'
 _CONTROLLER_TYPE_OPTION = 'device type'
 _GAMEPAD_OPTION = 'gamepad'
 _CNC_OPTION = 'cnc machine'
+_MAX_IN_FLIGHT_OPTION = 'max in flight'
+_MACRO_REFRESH_OPTION = 'macro refresh'
+_REPEAT_INTERVAL_OPTION = 'repeat interval'
+_READER_OPTION = 'reader'
+_READERS = ('thread', 'asyncio')
+_JOG_MODE_OPTION = 'jog mode'
+_JOG_MODES = ('step', 'continuous')
+_MAX_JOG_DISTANCE_OPTION = 'max jog distance'
+_RESPONSE_CURVE_OPTION = 'response curve'
+_LATENCY_REPORT_OPTION = 'latency report'
+_RESPONSE_CURVE_POINTS_OPTION = 'response curve points'
+_JOYSTICK_OPTION = 'joystick'
+_JOYSTICK_API_OPTION = 'joystick api'
+_SOFT_LIMITS_OPTION = 'soft limits'
+_TRAVEL_MIN_OPTION = 'travel min'
+_TRAVEL_MAX_OPTION = 'travel max'
+_HYSTERESIS_OPTION = 'hysteresis'
+_SMOOTHING_OPTION = 'smoothing'
+_RADIAL_DEADZONE_OPTION = 'radial deadzone'
+_COALESCE_AXES_OPTION = 'coalesce axes'
+_MOVED_CALLBACK_INTERVAL_OPTION = 'moved callback interval'
+_MAPPING_FILE_OPTION = 'mapping file'
+_REALTIME_LANE_OPTION = 'realtime lane'
+# Sections named "pendant NAME" define one pendant each
+_PENDANT_SECTION_PREFIX = 'pendant '
 
 def write_default_config(config_file: TextIO) -> None:
   config = configparser.ConfigParser()
@@ -37,35 +78,219 @@ def write_default_config(config_file: TextIO) -> None:
   config[_SERVER_SECTION][_CNC_PORT_OPTION] = '/dev/ttyACM0'
   config[_SERVER_SECTION][_BAUDRATE_OPTION] = '115200'
   config[_SERVER_SECTION][_CONTROLLER_TYPE_OPTION] = 'Grbl'
+  config[_SERVER_SECTION][_MAX_IN_FLIGHT_OPTION] = '4'
+  config[_SERVER_SECTION][_MACRO_REFRESH_OPTION] = '60'
   config[_DEVICE_SECTION] = {}
   config[_DEVICE_SECTION][_GAMEPAD_OPTION] = 'PS3'
   config[_DEVICE_SECTION][_CNC_OPTION] = 'Shapeoko'
+  config[_DEVICE_SECTION][_REPEAT_INTERVAL_OPTION] = '0.1'
+  config[_DEVICE_SECTION][_READER_OPTION] = 'thread'
+  config[_DEVICE_SECTION][_JOG_MODE_OPTION] = 'step'
+  config[_DEVICE_SECTION][_MAX_JOG_DISTANCE_OPTION] = '10'
+  config[_DEVICE_SECTION][_RESPONSE_CURVE_OPTION] = 'steps'
+  config[_DEVICE_SECTION][_LATENCY_REPORT_OPTION] = '0'
+  config[_DEVICE_SECTION][_SMOOTHING_OPTION] = '0'
+  config[_DEVICE_SECTION][_RADIAL_DEADZONE_OPTION] = '0'
+  config[_DEVICE_SECTION][_COALESCE_AXES_OPTION] = 'yes'
+  config[_DEVICE_SECTION][_MOVED_CALLBACK_INTERVAL_OPTION] = '0.02'
+  config[_DEVICE_SECTION][_REALTIME_LANE_OPTION] = 'yes'
   config.write(config_file)
 
 
-def get_config(config_file: TextIO) -> ConfigObjects:
+def _get_response_curve(device: configparser.SectionProxy
+                        ) -> Optional[command_mapping.ResponseCurve]:
+  """Returns the response curve configured for the device, None for the default steps.
+
+  Piecewise curve points are written as "deflection:fraction" pairs separated by
+  commas, for instance "0:0, 0.5:0.1, 1:1"."""
+  shape = device.get(_RESPONSE_CURVE_OPTION, fallback='steps')
+  if shape == 'steps':
+    return None
+  try:
+    points = tuple(
+      tuple(float(number) for number in point.split(':'))
+      for point in device.get(_RESPONSE_CURVE_POINTS_OPTION, fallback='').split(',')
+      if point.strip())
+    return command_mapping.ResponseCurve(shape=shape, points=points)
+  except ValueError as e:
+    raise NoValidConfigError(f'Invalid response curve: {e}')
+
+
+def _get_envelope(device: configparser.SectionProxy,
+                  default: Optional[command_mapping.WorkEnvelope]
+                  ) -> Optional[command_mapping.WorkEnvelope]:
+  """Returns the work envelope used to limit jogs, None if jogs are not limited.
+
+  Jogs are only limited with "soft limits = yes". "travel min" and "travel max"
+  are machine positions written as "x, y, z", and replace the default envelope
+  of the gamepad and CNC machine mapping."""
+  try:
+    if not device.getboolean(_SOFT_LIMITS_OPTION, fallback=False):
+      return None
+    if _TRAVEL_MIN_OPTION not in device and _TRAVEL_MAX_OPTION not in device:
+      return default
+    minimum, maximum = (
+      tuple(float(value) for value in device[option].split(','))
+      for option in (_TRAVEL_MIN_OPTION, _TRAVEL_MAX_OPTION))
+    if len(minimum) != 3 or len(maximum) != 3:
+      raise ValueError('travel limits need x, y and z values')
+    return command_mapping.WorkEnvelope(minimum=minimum, maximum=maximum)
+  except (KeyError, ValueError) as e:
+    raise NoValidConfigError(f'Invalid soft limits: {e}')
+
+
+def _get_gamepad(name: str, device: configparser.SectionProxy,
+                 existing: Optional[gamepad.Gamepad]) -> gamepad.Gamepad:
+  """Returns a new gamepad for the device section, or existing when it matches it."""
+  try:
+    pad = gamepad.get_gamepad_by_name(device[_GAMEPAD_OPTION])
+  except KeyError:
+    raise NoValidConfigError(f'Unknown gamepad {device[_GAMEPAD_OPTION]}')
+  if _JOYSTICK_OPTION in device:
+    pad.joystick_path = pathlib.Path(device[_JOYSTICK_OPTION])
+  pad.joystick_api = device.get(_JOYSTICK_API_OPTION, fallback='joystick')
+  if pad.joystick_api not in gamepad.Gamepad.JOYSTICK_APIS:
+    raise NoValidConfigError(f'Unknown joystick api {pad.joystick_api}, '
+                             f'expected one of {gamepad.Gamepad.JOYSTICK_APIS}')
+  if pad.joystick_api == 'evdev' and _JOYSTICK_OPTION not in device:
+    raise NoValidConfigError(f'The evdev joystick api needs a {_JOYSTICK_OPTION} path, '
+                             'like /dev/input/by-id/...-event-joystick')
+  if existing is None:
+    return pad
+  if (pad.joystick_path != existing.joystick_path or pad.joystick_api != existing.joystick_api
+      or pad.button_names != existing.button_names or pad.axis_names != existing.axis_names):
+    raise NoValidConfigError(f'Changing the gamepad or joystick of pendant {name} needs a restart')
+  return existing
+
+
+def _build_config(name: str, server_section: configparser.SectionProxy,
+                  device: configparser.SectionProxy,
+                  existing: Optional[gamepad.Gamepad] = None) -> Optional[ConfigObjects]:
+  """Returns the config of one pendant, None if the sections do not define one.
+
+  The config uses the existing gamepad when given, which is not modified."""
+  if _GAMEPAD_OPTION not in device or _CNC_OPTION not in device:
+    return None
+  pad = _get_gamepad(name, device, existing)
+  try:
+    coalesce_axes = device.getboolean(_COALESCE_AXES_OPTION, fallback=False)
+    realtime_lane = device.getboolean(_REALTIME_LANE_OPTION, fallback=True)
+  except ValueError as e:
+    raise NoValidConfigError(f'Invalid boolean option: {e}')
+  try:
+    moved_callback_interval = device.getfloat(_MOVED_CALLBACK_INTERVAL_OPTION, fallback=0.02)
+  except ValueError as e:
+    raise NoValidConfigError(f'Invalid moved callback interval: {e}')
+  if moved_callback_interval < 0:
+    raise NoValidConfigError('The moved callback interval cannot be negative')
+  if existing is None:
+    pad.coalesce_axes = coalesce_axes
+    pad.moved_callback_interval = moved_callback_interval
+  # Mappings of the mapping file replace the bundled ones, which replace the
+  # built-in ones, see mapping_file.py
+  mapping_paths = []
+  if _MAPPING_FILE_OPTION in device:
+    mapping_paths.append(pathlib.Path(device[_MAPPING_FILE_OPTION]).expanduser().resolve())
+  if mapping_file.DEFAULT_MAPPING_FILE.exists():
+    mapping_paths.append(mapping_file.DEFAULT_MAPPING_FILE)
+  try:
+    mapping = mapping_file.find_mapping(device[_GAMEPAD_OPTION], device[_CNC_OPTION],
+                                        mapping_paths)
+  except mapping_file.InvalidMappingError as e:
+    raise NoValidConfigError(str(e))
+  commands = mapping.commands
+  curve = _get_response_curve(device)
+  if curve:
+    commands = command_mapping.with_response_curve(commands, curve)
+  try:
+    hysteresis = device.getfloat(_HYSTERESIS_OPTION, fallback=0)
+    smoothing = device.getfloat(_SMOOTHING_OPTION, fallback=0)
+    if hysteresis or smoothing:
+      commands = command_mapping.with_filters(commands, hysteresis, smoothing)
+    deadzones = command_mapping.get_deadzones(
+      mapping.sticks, device.getfloat(_RADIAL_DEADZONE_OPTION, fallback=0))
+  except ValueError as e:
+    raise NoValidConfigError(f'Invalid axis filters: {e}')
+  reader = device.get(_READER_OPTION, fallback='thread')
+  if reader not in _READERS:
+    raise NoValidConfigError(f'Unknown gamepad reader {reader}, expected one of {_READERS}')
+  jog_mode = device.get(_JOG_MODE_OPTION, fallback='step')
+  if jog_mode not in _JOG_MODES:
+    raise NoValidConfigError(f'Unknown jog mode {jog_mode}, expected one of {_JOG_MODES}')
+  if jog_mode == 'continuous' and server_section[_CONTROLLER_TYPE_OPTION] != 'Grbl':
+    raise NoValidConfigError('Continuous jog mode is only supported by Grbl controllers')
+  return ConfigObjects(
+    gamepad=pad, 
+    mapped_commands=commands,
+    dispatch=command_dispatch.DispatchTable(commands, pad, deadzones,
+                                            exclude_realtime=realtime_lane),
+    address=server_section[_ADDRESS_OPTION],
+    cnc_port=server_section[_CNC_PORT_OPTION],
+    baudrate=server_section.getint(_BAUDRATE_OPTION),
+    controller_type=server_section[_CONTROLLER_TYPE_OPTION],
+    repeat_interval=device.getfloat(_REPEAT_INTERVAL_OPTION, fallback=0.1),
+    reader=reader,
+    jog_mode=jog_mode,
+    max_in_flight=server_section.getint(_MAX_IN_FLIGHT_OPTION, fallback=4),
+    max_jog_distance=device.getfloat(_MAX_JOG_DISTANCE_OPTION, fallback=10),
+    macro_refresh=server_section.getfloat(_MACRO_REFRESH_OPTION, fallback=60),
+    latency_report=device.getfloat(_LATENCY_REPORT_OPTION, fallback=0),
+    name=name,
+    envelope=_get_envelope(device, mapping.envelope),
+    coalesce_axes=coalesce_axes,
+    moved_callback_interval=moved_callback_interval,
+    realtime_lane=realtime_lane)
+
+
+def get_configs(config_file: TextIO, gamepads: Optional[Mapping[str, gamepad.Gamepad]] = None
+                ) -> Tuple[ConfigObjects, ...]:
+  """Returns the config of every pendant defined in the config file.
+
+  Each "pendant NAME" section defines a pendant. Its options override the ones
+  of the server and device sections, so shared settings can be written once
+  and each pendant only sets its gamepad, joystick, CNC machine and port, and
+  its address when it uses another server. Without pendant sections the server
+  and device sections define a single pendant named "default".
+
+  gamepads are used by the pendants of the same name instead of new ones, to
+  reload the config of running pendants. Their gamepad and joystick must not
+  change.
+  """
+  gamepads = gamepads or {}
   config = configparser.ConfigParser()
   config.read_file(config_file)
-  
-  pad = None
-  commands = None
-
-  if _DEVICE_SECTION in config:
-    device = config[_DEVICE_SECTION]
-    if _GAMEPAD_OPTION in device:
-      pad = gamepad.get_gamepad_by_name(device[_GAMEPAD_OPTION])
-      if 'cnc machine' in device:
-        commands = command_mapping.get_mapping(
-          gamepad=device[_GAMEPAD_OPTION],
-          cnc=device[_CNC_OPTION])
-  if pad and commands and _SERVER_SECTION in config:
-    server_section = config[_SERVER_SECTION]
-    return ConfigObjects(
-      gamepad=pad, 
-      mapped_commands=commands,
-      address=server_section[_ADDRESS_OPTION],
-      cnc_port=server_section[_CNC_PORT_OPTION],
-      baudrate=server_section.getint(_BAUDRATE_OPTION),
-      controller_type=server_section[_CONTROLLER_TYPE_OPTION])
-
-  raise NoValidConfigError('No valid config found in the config file')
+
+  names = [section[len(_PENDANT_SECTION_PREFIX):] for section in config.sections()
+           if section.startswith(_PENDANT_SECTION_PREFIX)]
+  if not names:
+    if _SERVER_SECTION in config and _DEVICE_SECTION in config:
+      config_objects = _build_config(
+        'default', config[_SERVER_SECTION], config[_DEVICE_SECTION], gamepads.get('default'))
+      if config_objects:
+        return (config_objects,)
+    raise NoValidConfigError('No valid config found in the config file')
+
+  merged = configparser.ConfigParser()
+  configs = []
+  for name in names:
+    options = {}
+    for section in (_SERVER_SECTION, _DEVICE_SECTION, _PENDANT_SECTION_PREFIX + name):
+      if section in config:
+        options.update(config[section])
+    merged[name] = options
+    if not all(option in merged[name] for option in (
+        _ADDRESS_OPTION, _CNC_PORT_OPTION, _BAUDRATE_OPTION, _CONTROLLER_TYPE_OPTION)):
+      raise NoValidConfigError(f'Pendant {name} has no complete server settings')
+    config_objects = _build_config(name, merged[name], merged[name], gamepads.get(name))
+    if not config_objects:
+      raise NoValidConfigError(f'Pendant {name} needs a {_GAMEPAD_OPTION} and a {_CNC_OPTION}')
+    configs.append(config_objects)
+  joysticks = [config_objects.gamepad.joystick_path for config_objects in configs]
+  if len(set(joysticks)) != len(joysticks):
+    raise NoValidConfigError('Each pendant needs its own joystick')
+  return tuple(configs)
+
+
+def get_config(config_file: TextIO) -> ConfigObjects:
+  """Returns the config of the first pendant defined in the config file."""
+  return get_configs(config_file)[0]
@@ -0,0 +1,109 @@
+"""Live reload of the config file of running pendants.
+
+The config file is polled for changes, as the standard library has no file
+notifications, and reloaded on SIGHUP too. A changed file is parsed in a
+thread, reusing the gamepads of the running pendants, and the new configs are
+swapped in on the event loop, so pendants see them on their next tick. The
+server connections and the gamepads stay open.
+
+Settings used to open the connections, ports and gamepads only apply after a
+restart. A config changing them, or one that does not parse, is rejected and
+the last good one is kept.
+"""
+
+import asyncio
+import configparser
+import logging
+import os
+import pathlib
+import time
+
+from typing import Dict, Optional, Sequence, Tuple
+
+import config_manager
+
+
+_logger = logging.getLogger('cncjs-py-pendant')
+
+# Settings read once, when the pendants connect and open their ports
+_RESTART_FIELDS = ('address', 'cnc_port', 'baudrate', 'controller_type', 'reader',
+                   'max_in_flight', 'macro_refresh', 'latency_report', 'realtime_lane')
+
+
+def _file_version(path: pathlib.Path) -> Optional[Tuple[int, int, int]]:
+  """Returns what tells whether path changed, None if it cannot be read."""
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return None
+  return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+class ConfigWatcher:
+  """Reloads the config file of running pendants when it changes.
+
+  Attributes:
+    path: config file.
+    configs: current config of each pendant, by name. Replaced as a whole
+      when the config is reloaded, so pendants read it once per tick.
+    interval: seconds between checks of the config file.
+  """
+
+  def __init__(self, path: pathlib.Path, configs: Sequence[config_manager.ConfigObjects],
+               interval: float = 1.0):
+    self.path = path
+    self.configs: Dict[str, config_manager.ConfigObjects] = {
+      config.name: config for config in configs}
+    self.interval = interval
+    self._version = _file_version(path)
+    self._lock = asyncio.Lock()
+
+  def _load(self) -> Tuple[config_manager.ConfigObjects, ...]:
+    gamepads = {name: config.gamepad for name, config in self.configs.items()}
+    with self.path.open('r') as config_file:
+      return config_manager.get_configs(config_file, gamepads)
+
+  def _check(self, configs: Sequence[config_manager.ConfigObjects]) -> Optional[str]:
+    """Returns why configs cannot replace the current ones, None if they can."""
+    names = {config.name for config in configs}
+    if names != set(self.configs):
+      return 'adding or removing pendants needs a restart'
+    for config in configs:
+      current = self.configs[config.name]
+      for field in _RESTART_FIELDS:
+        if getattr(config, field) != getattr(current, field):
+          return f'changing the {field} of pendant {config.name} needs a restart'
+    return None
+
+  def _swap(self, configs: Sequence[config_manager.ConfigObjects]) -> None:
+    for config in configs:
+      config.dispatch.take_over(self.configs[config.name].dispatch)
+      config.gamepad.coalesce_axes = config.coalesce_axes
+      config.gamepad.moved_callback_interval = config.moved_callback_interval
+    self.configs = {config.name: config for config in configs}
+
+  async def reload(self) -> bool:
+    """Reloads the config file, returning whether the new config was applied."""
+    async with self._lock:
+      self._version = _file_version(self.path)
+      start = time.perf_counter()
+      try:
+        configs = await asyncio.get_event_loop().run_in_executor(None, self._load)
+      except (config_manager.NoValidConfigError, configparser.Error, KeyError,
+              ValueError, OSError) as e:
+        _logger.error(f'Keeping the last good config, {self.path} is not valid: {e}')
+        return False
+      problem = self._check(configs)
+      if problem:
+        _logger.error(f'Keeping the last good config, {problem}')
+        return False
+      self._swap(configs)
+      _logger.info(f'Reloaded config in {(time.perf_counter() - start) * 1e3:.1f} ms')
+      return True
+
+  async def watch(self) -> None:
+    """Reloads the config file whenever it changes, until cancelled."""
+    while True:
+      await asyncio.sleep(self.interval)
+      if _file_version(self.path) != self._version:
+        await self.reload()
@@ -0,0 +1,248 @@
+"""Reading gamepads through the Linux event interface, /dev/input/event*.
+
+The joystick API (/dev/input/js*) reports every button and axis change on its
+own with millisecond timestamps, so a stick moved in a diagonal can be read
+with only one of its axes updated. The event interface groups the changes
+reported together by the device into frames ended by SYN_REPORT, timestamped
+in microseconds.
+
+EvdevDevice turns whole frames into the js events used by gamepad.Gamepad,
+numbering buttons and axes and scaling axis values the way the joydev driver
+does, so gamepad mappings work unchanged with either interface. The changes of
+a frame are always returned together, and a frame split across reads is kept
+until its SYN_REPORT arrives.
+
+js events carry millisecond timestamps, so Gamepad.last_timestamp and
+recordings are the same with either interface. The microsecond kernel time of
+each read is kept in EvdevDevice.frame_time, which the read latency uses.
+"""
+
+import fcntl
+import struct
+import time
+
+from typing import Dict, List, Optional, Tuple
+
+
+# struct input_event from linux/input.h: struct timeval time, __u16 type, __u16 code, __s32 value
+EVENT_STRUCT = struct.Struct('llHHi')
+EVENT_SIZE = EVENT_STRUCT.size
+# struct input_absinfo: value, minimum, maximum, fuzz, flat, resolution
+_ABSINFO_STRUCT = struct.Struct('6i')
+
+_EV_SYN = 0x00
+_EV_KEY = 0x01
+_EV_ABS = 0x03
+_SYN_REPORT = 0
+_SYN_DROPPED = 3
+# Key value of autorepeat events, which are not button changes
+_KEY_REPEAT = 2
+_BTN_MISC = 0x100
+_BTN_JOYSTICK = 0x120
+_KEY_MAX = 0x2ff
+_ABS_MAX = 0x3f
+
+# js events from linux/joystick.h, as returned by EvdevDevice
+_JS_EVENT_BUTTON = 0x01
+_JS_EVENT_AXIS = 0x02
+_JS_EVENT_INIT = 0x80
+_JS_MAX_AXIS = 32767
+# js event numbers are a __u8
+_JS_MAX_NUMBER = 255
+
+# ioctl numbers from linux/input.h, with the generic _IOC encoding
+_IOC_WRITE = 1
+_IOC_READ = 2
+# Numbers of EVIOCGBIT(event type) and EVIOCGKEY, whose size is the buffer length
+_EVIOCGBIT = 0x20
+_EVIOCGKEY = 0x18
+
+
+def _ioc(direction: int, number: int, size: int) -> int:
+  return direction << 30 | size << 16 | ord('E') << 8 | number
+
+
+def _eviocgabs(code: int) -> int:
+  return _ioc(_IOC_READ, 0x40 + code, _ABSINFO_STRUCT.size)
+
+
+_EVIOCSCLOCKID = _ioc(_IOC_WRITE, 0xa0, struct.calcsize('i'))
+
+# js event: timestamp (ms), value, type, number
+Event = Tuple[int, int, int, int]
+
+
+def _bits(fd: int, number: int, count: int) -> bytes:
+  """Returns the bitmask read by ioctl number, count bits long."""
+  buffer = bytearray((count + 7) // 8)
+  fcntl.ioctl(fd, _ioc(_IOC_READ, number, len(buffer)), buffer)
+  return bytes(buffer)
+
+
+def _has_bit(bits: bytes, bit: int) -> bool:
+  return bool(bits[bit // 8] & (1 << bit % 8))
+
+
+class Axis:
+  """Scales the values of an absolute axis to the js range, like joydev does.
+
+  Values within flat of the center of the range read as 0."""
+  __slots__ = ('number', 'center', 'flat', 'scale')
+
+  def __init__(self, number: int, minimum: int, maximum: int, flat: int = 0):
+    self.number = number
+    self.center = (minimum + maximum) / 2
+    half = (maximum - minimum) / 2
+    self.flat = flat if 0 < flat < half else 0
+    self.scale = _JS_MAX_AXIS / (half - self.flat) if half > self.flat else 0.0
+
+  def js_value(self, value: int) -> int:
+    offset = value - self.center
+    if abs(offset) <= self.flat:
+      return 0
+    offset += -self.flat if offset > 0 else self.flat
+    return max(-_JS_MAX_AXIS, min(_JS_MAX_AXIS, round(offset * self.scale)))
+
+
+def _absinfo(fd: int, code: int) -> Tuple[int, ...]:
+  buffer = bytearray(_ABSINFO_STRUCT.size)
+  fcntl.ioctl(fd, _eviocgabs(code), buffer)
+  return _ABSINFO_STRUCT.unpack(buffer)
+
+
+class EvdevDevice:
+  """Buttons and axes of an opened event device, decoding its events into js events.
+
+  Attributes:
+    buttons: js button number of each key code.
+    axes: js axis of each absolute axis code.
+    monotonic: whether event timestamps use CLOCK_MONOTONIC, otherwise they use
+      the wall clock.
+    frame_time: kernel time of the first frame returned by the last decode, in
+      seconds with microsecond resolution. None if it returned no frame.
+  """
+
+  def __init__(self, fd: int, buttons: Dict[int, int], axes: Dict[int, Axis],
+               monotonic: bool = True):
+    self.fd = fd
+    self.buttons = buttons
+    self.axes = axes
+    self.monotonic = monotonic
+    self.frame_time: Optional[float] = None
+    # Last value returned for each button and axis number, to resynchronize
+    # after the kernel dropped events.
+    self._buttons_sent: Dict[int, int] = {}
+    self._axes_sent: Dict[int, int] = {}
+    self._dropped = False
+
+  def _now(self) -> int:
+    clock = time.clock_gettime(time.CLOCK_MONOTONIC) if self.monotonic else time.time()
+    return int(clock * 1000) & 0xffffffff
+
+  def _current_values(self) -> Tuple[Dict[int, int], Dict[int, int]]:
+    """Returns the current js value of every button and axis, read from the device."""
+    key_bits = _bits(self.fd, _EVIOCGKEY, _KEY_MAX + 1)
+    buttons = {number: int(_has_bit(key_bits, code)) for code, number in self.buttons.items()}
+    axes = {axis.number: axis.js_value(_absinfo(self.fd, code)[0])
+            for code, axis in self.axes.items()}
+    return buttons, axes
+
+  def initial_events(self) -> List[Event]:
+    """Returns init events with the current state of the device, as joydev sends on open."""
+    timestamp = self._now()
+    self._buttons_sent, self._axes_sent = self._current_values()
+    self._dropped = False
+    return ([(timestamp, value, _JS_EVENT_BUTTON | _JS_EVENT_INIT, number)
+             for number, value in self._buttons_sent.items()]
+            + [(timestamp, value, _JS_EVENT_AXIS | _JS_EVENT_INIT, number)
+               for number, value in self._axes_sent.items()])
+
+  def _resync_events(self) -> List[Event]:
+    """Returns events for every input that changed while events were dropped."""
+    timestamp = self._now()
+    buttons, axes = self._current_values()
+    events = [(timestamp, value, _JS_EVENT_BUTTON, number) for number, value in buttons.items()
+              if value != self._buttons_sent.get(number, 0)]
+    events += [(timestamp, value, _JS_EVENT_AXIS, number) for number, value in axes.items()
+               if value != self._axes_sent.get(number, 0)]
+    self._buttons_sent, self._axes_sent = buttons, axes
+    return events
+
+  def _take(self, frame: List[Event], events: List[Event]) -> None:
+    """Adds the events of a whole frame to events."""
+    for _, value, event_type, number in frame:
+      if event_type == _JS_EVENT_BUTTON:
+        self._buttons_sent[number] = value
+      else:
+        self._axes_sent[number] = value
+    events.extend(frame)
+
+  def decode(self, data: memoryview, flush: bool = False) -> Tuple[List[Event], int]:
+    """Returns the js events of the whole frames at the start of data, and their size in bytes.
+
+    Bytes after the last SYN_REPORT belong to a frame not read completely yet,
+    unless flush is set, which returns the events of that frame too. After
+    SYN_DROPPED, events up to the next SYN_REPORT are discarded and the state
+    is read again from the device, as the kernel documentation advises."""
+    events: List[Event] = []
+    frame: List[Event] = []
+    consumed = 0
+    self.frame_time = None
+    buttons = self.buttons
+    axes = self.axes
+    whole = len(data) - len(data) % EVENT_SIZE
+    for position, (seconds, microseconds, event_type, code, value) in enumerate(
+        EVENT_STRUCT.iter_unpack(data[:whole])):
+      if event_type == _EV_KEY:
+        number = buttons.get(code)
+        if number is not None and value != _KEY_REPEAT:
+          frame.append(((seconds * 1000 + microseconds // 1000) & 0xffffffff,
+                        value, _JS_EVENT_BUTTON, number))
+      elif event_type == _EV_ABS:
+        axis = axes.get(code)
+        if axis is not None:
+          frame.append(((seconds * 1000 + microseconds // 1000) & 0xffffffff,
+                        axis.js_value(value), _JS_EVENT_AXIS, axis.number))
+      elif event_type == _EV_SYN:
+        if code == _SYN_REPORT:
+          consumed = (position + 1) * EVENT_SIZE
+          if self._dropped:
+            self._dropped = False
+            events.extend(self._resync_events())
+          elif frame:
+            if self.frame_time is None:
+              self.frame_time = seconds + microseconds / 1e6
+            self._take(frame, events)
+          frame = []
+        elif code == _SYN_DROPPED:
+          self._dropped = True
+          frame = []
+    if flush:
+      consumed = whole
+      if not self._dropped:
+        self._take(frame, events)
+    return events, consumed
+
+
+def open_device(fd: int) -> EvdevDevice:
+  """Returns the EvdevDevice of an opened event device, numbering its inputs like joydev.
+
+  Event timestamps are switched to CLOCK_MONOTONIC when the kernel allows it.
+  Throws an OSError if fd is not an event device."""
+  key_bits = _bits(fd, _EVIOCGBIT + _EV_KEY, _KEY_MAX + 1)
+  abs_bits = _bits(fd, _EVIOCGBIT + _EV_ABS, _ABS_MAX + 1)
+  # joydev numbers the joystick buttons first, then the miscellaneous ones
+  codes = [code for code in range(_BTN_JOYSTICK, _KEY_MAX + 1) if _has_bit(key_bits, code)]
+  codes += [code for code in range(_BTN_MISC, _BTN_JOYSTICK) if _has_bit(key_bits, code)]
+  buttons = {code: number for number, code in enumerate(codes[:_JS_MAX_NUMBER + 1])}
+  axes: Dict[int, Axis] = {}
+  for code in range(_ABS_MAX + 1):
+    if _has_bit(abs_bits, code):
+      _, minimum, maximum, _, flat, _ = _absinfo(fd, code)
+      axes[code] = Axis(len(axes), minimum, maximum, flat)
+  try:
+    fcntl.ioctl(fd, _EVIOCSCLOCKID, struct.pack('i', time.CLOCK_MONOTONIC))
+    monotonic = True
+  except OSError:
+    monotonic = False
+  return EvdevDevice(fd, buttons, axes, monotonic)
@@ -4,20 +4,70 @@
 This module is designed to read inputs from a gamepad or joystick. 
 """
 
+import array
 import asyncio
+import collections
 import inspect
 import logging
 import os
 import pathlib
+import select
 import struct
 import sys
 import threading
 import time
-from typing import Any, Callable, Dict, Optional
+from typing import Any, Callable, Deque, Dict, FrozenSet, List, Optional, Tuple
 
+import evdev_input
 
 _logger = logging.getLogger('cncjs-py-pendant')
 
+# Button and axis numbers are a __u8 in struct js_event
+INPUT_COUNT = 256
+
+
+class GamepadState:
+  """State of a gamepad at one point in time, indexed by button and axis number.
+
+  The reader builds a new state from a copy of the last one for every batch of
+  events and publishes it with a single assignment, so a published state never
+  changes and gives a consistent view without locks, see Gamepad.snapshot.
+
+  Attributes:
+    generation: incremented for every published state.
+    pressed: 1 for each pressed button, 0 otherwise.
+    presses: number of presses of each button so far. Consumers remember the
+    counts they saw, to tell which buttons were pressed since without writing
+    to the state.
+    releases: number of releases of each button so far.
+    axes: value of each axis, between -1.0 and +1.0.
+    known_buttons: numbers of the buttons reported by the driver.
+    known_axes: numbers of the axes reported by the driver.
+  """
+  __slots__ = ('generation', 'pressed', 'presses', 'releases', 'axes',
+               'known_buttons', 'known_axes')
+
+  def __init__(self):
+    self.generation = 0
+    self.pressed = bytearray(INPUT_COUNT)
+    self.presses = array.array('L', (0,)) * INPUT_COUNT
+    self.releases = array.array('L', (0,)) * INPUT_COUNT
+    self.axes = array.array('d', (0.0,)) * INPUT_COUNT
+    self.known_buttons: FrozenSet[int] = frozenset()
+    self.known_axes: FrozenSet[int] = frozenset()
+
+  def copy(self) -> 'GamepadState':
+    state = GamepadState.__new__(GamepadState)
+    state.generation = self.generation
+    state.pressed = self.pressed[:]
+    state.presses = self.presses[:]
+    state.releases = self.releases[:]
+    state.axes = self.axes[:]
+    state.known_buttons = self.known_buttons
+    state.known_axes = self.known_axes
+    return state
+
+
 class Gamepad:
   EVENT_CODE_BUTTON = 0x01
   EVENT_CODE_AXIS = 0x02
@@ -25,8 +75,18 @@ class Gamepad:
   EVENT_CODE_INIT_AXIS = 0x80 | EVENT_CODE_AXIS
   MIN_AXIS = -32767.0
   MAX_AXIS = +32767.0
+  # struct js_event from linux/joystick.h: __u32 time, __s16 value, __u8 type, __u8 number
+  EVENT_FORMAT = 'IhBB'
+  # Maximum number of events drained by a single read
+  EVENT_BATCH = 64
   EVENT_BUTTON = 'BUTTON'
   EVENT_AXIS = 'AXIS'
+  # Kernel interfaces the gamepad can be read from: /dev/input/js* or /dev/input/event*
+  JOYSTICK_APIS = ('joystick', 'evdev')
+  # Seconds between checks for a disconnected joystick coming back
+  RECONNECT_INTERVAL = 0.2
+  # Seconds between checks of is_ready by the blocking ready waits
+  READY_POLL_INTERVAL = 0.05
 
   class UpdateThread(threading.Thread):
     """Thread used to continually run the updateState function on a Gamepad in the background
@@ -47,6 +107,11 @@ class Gamepad:
         while self.running:
           self.gamepad.update_state()
         self.gamepad = None
+      except IOError as e:
+        _logger.error(str(e))
+        self.running = False
+        gamepad, self.gamepad = self.gamepad, None
+        gamepad._handle_disconnect()
       except:
         self.running = False
         self.gamepad = None
@@ -57,22 +122,60 @@ class Gamepad:
          button_names: Optional[Dict[int, str]] = None,
          axis_names: Optional[Dict[int, str]] = None):
     self.joystick_path = joystick_path
-    self.event_size = struct.calcsize('LhBB')
-    self.pressed_map: Dict[int, bool] = {}
-    self.was_pressed_map: Dict[int, bool] = {}
-    self.was_released_map: Dict[int, bool] = {}
-    self.axis_map: Dict[int, Callable[[], None]] = {}
+    # Interface of joystick_path, one of JOYSTICK_APIS. With evdev, the changes
+    # reported together by the device are always applied together.
+    self.joystick_api = 'joystick'
+    self._evdev: Optional[evdev_input.EvdevDevice] = None
+    # Events decoded but not returned yet by _get_next_event_raw, with evdev
+    self._next_events: Deque[Tuple[int, int, int, int]] = collections.deque()
+    self.event_size = struct.calcsize(Gamepad.EVENT_FORMAT)
+    self._event_struct = struct.Struct(Gamepad.EVENT_FORMAT)
+    self._read_buffer = bytearray(self.event_size * Gamepad.EVENT_BATCH)
+    self._read_view = memoryview(self._read_buffer)
+    self._read_pending = 0
+    # Last published state, replaced as a whole by the reader, see snapshot
+    self._state = GamepadState()
+    # Press and release counts seen by been_pressed and been_released
+    self._presses_seen = array.array('L', (0,)) * INPUT_COUNT
+    self._releases_seen = array.array('L', (0,)) * INPUT_COUNT
     self.button_names = button_names or {}
     self.button_index: Dict[int, str] = {}
     self.axis_names = axis_names or {}
     self.axis_index: Dict[int, str] = {}
     self.last_timestamp = 0
+    # time.perf_counter when the last batch of events was read, or with evdev
+    # when the kernel timestamped its first frame; and when it was applied.
+    self.last_read_time = 0.0
+    self.last_update_time = 0.0
     self.update_thread: Optional[Any] = None
+    # When set, every raw event read is also written to it, see recording.Recorder
+    self.recorder: Optional[Any] = None
     self.connected = True
+    # Whether to wait for the joystick to come back after it disconnects
+    self.auto_reconnect = True
+    # Called on the event loop thread when the joystick disconnects
+    self.disconnected_callbacks: List[Callable[[], None]] = []
+    self._reader_mode: Optional[str] = None
+    self._reconnect_task: Optional[asyncio.Future] = None
     self.pressed_event_map: Dict[int, Callable[[], None]] = {}
     self.released_event_map: Dict[int, Callable[[], None]] = {}
     self.changed_event_map: Dict[int, Callable[[], None]] = {}
     self.moved_event_map: Dict[int, Callable[[], None]] = {}
+    # When set, axis events read together only apply their latest value per
+    # axis, see _apply_coalesced. Button edges are still applied one by one.
+    self.coalesce_axes = False
+    # Minimum seconds between two runs of the moved callbacks of an axis. Values
+    # in between are held back, across reads, and only the latest one is delivered.
+    self.moved_callback_interval = 0.0
+    # Raw events applied to the state since the gamepad was created
+    self.events_applied = 0
+    self._moved_pending: Dict[int, float] = {}
+    self._moved_at: Dict[int, float] = {}
+    self._moved_timer: Optional[asyncio.TimerHandle] = None
+    self._loop: Optional[asyncio.AbstractEventLoop] = None
+    self._loop_thread_id: Optional[int] = None
+    self._updated: Optional[asyncio.Event] = None
+    self._reader_fd: Optional[int] = None
     self._setup_reverse_maps()
 
   def __del__(self):
@@ -81,14 +184,48 @@ class Gamepad:
     except AttributeError:
       pass
 
-  async def open(self):
+  async def open(self, retry_interval: float = 0.05, max_retry_interval: float = 1.0):
+    """Opens the joystick, waiting for it to be available.
+
+    Retries start after retry_interval seconds and back off up to
+    max_retry_interval, so a joystick that shows up right after boot is opened
+    quickly without polling a missing one too often."""
     _logger.info(f'Attempting to open joystick {self.joystick_path}')
-    while not self.joystick_path.exists():
-      _logger.info(f'Joystick {self.joystick_path} not found, retrying in 1 second')
-      await asyncio.sleep(1.0)
-    self.joystick_file = self.joystick_path.open()
+    while True:
+      try:
+        self.joystick_file = self.joystick_path.open('rb', buffering=0)
+        break
+      except OSError as e:
+        # Also covers device nodes that exist but are not accessible yet
+        _logger.info(f'Joystick {self.joystick_path} not available ({e.strerror}), '
+                     f'retrying in {retry_interval} seconds')
+        await asyncio.sleep(retry_interval)
+        retry_interval = min(retry_interval * 2, max(retry_interval, max_retry_interval))
+    self._read_pending = 0
+    if self.joystick_api == 'evdev':
+      self._open_evdev()
     _logger.info(f'Opened joystick {self.joystick_path}')
 
+  def _open_evdev(self, device: Optional[evdev_input.EvdevDevice] = None):
+    """Reads the buttons and axes of the opened event device and applies its state.
+
+    device replaces the one read from joystick_file, for the benchmarks."""
+    try:
+      self._evdev = device or evdev_input.open_device(self.joystick_file.fileno())
+    except OSError as e:
+      self.joystick_file.close()
+      raise IOError(f'{self.joystick_path} is not an event device: {e}')
+    if len(self._read_buffer) != evdev_input.EVENT_SIZE * Gamepad.EVENT_BATCH:
+      self._read_buffer = bytearray(evdev_input.EVENT_SIZE * Gamepad.EVENT_BATCH)
+      self._read_view = memoryview(self._read_buffer)
+    self._next_events.clear()
+    # The event interface has no init events, the current state is read instead
+    events = self._evdev.initial_events()
+    if self.recorder is not None:
+      self.recorder.write(b''.join(self._event_struct.pack(*event) for event in events))
+    self._apply_events(events)
+    self._notify_updated()
+
   def _setup_reverse_maps(self):
     for index in self.button_names:
       self.button_index[self.button_names[index]] = index
@@ -101,20 +238,69 @@ class Gamepad:
     The return format is:
       timestamp (ms), value, event type code, axis / button number
     Throws an IOError if the gamepad is disconnected"""
+    if self._evdev is not None:
+      while not self._next_events:
+        self._next_events.extend(self._read_events_raw())
+      return self._next_events.popleft()
     if self.connected:
       try:
         raw_event = self.joystick_file.read(self.event_size)
       except IOError as e:
         self.connected = False
         raise IOError(f'Gamepad {self.joystick_path} disconnected', e)
-      if raw_event is None:
+      if not raw_event:
         self.connected = False
         raise IOError(f'Gamepad {self.joystick_path} disconnected')
       else:
-        return struct.unpack('LhBB', raw_event)
+        return struct.unpack(Gamepad.EVENT_FORMAT, raw_event)
     else:
       raise IOError('Gamepad has been disconnected')
 
+  def _read_events_raw(self):
+    """Returns every pending raw event from the gamepad using a single read.
+
+    Events are returned as a list of tuples in the _get_next_event_raw format.
+    In blocking mode this waits for at least one event, in non-blocking mode an
+    empty list is returned when nothing is pending.
+    Throws an IOError if the gamepad is disconnected"""
+    if not self.connected:
+      raise IOError('Gamepad has been disconnected')
+    try:
+      count = self.joystick_file.readinto(self._read_view[self._read_pending:])
+    except IOError as e:
+      self.connected = False
+      raise IOError(f'Gamepad {self.joystick_path} disconnected', e)
+    if count is None:
+      return []
+    if not count:
+      self.connected = False
+      raise IOError(f'Gamepad {self.joystick_path} disconnected')
+    self.last_read_time = time.perf_counter()
+    available = self._read_pending + count
+    if self._evdev is not None:
+      events, complete = self._evdev.decode(self._read_view[:available])
+      if not complete and available == len(self._read_buffer):
+        # A frame larger than the buffer, apply what was read of it
+        _logger.warning(f'Event frame of {self.joystick_path} too large, splitting it')
+        events, complete = self._evdev.decode(self._read_view[:available], flush=True)
+      if self._evdev.frame_time is not None and self._evdev.monotonic:
+        # Measured from the kernel timestamp, which uses the monotonic clock
+        age = time.clock_gettime(time.CLOCK_MONOTONIC) - self._evdev.frame_time
+        self.last_read_time -= max(age, 0.0)
+      if self.recorder is not None and events:
+        self.recorder.write(b''.join(self._event_struct.pack(*event) for event in events))
+    else:
+      complete = available - available % self.event_size
+      events = list(self._event_struct.iter_unpack(self._read_view[:complete]))
+      if self.recorder is not None:
+        self.recorder.write(bytes(self._read_view[:complete]))
+    # Keep any trailing partial event for the next read. The joystick driver only
+    # returns whole events, but pipes and pseudo terminals may split them.
+    self._read_pending = available - complete
+    if self._read_pending:
+      self._read_buffer[:self._read_pending] = self._read_buffer[complete:available]
+    return events
+
   def get_next_event(self, skip_init=True):
     """Returns the next event from the gamepad.
 
@@ -130,129 +316,321 @@ class Gamepad:
     After each call the internal state used by get_pressed and get_axis is updated.
 
     Throws an IOError if the gamepad is disconnected"""
-    self.last_timestamp, value, event_type, index = self._get_next_event_raw()
-    skip = False
-    event_name = None
-    entity_name = None
-    final_value = None
-    if event_type == Gamepad.EVENT_CODE_BUTTON:
-      event_name = Gamepad.EVENT_BUTTON
-      if index in self.button_names:
-        entity_name = self.button_names[index]
+    while True:
+      event = self._get_next_event_raw()
+      self._apply_events((event,))
+      _, value, event_type, index = event
+      if skip_init and event_type & 0x80:
+        continue
+      if event_type & ~0x80 == Gamepad.EVENT_CODE_BUTTON:
+        return Gamepad.EVENT_BUTTON, self.button_names.get(index, index), value != 0
+      if event_type & ~0x80 == Gamepad.EVENT_CODE_AXIS:
+        return Gamepad.EVENT_AXIS, self.axis_names.get(index, index), value / Gamepad.MAX_AXIS
+
+  def update_state(self):
+    """Updates the internal button and axis states with all pending events.
+
+    This call waits for a new event if there are not any waiting to be processed.
+    The whole batch is applied before any waiter is woken up. While moved
+    callbacks are held back, the wait ends when they are due, to run them."""
+    if self._moved_pending:
+      due = self._run_moved_callbacks()
+      if due is not None and not select.select((self.joystick_file,), (), (), due)[0]:
+        self._run_moved_callbacks()
+        return
+    self._apply_events(self._read_events_raw())
+    self._notify_updated()
+
+  def snapshot(self) -> GamepadState:
+    """Returns the current state of the gamepad, in O(1).
+
+    The returned state never changes, read it once per tick to get a consistent
+    view of every button and axis. Safe to call from any thread."""
+    return self._state
+
+  @property
+  def generation(self) -> int:
+    """Incremented every time a batch of events changes the state."""
+    return self._state.generation
+
+  @property
+  def pressed_map(self) -> Dict[int, bool]:
+    """Whether each known button is pressed, as a new dict."""
+    state = self._state
+    return {index: bool(state.pressed[index]) for index in state.known_buttons}
+
+  @property
+  def axis_map(self) -> Dict[int, float]:
+    """Value of each known axis, as a new dict."""
+    state = self._state
+    return {index: state.axes[index] for index in state.known_axes}
+
+  def _apply_events(self, events):
+    """Applies a batch of raw events and publishes the resulting state.
+
+    Events are applied to a copy of the current state, which replaces it once
+    the whole batch is applied. Callbacks run after that, so they see the state
+    of the batch. Only one thread may apply events at a time."""
+    if not events:
+      return
+    self.events_applied += len(events)
+    state = self._state.copy()
+    state.generation += 1
+    fired: List[Tuple[List[Callable], tuple]] = []
+    if self.coalesce_axes:
+      self._apply_coalesced(state, events, fired)
+    else:
+      for event in events:
+        self._apply_event(state, fired, *event)
+    self._state = state
+    self.last_update_time = time.perf_counter()
+    for callbacks, arguments in fired:
+      for callback in callbacks:
+        callback(*arguments)
+    if self._moved_pending:
+      if self._reader_mode == 'thread':
+        self._run_moved_callbacks()
       else:
-        entity_name = index
-      if value == 0:
-        final_value = False
-        self.was_released_map[index] = True
-        for callback in self.released_event_map[index]:
-          callback()
+        self._schedule_moved_callbacks()
+
+  def _apply_coalesced(self, state: GamepadState, events, fired):
+    """Applies a batch of raw events to state, keeping only the latest value of each axis.
+
+    Button events are applied in order, so every press and release is counted
+    and reaches the button callbacks exactly once."""
+    axes: Dict[int, int] = {}
+    for event in events:
+      event_type = event[2]
+      if event_type == Gamepad.EVENT_CODE_AXIS:
+        axes[event[3]] = event[1]
+        self.last_timestamp = event[0]
       else:
-        final_value = True
-        self.was_pressed_map[index] = True
-        for callback in self.pressed_event_map[index]:
-          callback()
-      self.pressed_map[index] = final_value
-      for callback in self.changed_event_map[index]:
-        callback(final_value)
-    elif event_type == Gamepad.EVENT_CODE_AXIS:
-      event_name = Gamepad.EVENT_AXIS
-      if index in self.axis_names:
-        entity_name = self.axis_names[index]
+        if event_type == Gamepad.EVENT_CODE_INIT_AXIS:
+          # The init value replaces the moves read before it
+          axes.pop(event[3], None)
+        self._apply_event(state, fired, *event)
+    state_axes = state.axes
+    for index, value in axes.items():
+      state_axes[index] = final_value = value / Gamepad.MAX_AXIS
+      callbacks = self.moved_event_map.get(index)
+      if not callbacks:
+        continue
+      if self.moved_callback_interval:
+        self._moved_pending[index] = final_value
       else:
-        entity_name = index
-      final_value = value / Gamepad.MAX_AXIS
-      self.axis_map[index] = final_value
+        fired.append((callbacks, (final_value,)))
+
+  def _run_moved_callbacks(self) -> Optional[float]:
+    """Runs the moved callbacks held back for the axes that are due.
+
+    Returns the seconds until the next held back axis is due, None if none is."""
+    now = time.perf_counter()
+    interval = self.moved_callback_interval
+    due = None
+    for index, value in list(self._moved_pending.items()):
+      wait = self._moved_at.get(index, -interval) + interval - now
+      if wait > 0:
+        due = wait if due is None else min(due, wait)
+        continue
+      del self._moved_pending[index]
+      self._moved_at[index] = now
       for callback in self.moved_event_map[index]:
-        callback(final_value)
-    elif event_type == Gamepad.EVENT_CODE_INIT_BUTTON:
-      event_name = Gamepad.EVENT_BUTTON
-      if index in self.button_names:
-        entity_name = self.button_names[index]
-      else:
-        entity_name = index
-      if value == 0:
-        final_value = False
-      else:
-        final_value = True
-      self.pressed_map[index] = final_value
-      self.was_pressed_map[index] = False
-      self.was_released_map[index] = False
-      self.pressed_event_map[index] = []
-      self.released_event_map[index] = []
-      self.changed_event_map[index] = []
-      skip = skip_init
-    elif event_type == Gamepad.EVENT_CODE_INIT_AXIS:
-      event_name = Gamepad.EVENT_AXIS
-      if index in self.axis_names:
-        entity_name = self.axis_names[index]
-      else:
-        entity_name = index
-      final_value = value / Gamepad.MAX_AXIS
-      self.axis_map[index] = final_value
-      self.moved_event_map[index] = []
-      skip = skip_init
-    else:
-      skip = True
-
-    if skip:
-      return self.get_next_event()
-    else:
-      return event_name, entity_name, final_value
-
-  def update_state(self):
-    """Updates the internal button and axis states with the next pending event.
-
-    This call waits for a new event if there are not any waiting to be processed."""
-    self.last_timestamp, value, event_type, index = self._get_next_event_raw()
+        callback(value)
+    return due
+
+  def _schedule_moved_callbacks(self):
+    """Runs the held back moved callbacks from the loop once they are due.
+
+    Used by the asyncio reader and replays, the update thread waits for them
+    in update_state."""
+    if self._loop is None or self._moved_timer is not None or not self._moved_pending:
+      return
+
+    def run():
+      self._moved_timer = None
+      if self._run_moved_callbacks() is not None:
+        self._schedule_moved_callbacks()
+    due = self._run_moved_callbacks()
+    if due is not None:
+      self._moved_timer = self._loop.call_later(due, run)
+
+  def _apply_event(self, state: GamepadState, fired, timestamp, value, event_type, index):
+    """Applies a single raw event to state, adding the callbacks it fires to fired."""
+    self.last_timestamp = timestamp
     if event_type == Gamepad.EVENT_CODE_BUTTON:
-      if value == 0:
-        final_value = False
-        self.was_released_map[index] = True
-        for callback in self.released_event_map[index]:
-          callback()
+      final_value = value != 0
+      state.pressed[index] = final_value
+      if final_value:
+        state.presses[index] += 1
+        callbacks = self.pressed_event_map.get(index)
       else:
-        final_value = True
-        self.was_pressed_map[index] = True
-        for callback in self.pressed_event_map[index]:
-          callback()
-      self.pressed_map[index] = final_value
-      for callback in self.changed_event_map[index]:
-        callback(final_value)
+        state.releases[index] += 1
+        callbacks = self.released_event_map.get(index)
+      if callbacks:
+        fired.append((callbacks, ()))
+      callbacks = self.changed_event_map.get(index)
+      if callbacks:
+        fired.append((callbacks, (final_value,)))
     elif event_type == Gamepad.EVENT_CODE_AXIS:
-      final_value = value / Gamepad.MAX_AXIS
-      self.axis_map[index] = final_value
-      for callback in self.moved_event_map[index]:
-        callback(final_value)
+      state.axes[index] = final_value = value / Gamepad.MAX_AXIS
+      callbacks = self.moved_event_map.get(index)
+      if callbacks and self.moved_callback_interval:
+        self._moved_pending[index] = final_value
+      elif callbacks:
+        fired.append((callbacks, (final_value,)))
     elif event_type == Gamepad.EVENT_CODE_INIT_BUTTON:
-      if value == 0:
-        final_value = False
-      else:
-        final_value = True
-      self.pressed_map[index] = final_value
-      self.was_pressed_map[index] = False
-      self.was_released_map[index] = False
-      self.pressed_event_map[index] = []
-      self.released_event_map[index] = []
-      self.changed_event_map[index] = []
+      state.pressed[index] = value != 0
+      if index not in state.known_buttons:
+        state.known_buttons = state.known_buttons | {index}
+      # Init events are sent again when a joystick reconnects, keep the callbacks.
+      self.pressed_event_map.setdefault(index, [])
+      self.released_event_map.setdefault(index, [])
+      self.changed_event_map.setdefault(index, [])
     elif event_type == Gamepad.EVENT_CODE_INIT_AXIS:
-      final_value = value / Gamepad.MAX_AXIS
-      self.axis_map[index] = final_value
-      self.moved_event_map[index] = []
+      state.axes[index] = value / Gamepad.MAX_AXIS
+      if index not in state.known_axes:
+        state.known_axes = state.known_axes | {index}
+      self.moved_event_map.setdefault(index, [])
+
+  def _release_all(self):
+    """Resets every button to released and every axis to its center."""
+    state = self._state.copy()
+    state.generation += 1
+    self._moved_pending.clear()
+    for index in state.known_buttons:
+      if state.pressed[index]:
+        state.pressed[index] = 0
+        state.releases[index] += 1
+    for index in state.known_axes:
+      state.axes[index] = 0.0
+    self._state = state
+
+  def _handle_disconnect(self):
+    """Releases every input, runs the disconnected callbacks and waits for the joystick.
+
+    Safe to call from the background update thread."""
+    if self._loop is None:
+      return
+    if threading.get_ident() != self._loop_thread_id:
+      self._loop.call_soon_threadsafe(self._handle_disconnect)
+      return
+    self._release_all()
+    for callback in self.disconnected_callbacks:
+      callback()
+    self._notify_updated()
+    if self.auto_reconnect and self._reconnect_task is None:
+      self._reconnect_task = asyncio.ensure_future(self._reconnect())
+
+  async def _reconnect(self):
+    """Reopens the joystick once it is back and restarts the reader that was in use.
+
+    The driver sends init events on open, which resynchronize the state."""
+    try:
+      try:
+        self.joystick_file.close()
+      except (AttributeError, OSError):
+        pass
+      await self.open(retry_interval=Gamepad.RECONNECT_INTERVAL,
+                      max_retry_interval=Gamepad.RECONNECT_INTERVAL)
+      self.connected = True
+      if self._reader_mode == 'asyncio':
+        self.start_event_loop_updates()
+      elif self._reader_mode == 'thread':
+        self.start_background_updates(wait_for_ready=False)
+      _logger.info(f'Joystick {self.joystick_path} reconnected')
+    finally:
+      self._reconnect_task = None
+
+  def attach_event_loop(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+    """Binds the gamepad to an asyncio loop, so coroutines can use wait_for_update.
+
+    Must be called from the thread running the loop."""
+    self._loop = loop or asyncio.get_event_loop()
+    self._loop_thread_id = threading.get_ident()
+    self._updated = asyncio.Event()
+
+  def _notify_updated(self):
+    """Wakes up any coroutine waiting in wait_for_update.
+
+    Safe to call from the background update thread."""
+    if self._loop is None or self._updated.is_set():
+      return
+    if threading.get_ident() == self._loop_thread_id:
+      self._updated.set()
+    else:
+      self._loop.call_soon_threadsafe(self._updated.set)
+
+  async def wait_for_update(self, timeout: Optional[float] = None) -> bool:
+    """Waits until the gamepad state changes.
+
+    Returns True if the state changed, False if the timeout expired first.
+    With no timeout the call sleeps until the next event arrives."""
+    if self._updated is None:
+      raise RuntimeError('Called wait_for_update before attach_event_loop')
+    try:
+      await asyncio.wait_for(self._updated.wait(), timeout)
+    except asyncio.TimeoutError:
+      return False
+    self._updated.clear()
+    return True
 
   def start_background_updates(self, wait_for_ready=True):
     """Starts a background thread which keeps the gamepad state updated automatically.
     This allows for asynchronous gamepad updates and event callback code.
 
+    wait_for_ready blocks the calling thread until is_ready, coroutines should
+    pass False and await wait_until_ready instead.
+
     Do not use with get_next_event"""
     if self.update_thread:
       if self.update_thread.running:
         raise RuntimeError(
           'Called startBackgroundUpdates when the update thread is already running')
     self.update_thread = Gamepad.UpdateThread(self)
+    self._reader_mode = 'thread'
     self.update_thread.start()
     if wait_for_ready:
       while not self.is_ready() and self.connected:
-        time.sleep(1.0)
+        time.sleep(Gamepad.READY_POLL_INTERVAL)
+
+  def start_event_loop_updates(self):
+    """Keeps the gamepad state updated from the asyncio loop, without a background thread.
+
+    The joystick is switched to non-blocking mode and read whenever the loop reports
+    it as readable, so state is only ever touched from the loop thread.
+
+    Do not use with get_next_event or start_background_updates"""
+    if self.update_thread and self.update_thread.running:
+      raise RuntimeError(
+        'Called start_event_loop_updates while the update thread is running')
+    if self._reader_fd is not None:
+      raise RuntimeError('Called start_event_loop_updates twice')
+    if self._loop is None:
+      self.attach_event_loop()
+    self._reader_fd = self.joystick_file.fileno()
+    self._reader_mode = 'asyncio'
+    os.set_blocking(self._reader_fd, False)
+    self._loop.add_reader(self._reader_fd, self._on_readable)
+
+  def _on_readable(self):
+    """Reader callback for start_event_loop_updates, applies every pending event."""
+    try:
+      events = self._read_events_raw()
+      while events:
+        self._apply_events(events)
+        events = self._read_events_raw()
+    except IOError as e:
+      _logger.error(str(e))
+      self.stop_event_loop_updates()
+      self._handle_disconnect()
+    self._notify_updated()
+
+  def stop_event_loop_updates(self):
+    """Stops reading the gamepad from the asyncio loop.
+    This may be called even if the loop reader was never started."""
+    if self._reader_fd is not None:
+      self._loop.remove_reader(self._reader_fd)
+      self._reader_fd = None
 
   def stop_background_updates(self):
     """Stops the background thread which keeps the gamepad state updated automatically.
@@ -261,12 +639,34 @@ class Gamepad:
     The thread will stop on the next event after this call was made."""
     if self.update_thread is not None:
       self.update_thread.running = False
+    self.stop_event_loop_updates()
+    if self._moved_timer is not None:
+      self._moved_timer.cancel()
+      self._moved_timer = None
 
   def is_ready(self):
     """Used with update_state to indicate that the gamepad is now ready for use.
 
     This is usually after the first button press or stick movement."""
-    return len(self.axis_map) + len(self.pressed_map) > 1
+    state = self._state
+    return len(state.known_axes) + len(state.known_buttons) > 1
+
+  async def wait_until_ready(self, timeout: Optional[float] = None) -> bool:
+    """Waits until is_ready is True without blocking the loop.
+
+    Returns False if the timeout expired or the gamepad disconnected first.
+    Must be called before anything else waits with wait_for_update."""
+    if self._updated is None:
+      raise RuntimeError('Called wait_until_ready before attach_event_loop')
+    deadline = None if timeout is None else self._loop.time() + timeout
+    while not self.is_ready():
+      if not self.connected:
+        return False
+      remaining = None if deadline is None else deadline - self._loop.time()
+      if remaining is not None and remaining <= 0:
+        return False
+      await self.wait_for_update(remaining)
+    return True
 
   def wait_ready(self):
     """Convenience function which waits until the is_ready call is True."""
@@ -291,41 +691,41 @@ class Gamepad:
     Status is updated by getNextEvent calls.
 
     Throws ValueError if the button name or index cannot be found."""
-    try:
-      button_index = self._get_button_index(button_name)
-      return self.pressed_map[button_index]
-    except KeyError:
+    button_index = self._get_button_index(button_name)
+    state = self._state
+    if button_index not in state.known_buttons:
       raise ValueError('Button %i was not found' % button_index)
+    return bool(state.pressed[button_index])
 
   def been_pressed(self, button_name):
     """Returns True if the button specified by name or index has been pressed since the last beenPressed call.
-    Used in conjunction with updateState.
+    Used in conjunction with updateState. Several presses between two calls count as one.
 
     Throws ValueError if the button name or index cannot be found."""
-    try:
-      button_index = self._get_button_index(button_name)
-      if self.was_pressed_map[button_index]:
-        self.was_pressed_map[button_index] = False
-        return True
-      else:
-        return False
-    except KeyError:
+    button_index = self._get_button_index(button_name)
+    state = self._state
+    if button_index not in state.known_buttons:
       raise ValueError('Button %i was not found' % button_index)
+    presses = state.presses[button_index]
+    if presses == self._presses_seen[button_index]:
+      return False
+    self._presses_seen[button_index] = presses
+    return True
 
   def been_released(self, button_name):
     """Returns True if the button specified by name or index has been released since the last beenReleased call.
-    Used in conjunction with updateState.
+    Used in conjunction with updateState. Several releases between two calls count as one.
 
     Throws ValueError if the button name or index cannot be found."""
-    try:
-      button_index = self._get_button_index(button_name)
-      if self.was_released_map[button_index]:
-        self.was_released_map[button_index] = False
-        return True
-      else:
-        return False
-    except KeyError:
+    button_index = self._get_button_index(button_name)
+    state = self._state
+    if button_index not in state.known_buttons:
       raise ValueError('Button %i was not found' % button_index)
+    releases = state.releases[button_index]
+    if releases == self._releases_seen[button_index]:
+      return False
+    self._releases_seen[button_index] = releases
+    return True
 
   def axis(self, axis_name):
     """Returns the last observed state of a gamepad axis specified by name or index.
@@ -339,11 +739,12 @@ class Gamepad:
         axis_index = self.axis_index[axis_name]
       else:
         axis_index = int(axis_name)
-      return self.axis_map[axis_index]
-    except KeyError:
-      raise ValueError('Axis %i was not found' % axis_index)
     except ValueError:
       raise ValueError('Axis name %s was not found' % axis_name)
+    state = self._state
+    if axis_index not in state.known_axes:
+      raise ValueError('Axis %i was not found' % axis_index)
+    return state.axes[axis_index]
 
   def available_button_names(self):
     """Returns a list of available button names for this gamepad.
@@ -362,6 +763,7 @@ class Gamepad:
   def disconnect(self):
     """Cleanly disconnect and remove any threads and event handlers."""
     self.connected = False
+    self.auto_reconnect = False
     self.stop_background_updates()
     del self.joystick_file
 
@@ -0,0 +1,124 @@
+"""Low overhead latency statistics for the input to controller path.
+
+Stages, in the order an input travels through the pendant:
+  read: reading a batch of events until they are applied to the gamepad state.
+  dispatch: state applied until get_commands returns the commands for it.
+  emit: commands queued until the emit to the server finishes, including the
+  time spent waiting for the controller to have room.
+  echo: emit finished until the server reports writing the line to the serial
+  port (serialport:write).
+  total: events read until the resulting emit finishes.
+  realtime: a real-time command press read until its emit finishes, through
+  the priority lane of realtime.py instead of the stages above.
+All times come from time.perf_counter.
+"""
+
+import collections
+import logging
+import math
+import time
+
+from typing import Deque, Dict, List, Tuple
+
+
+_logger = logging.getLogger('cncjs-py-pendant')
+
+STAGES = ('read', 'dispatch', 'emit', 'echo', 'total', 'realtime')
+
+# Buckets per power of two; bounds the relative error of percentiles to ~9%
+_SUB_BUCKETS = 8
+# Smallest latency told apart, in seconds
+_RESOLUTION = 1e-6
+
+
+class Histogram:
+  """Log bucketed histogram of durations, recording is O(1)."""
+
+  def __init__(self):
+    self.counts: Dict[int, int] = collections.defaultdict(int)
+    self.count = 0
+    self.max = 0.0
+
+  def record(self, seconds: float) -> None:
+    mantissa, exponent = math.frexp(max(seconds / _RESOLUTION, 1.0))
+    self.counts[exponent * _SUB_BUCKETS + int((mantissa - 0.5) * 2 * _SUB_BUCKETS)] += 1
+    self.count += 1
+    if seconds > self.max:
+      self.max = seconds
+
+  def percentile(self, percent: float) -> float:
+    """Returns the upper bound of the bucket holding the given percentile."""
+    if not self.count:
+      return 0.0
+    remaining = self.count * percent / 100
+    for bucket in sorted(self.counts):
+      remaining -= self.counts[bucket]
+      if remaining <= 0:
+        break
+    exponent, sub_bucket = divmod(bucket, _SUB_BUCKETS)
+    upper = math.ldexp(0.5 + (sub_bucket + 1) / (2 * _SUB_BUCKETS), exponent) * _RESOLUTION
+    return min(upper, self.max)
+
+  def reset(self) -> None:
+    self.counts.clear()
+    self.count = 0
+    self.max = 0.0
+
+
+class LatencyTracker:
+  """Histograms for each stage of the pendant, see the module documentation.
+
+  Attributes:
+    histograms: histogram of each stage, by stage name.
+  """
+
+  # Maximum number of emitted lines waiting for their serialport:write echo
+  _MAX_PENDING_ECHOES = 64
+
+  def __init__(self):
+    self.histograms = {stage: Histogram() for stage in STAGES}
+    self._pending_echoes: Deque[Tuple[str, float]] = collections.deque(
+      maxlen=LatencyTracker._MAX_PENDING_ECHOES)
+
+  def record(self, stage: str, seconds: float) -> None:
+    self.histograms[stage].record(seconds)
+
+  def emitted(self, lines: List[str], emitted_at: float) -> None:
+    """Remembers lines just emitted, to measure the time until they are echoed."""
+    for line in lines:
+      self._pending_echoes.append((line.strip(), emitted_at))
+
+  def serial_write(self, data: str) -> None:
+    """Handler for lines the server reports writing to the serial port."""
+    now = time.perf_counter()
+    line = data.strip()
+    for index, (pending_line, emitted_at) in enumerate(self._pending_echoes):
+      if pending_line == line:
+        self.record('echo', now - emitted_at)
+        # Older lines that were never echoed will not be anymore.
+        for _ in range(index + 1):
+          self._pending_echoes.popleft()
+        break
+
+  def report(self) -> Dict[str, Dict[str, float]]:
+    """Returns count, p50, p99 and max (in milliseconds) for each stage."""
+    return {
+      stage: {
+        'count': histogram.count,
+        'p50': histogram.percentile(50) * 1e3,
+        'p99': histogram.percentile(99) * 1e3,
+        'max': histogram.max * 1e3,
+      } for stage, histogram in self.histograms.items()
+    }
+
+  def log_report(self, name: str = '') -> None:
+    """Logs the report, prefixed with name when several trackers are in use."""
+    prefix = f'{name} ' if name else ''
+    for stage, stats in self.report().items():
+      _logger.info(
+        f'{prefix}Latency {stage:>8}: n={stats["count"]:<7.0f} p50={stats["p50"]:.3f} ms '
+        f'p99={stats["p99"]:.3f} ms max={stats["max"]:.3f} ms')
+
+  def reset(self) -> None:
+    for histogram in self.histograms.values():
+      histogram.reset()
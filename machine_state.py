@@ -0,0 +1,289 @@
+"""Local mirror of the machine state, fed by CNCjs and the controller.
+
+CNCjs sends the state of Grbl controllers as controller:state events, and the
+controller itself answers "?" with status reports like
+  <Idle|MPos:1.000,2.000,0.000|FS:0,0|WCO:0.000,0.000,-5.000|Ov:100,100,100>
+which reach the pendant as serialport:read lines. CNCjs also reports whether
+it is running a G-code program with workflow:state events. All of them update
+a MachineState, which the pendant reads on every tick to avoid sending
+commands the controller would reject. Other controllers are not mirrored,
+their state stays unknown.
+"""
+
+import logging
+import time
+
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import command_mapping
+
+
+_logger = logging.getLogger('cncjs-py-pendant')
+
+Position = Tuple[float, float, float]
+
+# Grbl only accepts jog commands in the Idle and Jog states
+JOG_BLOCKING_STATES = frozenset(('Alarm', 'Run', 'Hold', 'Door', 'Sleep', 'Home', 'Check'))
+# Step moves are plain G-code and put Grbl in Run themselves, so Run does not
+# block them. A running program does, see workflow_state.
+MOVE_BLOCKING_STATES = JOG_BLOCKING_STATES - {'Run'}
+# CNCjs workflow states while a program is being sent
+BUSY_WORKFLOW_STATES = frozenset(('running', 'paused'))
+# In Alarm, Grbl rejects G-code with error:9, only $ commands and homing work
+GCODE_BLOCKING_STATES = frozenset(('Alarm',))
+# CNCjs commands that may move the machine to a position the pendant cannot
+# tell, or stop it before the position it was sent to
+_MOVING_COMMANDS = frozenset(('gcode', 'homing', command_mapping.MACRO_RUN, 'feedhold', 'reset'))
+# CNCjs command running the homing cycle, and the Grbl line it sends
+_HOMING_COMMAND = 'homing'
+_HOMING_LINE = '$H'
+# Seconds after the last command sent before an Idle report is trusted to
+# include its moves. CNCjs only sends controller:state when the state changes,
+# so a command that does not move the machine (set zero, a macro...) is not
+# followed by a new Idle report: the last one is trusted once this delay passed
+# without the machine leaving Idle.
+_RESYNC_DELAY = 0.5
+
+
+def _position(values: Sequence[Any]) -> Position:
+  x, y, z = (float(value) for value in values[:3])
+  return x, y, z
+
+
+class MachineState:
+  """Last known state of the machine, every attribute is None until reported.
+
+  Attributes:
+    active_state: Grbl state, like Idle, Jog, Run, Hold or Alarm, without the
+    sub state (Hold:0 is Hold).
+    sub_state: number after the state, like 0 in Hold:0, None when not reported.
+    machine_position: (x, y, z) in machine coordinates.
+    work_position: (x, y, z) in work coordinates.
+    work_offset: machine minus work position, from WCO.
+    feed_rate: current feed rate.
+    spindle_speed: current spindle speed.
+    overrides: (feed, rapid, spindle) override percentages.
+    workflow_state: CNCjs workflow state, idle, running or paused.
+    updated_at: time.monotonic of the last update.
+    jogs_allowed: whether the controller would accept a $J jog now. True while
+    the state is unknown.
+    moves_allowed: whether a step move (G91 G-code) can be sent now, False while
+    a program runs. True while the state is unknown.
+    gcode_allowed: whether the controller would accept G-code now. True while
+    the state is unknown.
+    planned_position: machine position once the jogs sent so far end, None when
+    it is the reported one.
+    position_stale: whether a command moved the machine somewhere unknown since
+    the last Idle report.
+    homed: whether the machine finished a homing cycle since the last alarm, so
+    its machine position matches the travel limits. Until then MPos is wherever
+    the machine was powered on or unlocked with $X.
+  """
+  __slots__ = ('active_state', 'sub_state', 'machine_position', 'work_position', 'work_offset',
+               'feed_rate', 'spindle_speed', 'overrides', 'workflow_state', 'updated_at',
+               'jogs_allowed', 'moves_allowed', 'gcode_allowed', 'planned_position',
+               'position_stale', 'homed', '_sent_at', '_holding_jogs', '_homing')
+
+  def __init__(self):
+    self.active_state: Optional[str] = None
+    self.sub_state: Optional[int] = None
+    self.machine_position: Optional[Position] = None
+    self.work_position: Optional[Position] = None
+    self.work_offset: Optional[Position] = None
+    self.feed_rate: Optional[float] = None
+    self.spindle_speed: Optional[float] = None
+    self.overrides: Optional[Tuple[int, int, int]] = None
+    self.workflow_state: Optional[str] = None
+    self.updated_at: Optional[float] = None
+    self.jogs_allowed = True
+    self.moves_allowed = True
+    self.gcode_allowed = True
+    self.planned_position: Optional[Position] = None
+    self.position_stale = False
+    self.homed = False
+    self._sent_at = 0.0
+    self._holding_jogs = False
+    # A homing cycle was sent or reported, and has not ended in Idle yet
+    self._homing = False
+
+  def _update_allowed(self) -> None:
+    busy = self.workflow_state in BUSY_WORKFLOW_STATES
+    self.jogs_allowed = not busy and self.active_state not in JOG_BLOCKING_STATES
+    self.moves_allowed = not busy and self.active_state not in MOVE_BLOCKING_STATES
+    self.gcode_allowed = self.active_state not in GCODE_BLOCKING_STATES
+    self.updated_at = time.monotonic()
+
+  def _resync(self, now: float) -> None:
+    if self.active_state == 'Idle' and now - self._sent_at > _RESYNC_DELAY:
+      # Everything sent ran, the reported position is where the machine is
+      self.planned_position = None
+      self.position_stale = False
+      if self._homing:
+        self._homing = False
+        self.homed = True
+
+  def _set_active_state(self, active_state: Optional[str],
+                        sub_state: Optional[int] = None) -> None:
+    self.active_state = active_state
+    self.sub_state = sub_state
+    if active_state == 'Home':
+      self._homing = True
+    elif active_state == 'Alarm':
+      # Alarms and unlocking with $X leave the machine position unknown
+      self._homing = False
+      self.homed = False
+    self._update_allowed()
+    self._resync(self.updated_at)
+
+  @property
+  def hold_complete(self) -> bool:
+    """Whether a feed hold stopped the machine, so a soft reset keeps its position."""
+    return self.active_state == 'Hold' and self.sub_state == 0
+
+  def workflow(self, workflow_state: str) -> None:
+    """Handler for CNCjs workflow:state events."""
+    self.workflow_state = workflow_state
+    self._update_allowed()
+
+  def _complete_positions(self, machine_known: bool, work_known: bool) -> None:
+    """Derives the position that was not reported from the other one and the offset."""
+    offset = self.work_offset
+    if offset is None:
+      return
+    if machine_known and not work_known:
+      self.work_position = tuple(
+        position - delta for position, delta in zip(self.machine_position, offset))
+    elif work_known and not machine_known:
+      self.machine_position = tuple(
+        position + delta for position, delta in zip(self.work_position, offset))
+
+  def controller_state(self, controller_type: str, state: Dict[str, Any]) -> None:
+    """Handler for CNCjs controller:state events."""
+    if controller_type != 'Grbl':
+      return
+    status = state.get('status') or {}
+    try:
+      mpos = status.get('mpos')
+      wpos = status.get('wpos')
+      if mpos:
+        self.machine_position = _position((mpos['x'], mpos['y'], mpos['z']))
+      if wpos:
+        self.work_position = _position((wpos['x'], wpos['y'], wpos['z']))
+      wco = status.get('wco')
+      if wco:
+        self.work_offset = _position((wco['x'], wco['y'], wco['z']))
+      self._complete_positions(bool(mpos), bool(wpos))
+      if 'feedrate' in status:
+        self.feed_rate = float(status['feedrate'])
+      if 'spindle' in status:
+        self.spindle_speed = float(status['spindle'])
+      overrides = status.get('ov')
+      if overrides and len(overrides) >= 3:
+        self.overrides = (int(overrides[0]), int(overrides[1]), int(overrides[2]))
+    except (KeyError, TypeError, ValueError):
+      pass
+    if 'activeState' in status:
+      sub_state = status.get('subState')
+      self._set_active_state(status['activeState'] or None,
+                             sub_state if isinstance(sub_state, int) else None)
+
+  def status_report(self, line: str) -> bool:
+    """Updates the state from a Grbl 1.1 status report, returns whether line was one."""
+    line = line.strip()
+    if not (line.startswith('<') and line.endswith('>')):
+      return False
+    fields = line[1:-1].split('|')
+    machine_known = work_known = False
+    try:
+      for field in fields[1:]:
+        name, _, value = field.partition(':')
+        if name == 'MPos':
+          self.machine_position = _position(value.split(','))
+          machine_known = True
+        elif name == 'WPos':
+          self.work_position = _position(value.split(','))
+          work_known = True
+        elif name == 'WCO':
+          self.work_offset = _position(value.split(','))
+        elif name == 'FS':
+          feed_rate, spindle_speed = value.split(',')[:2]
+          self.feed_rate = float(feed_rate)
+          self.spindle_speed = float(spindle_speed)
+        elif name == 'F':
+          self.feed_rate = float(value)
+        elif name == 'Ov':
+          feed, rapid, spindle = value.split(',')[:3]
+          self.overrides = (int(feed), int(rapid), int(spindle))
+    except ValueError:
+      return False
+    self._complete_positions(machine_known, work_known)
+    active_state, _, sub_state = fields[0].partition(':')
+    self._set_active_state(active_state, int(sub_state) if sub_state.isdigit() else None)
+    return True
+
+  def limit_jog(self, distances: Dict[command_mapping.MovementAxis, float],
+                envelope: command_mapping.WorkEnvelope) -> None:
+    """Shortens the distances of a jog in place so it ends inside envelope.
+
+    The machine is somewhere between its reported position, which lags behind,
+    and the planned one, which it may not reach if a jog is cancelled. Each axis
+    starts from whichever of the two is closer to the limit it moves towards.
+    Jogs are dropped while the position is stale, and left as they are while
+    the position is unknown or the machine has not been homed.
+    """
+    reported = self.machine_position
+    if reported is None or not self.homed:
+      return
+    if self.position_stale:
+      self._resync(time.monotonic())
+    if self.position_stale:
+      if not self._holding_jogs:
+        _logger.warning(f'Holding back jogs in state {self.active_state} until the machine '
+                        f'reports where a command moved it')
+        self._holding_jogs = True
+      for axis in distances:
+        distances[axis] = 0.0
+      return
+    if self._holding_jogs:
+      _logger.info('Machine position known again, jogging')
+      self._holding_jogs = False
+    planned = self.planned_position or reported
+    for axis, distance in distances.items():
+      index = command_mapping.AXIS_INDEX[axis]
+      if distance > 0:
+        start = max(reported[index], planned[index])
+      else:
+        start = min(reported[index], planned[index])
+      distances[axis] = envelope.limit(axis, start, distance)
+
+  def jogged(self, distances: Dict[command_mapping.MovementAxis, float]) -> None:
+    """Records a jog that was just sent."""
+    self._sent_at = time.monotonic()
+    start = self.planned_position or self.machine_position
+    if start is not None:
+      self.planned_position = tuple(
+        start[index] + distances.get(axis, 0.0)
+        for axis, index in command_mapping.AXIS_INDEX.items())
+
+  def commanded(self, command: command_mapping.Command) -> None:
+    """Records a command other than a jog that was just sent."""
+    if command.event != 'command':
+      return
+    name = command.arguments[0]
+    if name == _HOMING_COMMAND or (
+        name == 'gcode' and command.arguments[1].strip().upper() == _HOMING_LINE):
+      self._homing = True
+    if name in _MOVING_COMMANDS:
+      self._sent_at = time.monotonic()
+      self.planned_position = None
+      self.position_stale = True
+
+  def accepts(self, command: command_mapping.Command) -> bool:
+    """Whether the controller would accept command in the current state.
+
+    Real-time commands written to the port and homing/unlock always go through.
+    G-code, including macros, is held back in Alarm.
+    """
+    if self.gcode_allowed or command.event != 'command':
+      return True
+    return command.arguments[0] not in ('gcode', command_mapping.MACRO_RUN)
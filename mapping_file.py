@@ -0,0 +1,420 @@
+"""Gamepad to CNC machine mappings defined in JSON files.
+
+A mapping file defines mappings for any gamepad known to gamepad.py:
+
+  {"mappings": [{
+    "gamepad": "Xbox360",
+    "cnc": "Shapeoko",
+    "magnitude axes": {
+      "stick": {"slow_move_step": 0.1, "mid_move_step": 1, "fast_move_step": 10,
+                "slow_when_below": 0.4, "fast_when_above": 0.8,
+                "trigger_if_above": 0.1, "use_absolute_input": true},
+      "trigger": {"label": "LT", "slow_when_below": -0.2}
+    },
+    "commands": [
+      {"button": "XBOX", "commands": [["homing"]]},
+      {"button": "Y", "move": "Z", "direction": "+", "magnitude": "trigger"},
+      {"axis": "LEFT-Y", "move": "Y", "magnitude": "stick", "reverse": true}
+    ],
+    "envelope": {"minimum": [-425, -425, -75], "maximum": [0, 0, 0]},
+    "sticks": [["LEFT-X", "LEFT-Y"]]
+  }]}
+
+Magnitude axes take the fields of command_mapping.MagnitudeAxis. Axis
+commands use the magnitude axis with their own axis as label. Commands are
+lists of arguments sent with the "command" event, or objects with
+"arguments" and "event". Buttons sending only ["feedhold"], ["cyclestart"],
+["reset"] or the "\\u0085" write (jog cancel) are sent by the priority lane of
+realtime.py. Every button and axis is checked against the gamepad, and
+unknown keys are rejected, so typos fail at startup.
+
+Validated mappings are cached on disk as plain JSON, keyed by the hash of the
+file and of the modules checking and building them, so a file that did not
+change is loaded without being checked again. The objects are built again from
+the cache, and a cache that does not build is ignored.
+"""
+
+import dataclasses
+import functools
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import tempfile
+
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import command_mapping
+import gamepad
+
+
+_logger = logging.getLogger('cncjs-py-pendant')
+
+# Mappings shipped with the pendant, for the gamepads without a built-in one
+DEFAULT_MAPPING_FILE = pathlib.Path(__file__).resolve().parent / 'mappings.json'
+# Modules deciding what a cached mapping holds: the gamepads it was checked
+# against, the mapping objects and this parser. Their hash is part of the key.
+_CACHE_SOURCES = (gamepad.__file__, command_mapping.__file__, __file__)
+_MAGNITUDE_AXIS_FIELDS = tuple(
+  field.name for field in dataclasses.fields(command_mapping.MagnitudeAxis))
+
+_MAPPING_KEYS = frozenset(('gamepad', 'cnc', 'magnitude axes', 'commands', 'envelope', 'sticks'))
+_COMMAND_KEYS = frozenset(('button', 'axis', 'commands', 'move', 'direction', 'magnitude',
+                           'reverse', 'repeat'))
+# Magnitude axis fields a mapping file may set, with their JSON types. Curves
+# and filters come from the config file.
+_MAGNITUDE_FIELDS = {
+  'label': (str,), 'slow_move_step': (int, float), 'mid_move_step': (int, float),
+  'fast_move_step': (int, float), 'slow_when_below': (int, float),
+  'fast_when_above': (int, float), 'trigger_if_above': (int, float),
+  'use_absolute_input': (bool,)}
+_DIRECTIONS = {'+': command_mapping.Direction.POSITIVE, '-': command_mapping.Direction.NEGATIVE}
+
+# Content hash and mappings last loaded from each file with the default cache
+_loaded: Dict[pathlib.Path, Tuple[str, Tuple['Mapping', ...]]] = {}
+
+
+class InvalidMappingError(ValueError):
+  """The mapping file is not valid."""
+
+
+@dataclasses.dataclass(frozen=True)
+class Mapping:
+  """Commands of a gamepad on a CNC machine, with the machine envelope and the gamepad sticks."""
+  gamepad: str
+  cnc: str
+  commands: Tuple[command_mapping.MappedCommand, ...]
+  envelope: Optional[command_mapping.WorkEnvelope] = None
+  sticks: Tuple[Tuple[str, str], ...] = ()
+
+
+def _check_keys(where: str, value: Any, allowed: Iterable[str]) -> None:
+  if not isinstance(value, dict):
+    raise InvalidMappingError(f'{where} must be an object')
+  unknown = set(value) - set(allowed)
+  if unknown:
+    raise InvalidMappingError(f'{where} has unknown keys {sorted(unknown)}')
+
+
+def _command(where: str, value: Any) -> command_mapping.Command:
+  if isinstance(value, dict):
+    _check_keys(where, value, ('arguments', 'event'))
+    arguments, event = value.get('arguments'), value.get('event', 'command')
+  else:
+    arguments, event = value, 'command'
+  if (not isinstance(arguments, list) or not arguments
+      or not all(isinstance(argument, str) for argument in arguments)):
+    raise InvalidMappingError(f'{where} needs a list of string arguments')
+  if event not in ('command', 'write'):
+    raise InvalidMappingError(f'{where} has unknown event {event}')
+  return command_mapping.Command(tuple(arguments), event=event)
+
+
+class _Parser:
+  """Validates the mappings of one gamepad and builds their objects."""
+
+  def __init__(self, where: str, pad: gamepad.Gamepad):
+    self.where = where
+    self.buttons = set(pad.available_button_names())
+    self.axes = set(pad.available_axis_names())
+    self.magnitudes: Dict[str, command_mapping.MagnitudeAxis] = {}
+
+  def button(self, where: str, name: Any) -> str:
+    if not isinstance(name, str) or name not in self.buttons:
+      raise InvalidMappingError(f'{where}: unknown button {name}, expected one of '
+                                f'{sorted(self.buttons)}')
+    return name
+
+  def axis(self, where: str, name: Any) -> str:
+    if not isinstance(name, str) or name not in self.axes:
+      raise InvalidMappingError(f'{where}: unknown axis {name}, expected one of '
+                                f'{sorted(self.axes)}')
+    return name
+
+  def magnitude_axes(self, value: Any) -> None:
+    where = f'{self.where} magnitude axes'
+    if not isinstance(value, dict):
+      raise InvalidMappingError(f'{where} must be an object')
+    for name, fields in value.items():
+      _check_keys(f'{where} {name}', fields, _MAGNITUDE_FIELDS)
+      for field, value in fields.items():
+        # bool is an int, but not a valid step or threshold
+        if not isinstance(value, _MAGNITUDE_FIELDS[field]) or (
+            isinstance(value, bool) and bool not in _MAGNITUDE_FIELDS[field]):
+          raise InvalidMappingError(f'{where} {name}: invalid {field} {value!r}')
+      if fields.get('label'):
+        self.axis(f'{where} {name}', fields['label'])
+      try:
+        self.magnitudes[name] = command_mapping.MagnitudeAxis(**fields)
+      except (TypeError, ValueError) as e:
+        raise InvalidMappingError(f'{where} {name}: {e}')
+
+  def magnitude(self, where: str, name: Any) -> command_mapping.MagnitudeAxis:
+    if not isinstance(name, str) or name not in self.magnitudes:
+      raise InvalidMappingError(f'{where}: unknown magnitude axis {name}')
+    return self.magnitudes[name]
+
+  def mapped_command(self, number: int, value: Any) -> command_mapping.MappedCommand:
+    where = f'{self.where} command {number}'
+    _check_keys(where, value, _COMMAND_KEYS)
+    if ('button' in value) == ('axis' in value):
+      raise InvalidMappingError(f'{where} needs either a button or an axis')
+    if 'commands' in value:
+      if 'axis' in value:
+        raise InvalidMappingError(f'{where}: axes cannot send commands')
+      if not isinstance(value['commands'], list) or not value['commands']:
+        raise InvalidMappingError(f'{where} needs a list of commands')
+      return command_mapping.MappedCommand(
+        button=self.button(where, value['button']),
+        commands=tuple(_command(f'{where} command {index}', command)
+                       for index, command in enumerate(value['commands'])),
+        repeat_if_pressed=bool(value.get('repeat', False)))
+    try:
+      movement_axis = command_mapping.MovementAxis(value.get('move'))
+    except ValueError:
+      raise InvalidMappingError(f'{where} needs a move of X, Y or Z, or commands')
+    magnitude = self.magnitude(where, value.get('magnitude'))
+    if 'axis' in value:
+      return command_mapping.MappedCommand(
+        axis=dataclasses.replace(magnitude, label=self.axis(where, value['axis'])),
+        movement_axis=movement_axis,
+        reverse_axis_direction=bool(value.get('reverse', False)))
+    if not isinstance(value.get('direction'), str) or value['direction'] not in _DIRECTIONS:
+      raise InvalidMappingError(f'{where} needs a direction of "+" or "-"')
+    return command_mapping.MappedCommand(
+      button=self.button(where, value['button']),
+      movement_axis=movement_axis,
+      direction=_DIRECTIONS[value['direction']],
+      magnitude_axis=magnitude,
+      repeat_if_pressed=bool(value.get('repeat', True)))
+
+  def envelope(self, value: Any) -> command_mapping.WorkEnvelope:
+    where = f'{self.where} envelope'
+    _check_keys(where, value, ('minimum', 'maximum'))
+    try:
+      minimum, maximum = (tuple(float(position) for position in value[key])
+                          for key in ('minimum', 'maximum'))
+      if len(minimum) != 3 or len(maximum) != 3:
+        raise ValueError('limits need x, y and z values')
+      return command_mapping.WorkEnvelope(minimum=minimum, maximum=maximum)
+    except (KeyError, TypeError, ValueError) as e:
+      raise InvalidMappingError(f'{where}: {e}')
+
+  def sticks(self, value: Any) -> Tuple[Tuple[str, str], ...]:
+    where = f'{self.where} sticks'
+    if not isinstance(value, list) or not all(
+        isinstance(stick, list) and len(stick) == 2 for stick in value):
+      raise InvalidMappingError(f'{where} must be a list of [x, y] axes')
+    return tuple((self.axis(where, x), self.axis(where, y)) for x, y in value)
+
+
+def _parse_mapping(number: int, value: Any) -> Mapping:
+  where = f'Mapping {number}'
+  _check_keys(where, value, _MAPPING_KEYS)
+  name, cnc = value.get('gamepad'), value.get('cnc')
+  if not isinstance(cnc, str) or not cnc:
+    raise InvalidMappingError(f'{where} needs a cnc machine name')
+  try:
+    pad = gamepad.get_gamepad_by_name(name)
+  except (KeyError, TypeError):
+    raise InvalidMappingError(f'{where}: unknown gamepad {name}')
+  parser = _Parser(f'Mapping {name}/{cnc}', pad)
+  parser.magnitude_axes(value.get('magnitude axes', {}))
+  commands = value.get('commands')
+  if not isinstance(commands, list) or not commands:
+    raise InvalidMappingError(f'{parser.where} needs a list of commands')
+  return Mapping(
+    gamepad=name, cnc=cnc,
+    commands=tuple(parser.mapped_command(index, command)
+                   for index, command in enumerate(commands)),
+    envelope=parser.envelope(value['envelope']) if 'envelope' in value else None,
+    sticks=parser.sticks(value.get('sticks', [])))
+
+
+def parse_mappings(content: bytes) -> Tuple[Mapping, ...]:
+  """Parses and validates the content of a mapping file."""
+  try:
+    document = json.loads(content)
+  except ValueError as e:
+    raise InvalidMappingError(f'Invalid JSON: {e}')
+  _check_keys('Mapping file', document, ('mappings',))
+  if not isinstance(document.get('mappings'), list):
+    raise InvalidMappingError('Mapping file needs a list of mappings')
+  mappings = tuple(_parse_mapping(number, value)
+                   for number, value in enumerate(document['mappings']))
+  names = [(mapping.gamepad, mapping.cnc) for mapping in mappings]
+  if len(set(names)) != len(names):
+    raise InvalidMappingError('Mapping file defines a gamepad and CNC machine twice')
+  return mappings
+
+
+def default_cache_directory() -> pathlib.Path:
+  cache = os.environ.get('XDG_CACHE_HOME') or pathlib.Path('~/.cache').expanduser()
+  return pathlib.Path(cache) / 'cncjs-py-pendant' / 'mappings'
+
+
+@functools.lru_cache(maxsize=None)
+def _sources_hash() -> str:
+  digest = hashlib.sha256()
+  for source in _CACHE_SOURCES:
+    digest.update(pathlib.Path(source).read_bytes())
+  return digest.hexdigest()[:16]
+
+
+class _Encoder:
+  """Turns the mappings of a file into plain JSON values, see _decode.
+
+  Magnitude axes are written once per mapping with the values of their fields,
+  and referenced by index, as mappings share them between their commands."""
+
+  def __init__(self):
+    self.magnitudes: List[List[Any]] = []
+    self._indices: Dict[command_mapping.MagnitudeAxis, int] = {}
+
+  def magnitude(self, axis: Optional[command_mapping.MagnitudeAxis]) -> Optional[int]:
+    if axis is None:
+      return None
+    if axis not in self._indices:
+      values = [getattr(axis, field) for field in _MAGNITUDE_AXIS_FIELDS]
+      values = [[value.shape, [list(point) for point in value.points]]
+                if isinstance(value, command_mapping.ResponseCurve) else value
+                for value in values]
+      self._indices[axis] = len(self.magnitudes)
+      self.magnitudes.append(values)
+    return self._indices[axis]
+
+  def mapping(self, mapping: Mapping) -> Dict[str, Any]:
+    commands = [[
+      action.button,
+      self.magnitude(action.axis),
+      action.reverse_axis_direction,
+      [[list(command.arguments), command.event] for command in action.commands],
+      action.direction.value if action.direction else None,
+      action.movement_axis.value if action.movement_axis else None,
+      action.repeat_if_pressed,
+      self.magnitude(action.magnitude_axis),
+    ] for action in mapping.commands]
+    return {
+      'gamepad': mapping.gamepad,
+      'cnc': mapping.cnc,
+      'magnitudes': self.magnitudes,
+      'commands': commands,
+      'envelope': ([list(mapping.envelope.minimum), list(mapping.envelope.maximum)]
+                   if mapping.envelope else None),
+      'sticks': [list(stick) for stick in mapping.sticks],
+    }
+
+
+def _encode(mappings: Tuple[Mapping, ...]) -> List[Dict[str, Any]]:
+  """Returns mappings as plain JSON values, with the fields of their objects."""
+  return [_Encoder().mapping(mapping) for mapping in mappings]
+
+
+def _decode_magnitude(values: List[Any]) -> command_mapping.MagnitudeAxis:
+  if len(values) != len(_MAGNITUDE_AXIS_FIELDS):
+    raise ValueError(f'Magnitude axis with {len(values)} fields')
+  fields = dict(zip(_MAGNITUDE_AXIS_FIELDS, values))
+  curve = fields['curve']
+  if curve is not None:
+    fields['curve'] = command_mapping.ResponseCurve(
+      shape=curve[0], points=tuple(tuple(point) for point in curve[1]))
+  return command_mapping.MagnitudeAxis(**fields)
+
+
+def _decode(value: List[Dict[str, Any]]) -> Tuple[Mapping, ...]:
+  """Builds the mappings written by _encode, without checking them again."""
+  mappings = []
+  for mapping in value:
+    magnitudes = [_decode_magnitude(values) for values in mapping['magnitudes']]
+    commands = []
+    for (button, axis, reverse, arguments, direction, movement_axis, repeat,
+         magnitude) in mapping['commands']:
+      commands.append(command_mapping.MappedCommand(
+        button=button,
+        axis=magnitudes[axis] if axis is not None else None,
+        reverse_axis_direction=reverse,
+        commands=tuple(command_mapping.Command(tuple(command), event=event)
+                       for command, event in arguments),
+        direction=command_mapping.Direction(direction) if direction is not None else None,
+        movement_axis=(command_mapping.MovementAxis(movement_axis)
+                       if movement_axis is not None else None),
+        repeat_if_pressed=repeat,
+        magnitude_axis=magnitudes[magnitude] if magnitude is not None else None))
+    envelope = mapping['envelope']
+    mappings.append(Mapping(
+      gamepad=mapping['gamepad'], cnc=mapping['cnc'], commands=tuple(commands),
+      envelope=(command_mapping.WorkEnvelope(minimum=tuple(envelope[0]),
+                                             maximum=tuple(envelope[1]))
+                if envelope else None),
+      sticks=tuple((x, y) for x, y in mapping['sticks'])))
+  return tuple(mappings)
+
+
+def _read_cache(path: pathlib.Path) -> Optional[Tuple[Mapping, ...]]:
+  try:
+    return _decode(json.loads(path.read_bytes()))
+  except FileNotFoundError:
+    return None
+  except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+    # Truncated or written by another version, parse the file again
+    _logger.info(f'Ignoring mapping cache {path}: {e!r}')
+    return None
+
+
+def _write_cache(path: pathlib.Path, mappings: Tuple[Mapping, ...]) -> None:
+  try:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Written aside and renamed, so a concurrent load never sees half of it
+    with tempfile.NamedTemporaryFile('w', dir=path.parent, delete=False) as cache:
+      json.dump(_encode(mappings), cache)
+    os.replace(cache.name, path)
+  except OSError as e:
+    _logger.info(f'Could not write mapping cache {path}: {e}')
+
+
+def load_mappings(path: pathlib.Path,
+                  cache_directory: Optional[pathlib.Path] = None) -> Tuple[Mapping, ...]:
+  """Returns the mappings of a file, from the cache when the file did not change.
+
+  The cache is keyed by the hash of the file content, so edits are picked up
+  without invalidating anything, and by the hash of the modules checking and
+  building the mappings, so they are checked again when those change. The
+  mappings last loaded from each file are also kept in memory, for when the
+  config is reloaded. Pass a cache_directory to use another cache, which
+  bypasses the one in memory."""
+  try:
+    content = path.read_bytes()
+  except OSError as e:
+    raise InvalidMappingError(f'Could not read mapping file {path}: {e}')
+  key = hashlib.sha256(content).hexdigest()
+  loaded = _loaded.get(path)
+  if cache_directory is None and loaded is not None and loaded[0] == key:
+    return loaded[1]
+  cache = (cache_directory or default_cache_directory()) / f'{key}-{_sources_hash()}.json'
+  mappings = _read_cache(cache)
+  if mappings is None:
+    mappings = parse_mappings(content)
+    _write_cache(cache, mappings)
+  if cache_directory is None:
+    _loaded[path] = (key, mappings)
+  return mappings
+
+
+def find_mapping(gamepad_name: str, cnc: str,
+                 paths: Sequence[pathlib.Path] = ()) -> Mapping:
+  """Returns the mapping of a gamepad and CNC machine.
+
+  The mapping files at paths are searched in order, then the built-in
+  mappings of command_mapping."""
+  for path in paths:
+    for mapping in load_mappings(path):
+      if mapping.gamepad == gamepad_name and mapping.cnc == cnc:
+        return mapping
+  try:
+    commands = command_mapping.get_mapping(gamepad=gamepad_name, cnc=cnc)
+  except KeyError:
+    raise InvalidMappingError(f'No mapping for gamepad {gamepad_name} and CNC machine {cnc}')
+  return Mapping(gamepad=gamepad_name, cnc=cnc, commands=commands,
+                 envelope=command_mapping.get_envelope(gamepad_name, cnc),
+                 sticks=command_mapping.get_sticks(gamepad_name, cnc))
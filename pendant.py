@@ -1,21 +1,33 @@
 #!/usr/bin/python3
 
+import argparse
 import asyncio
 import collections
+import contextlib
 import datetime
-import dataclasses
+import functools
 import json
-import jwt
 import logging
+import math
 import pathlib
+import signal
 import sys
+import time
 
 import gamepad
 import cncjs_sio
+import command_dispatch
 import command_mapping
+import command_queue
 import config_manager
+import config_watch
+import latency
+import machine_state
+import realtime
+import recording
+import startup
 
-from typing import Tuple, Dict
+from typing import Dict, Iterable, Optional, Sequence, Tuple
 
 # set logging for the project
 _handler = logging.StreamHandler()
@@ -27,73 +39,406 @@ _logger.addHandler(_handler)
 logging.getLogger().setLevel(logging.INFO)
 
 
-@dataclasses.dataclass
-class Move:
-  direction: int = 0
-  magnitude_axis: command_mapping.MagnitudeAxis = command_mapping.MagnitudeAxis()
-
-
-def get_commands(config: config_manager.ConfigObjects) -> Tuple[command_mapping.Command, ...]:
-  moves: Dict[command_mapping.MovementAxis, Move] = collections.defaultdict(Move)
-
-  for action in config.mapped_commands:
-    if action.button:
-      pressed = (config.gamepad.is_pressed(action.button) if action.repeat_if_pressed
-             else config.gamepad.been_pressed(action.button))
-      if pressed:
-        if action.commands:
-          return action.commands
-        if action.movement_axis and action.direction:
-          moves[action.movement_axis].direction += action.direction.value
-          moves[action.movement_axis].magnitude_axis = action.magnitude_axis
-
-    if action.axis:
-      axis_value = config.gamepad.axis(action.axis.label)
-      if action.axis.has_triggered(axis_value):
-        moves[action.movement_axis].direction += (
-          int(axis_value / abs(axis_value)) * action.axis_direction_multiplier())
-        moves[action.movement_axis].magnitude_axis = action.axis
-
-  # Process movement requests.
-  gcode_moves = []
-  for axis, move in moves.items():
-    if move.direction:
-      distance = move.magnitude_axis.travel_distance(
-        config.gamepad.axis(move.magnitude_axis.label))
-      gcode_moves.append(f'{axis.value}{distance * move.direction}')
-  if gcode_moves:
-    # Set G-code prefixes for the move
-    gcode_moves = ['G91'] + gcode_moves
-    return (command_mapping.Command(('gcode', ' '.join(gcode_moves)),),
-        command_mapping.Command(('gcode', 'G90'),))
-
-  return ()
-
-
-async def main():
-  # Open config files
-  config_path = pathlib.Path('~/.cncjs-py-pendant-config').expanduser().resolve()
-  if not config_path.exists():
-    with config_path.open('w') as config_file:
-      config_manager.write_default_config(config_file)
-
-  with config_path.open('r') as config_file:
-    config = config_manager.get_config(config_file) 
-
-  cncrc_config = pathlib.Path('~/.cncrc').expanduser().resolve()
-  with cncrc_config.open('r') as f:
-    token = cncjs_sio.generate_access_token_from_cncrc(f)
-
-  sio = cncjs_sio.CNCjs_SIO()
-  await asyncio.gather(sio.connect(config.address, token), config.gamepad.open())
-  await sio.client.emit('open', (config.cnc_port, {'baudrate': config.baudrate, 'controllerType': config.controller_type}))
-  config.gamepad.start_background_updates()
+# Jog distances are sent with this many decimals
+_JOG_DECIMALS = 3
+_JOG_SCALE = 10 ** _JOG_DECIMALS
+_ABSOLUTE_MODE = command_mapping.Command(('gcode', 'G90'))
+# Seconds a feed hold may take to stop the machine when the gamepad disconnects
+_HOLD_TIMEOUT = 5.0
+_HOLD_POLL_INTERVAL = 0.05
+
+# Jog moves with the distances in 1/_JOG_SCALE units, used as cache keys
+_QuantizedMoves = Tuple[Tuple[command_mapping.MovementAxis, int], ...]
+
+
+def _quantize(moves: Iterable[Tuple[command_mapping.MovementAxis, float]]) -> _QuantizedMoves:
+  """Rounds the distances of moves to the decimals sent, dropping the ones rounded to 0."""
+  quantized = tuple((axis, round(distance * _JOG_SCALE)) for axis, distance in moves)
+  return tuple((axis, distance) for axis, distance in quantized if distance)
+
+
+@functools.lru_cache(maxsize=1024)
+def _gcode_word(axis: command_mapping.MovementAxis, distance: int) -> str:
+  """Returns the G-code word for a quantized distance, like X-0.3 for -300."""
+  whole, fraction = divmod(abs(distance), _JOG_SCALE)
+  sign = '-' if distance < 0 else ''
+  decimals = f'{fraction:0{_JOG_DECIMALS}d}'.rstrip('0')
+  return f'{axis.value}{sign}{whole}.{decimals}' if decimals else f'{axis.value}{sign}{whole}'
+
+
+@functools.lru_cache(maxsize=1024)
+def _step_jog_commands(moves: _QuantizedMoves) -> Tuple[command_mapping.Command, ...]:
+  gcode_moves = ' '.join(_gcode_word(axis, distance) for axis, distance in moves)
+  return (command_mapping.Command(('gcode', f'G91 {gcode_moves}')), _ABSOLUTE_MODE)
+
+
+@functools.lru_cache(maxsize=1024)
+def _continuous_jog_command(moves: _QuantizedMoves, feed_rate: int) -> command_mapping.Command:
+  gcode_moves = ' '.join(_gcode_word(axis, distance) for axis, distance in moves)
+  return command_mapping.Command(('gcode', f'$J=G91 {gcode_moves} F{feed_rate}'))
+
+
+def _jog_command(moves: _QuantizedMoves, duration: float) -> command_mapping.Command:
+  length = math.sqrt(sum(distance * distance for _, distance in moves)) / _JOG_SCALE
+  # Grbl feed rates are in units per minute
+  return _continuous_jog_command(moves, round(length * 60 / duration))
+
+
+def jog_command(moves: command_dispatch.Moves, duration: float) -> command_mapping.Command:
+  """Returns a Grbl jog command covering moves in the given duration (seconds)."""
+  return _jog_command(_quantize(moves), duration)
+
+
+def jog_commands(config: config_manager.ConfigObjects,
+                 jog: command_queue.PendingJog) -> Tuple[command_mapping.Command, ...]:
+  """Returns the commands to send for a (possibly merged) jog.
+
+  Distances are rounded to _JOG_DECIMALS decimals and the commands are cached,
+  so held inputs reuse the same strings and Command objects on every tick.
+  """
+  moves = _quantize((axis, jog.distances[axis])
+                    for axis in command_dispatch.MOVEMENT_AXES if jog.distances.get(axis))
+  if not moves:
+    return ()
+  if config.jog_mode == 'continuous':
+    # Each jog command lasts as long as the ticks it was generated for, so the
+    # next tick extends it while the input is held.
+    return (_jog_command(moves, jog.duration),)
+  return _step_jog_commands(moves)
+
+
+def _moves_allowed(config: config_manager.ConfigObjects,
+                   state: machine_state.MachineState) -> bool:
+  # Grbl runs $J jogs in its Jog state, but step moves in Run like any G-code
+  return state.jogs_allowed if config.jog_mode == 'continuous' else state.moves_allowed
+
+
+def get_commands(config: config_manager.ConfigObjects,
+                 state: Optional[machine_state.MachineState] = None
+                 ) -> Tuple[Tuple[command_mapping.Command, ...], command_dispatch.Moves]:
+  """Returns the commands and the jog moves requested by the gamepad.
+
+  When the machine state is known, jogs are dropped while the controller would
+  reject them (Alarm, Hold, a running program...), and so are commands rejected
+  in Alarm.
+  """
+  dispatch = config.dispatch
+  was_moving = bool(dispatch.moves)
+  commands, moves = dispatch.evaluate()
+  if config.jog_mode == 'continuous' and was_moving and not moves:
+    # Cancelling the jog flushes whatever Grbl still has queued, stopping the
+    # machine as soon as the input is released.
+    commands = (command_mapping.JOG_CANCEL,) + commands
+  if state is not None:
+    if moves and not _moves_allowed(config, state):
+      moves = ()
+    if commands and not state.gcode_allowed:
+      commands = tuple(command for command in commands if state.accepts(command))
+  return commands, moves
+
+
+async def stop_motion(sio: cncjs_sio.CNCjs_SIO, config: config_manager.ConfigObjects) -> None:
+  """Stops the moves the pendant sent to a Grbl controller, when the gamepad disconnects.
+
+  Continuous jogs are cancelled with jog cancel. Step moves are plain G-code,
+  which Grbl does not cancel that way: the feed is held, then once the machine
+  stopped its buffer is flushed by a soft reset, which keeps the position in a
+  completed hold. Nothing is sent to an Idle machine with no line waiting for an
+  answer, Grbl would enter a hold it does not leave on its own. If the hold is
+  not seen completing, the feed stays held.
+  """
+  if not sio.connected.is_set():
+    return
+  if config.jog_mode == 'continuous':
+    await sio.send_realtime(config.cnc_port, command_mapping.JOG_CANCEL)
+    return
+  state = sio.state
+  if state.workflow_state in machine_state.BUSY_WORKFLOW_STATES:
+    # Step moves are not sent while a program runs
+    return
+  if state.active_state == 'Idle' and not sio.queue.depth:
+    return
+  await sio.send_realtime(config.cnc_port, command_mapping.FEED_HOLD)
+  state.commanded(command_mapping.FEED_HOLD)
+  deadline = time.monotonic() + _HOLD_TIMEOUT
+  while not state.hold_complete:
+    if time.monotonic() > deadline:
+      _logger.warning(f'Feed held after the joystick disconnected, but the machine is still '
+                      f'{state.active_state}: resume or reset it')
+      return
+    await asyncio.sleep(_HOLD_POLL_INTERVAL)
+  await sio.send_realtime(config.cnc_port, command_mapping.SOFT_RESET)
+  # Grbl flushes the lines it has not answered, no answer will come for them
+  sio.queue.clear()
+  state.commanded(command_mapping.SOFT_RESET)
+  _logger.info('Stopped the moves sent before the joystick disconnected')
+
+
+async def send_pending(sio: cncjs_sio.CNCjs_SIO, config: config_manager.ConfigObjects,
+                       pending: command_queue.PendingCommands,
+                       tracker: latency.LatencyTracker,
+                       watcher: Optional[config_watch.ConfigWatcher] = None) -> None:
+  """Sends pending commands as soon as the controller has room for them.
+
+  Jogs stay in pending while the controller is busy, so later ticks are merged
+  into them instead of queueing more moves. When the machine position and the
+  work envelope are known, jogs are shortened to end inside the envelope. The
+  config is taken from watcher when given, so reloads apply to the next jog.
+  """
   while await sio.connected.wait():
-    commands = get_commands(config)
+    if watcher is not None:
+      config = watcher.configs[config.name]
+    if not pending:
+      pending.changed.clear()
+      await pending.changed.wait()
+      continue
+    item = pending.peek()
+    state = sio.state
+    if isinstance(item, command_queue.PendingJog):
+      if not _moves_allowed(config, state):
+        # The machine changed state while the jog was waiting for room
+        _logger.debug(f'Dropping jog in state {state.active_state}')
+        pending.pop()
+        continue
+      if config.envelope is not None:
+        state.limit_jog(item.distances, config.envelope)
+        # Rounded as in the G-code, so the planned position is where jogs end
+        for axis, distance in item.distances.items():
+          item.distances[axis] = round(distance, _JOG_DECIMALS)
+    commands = (jog_commands(config, item) if isinstance(item, command_queue.PendingJog)
+                else item)
+    lines = sum(command_queue.expected_acks(command) for command in commands)
+    if not sio.queue.has_room(lines):
+      pending.changed.clear()
+      try:
+        await asyncio.wait_for(pending.changed.wait(), sio.queue.ack_timeout)
+      except asyncio.TimeoutError:
+        pass
+      continue
+    queued_at, input_at = pending.peek_times()
+    pending.pop()
+    for command in commands:
+      await sio.send(config.cnc_port, command)
+    if commands:
+      if isinstance(item, command_queue.PendingJog):
+        state.jogged(item.distances)
+      else:
+        for command in commands:
+          state.commanded(command)
     if commands:
-      for command in commands:
-        await sio.client.emit('command', (config.cnc_port,) + command.arguments)
-    await sio.client.sleep(0.1)
+      sio.queue.served(pending.wake)
+      emitted_at = time.perf_counter()
+      tracker.record('emit', emitted_at - queued_at)
+      tracker.record('total', emitted_at - input_at)
+
+
+async def log_latency(tracker: latency.LatencyTracker, interval: float, name: str = '') -> None:
+  """Logs the latency statistics every interval seconds."""
+  while True:
+    await asyncio.sleep(interval)
+    tracker.log_report(name)
+
+
+async def run_pendant(config: config_manager.ConfigObjects, sio: cncjs_sio.CNCjs_SIO,
+                      replay: Optional[pathlib.Path] = None, replay_speed: float = 1.0,
+                      tracker: Optional[latency.LatencyTracker] = None,
+                      startup_timer: Optional[startup.StartupTimer] = None,
+                      watcher: Optional[config_watch.ConfigWatcher] = None) -> None:
+  """Turns the inputs of the (opened) gamepad into commands sent through sio.
+
+  When replay is set, inputs come from that recording instead of the gamepad.
+  Latencies are recorded in tracker, by default the one of sio. Several
+  pendants can run on the same loop, sharing sio or not. startup_timer is told
+  when the gamepad is ready. When watcher is given, the config of the pendant
+  is taken from it on every tick, so reloaded configs apply right away.
+  """
+  if tracker is None:
+    tracker = sio.latency
+  pad = config.gamepad
+  pad.attach_event_loop()
+  if replay:
+    asyncio.ensure_future(recording.replay(pad, replay, replay_speed))
+  elif config.reader == 'asyncio':
+    pad.start_event_loop_updates()
+  else:
+    pad.start_background_updates(wait_for_ready=False)
+  with (startup_timer.phase(f'joystick ready {config.name}') if startup_timer
+        else contextlib.nullcontext()):
+    if not replay:
+      await pad.wait_until_ready()
+  if startup_timer:
+    startup_timer.pendant_ready()
+  pending = command_queue.PendingCommands(max_distance=config.max_jog_distance)
+  sio.queue.ack_listeners.append(pending.wake)
+  sender = asyncio.ensure_future(send_pending(sio, config, pending, tracker, watcher))
+  # Real-time commands are sent from the gamepad callbacks, not from the ticks
+  lane = None
+  if config.realtime_lane:
+    lane = realtime.RealtimeLane(sio, config.cnc_port, pad, tracker, pending)
+    lane.set_mapping(config.mapped_commands)
+
+  def cancel_jog():
+    # The gamepad released every input, but moves already waiting to be sent
+    # and moves running on the controller must not outlive the gamepad either.
+    pending.discard_moves()
+    if config.controller_type == 'Grbl':
+      asyncio.ensure_future(stop_motion(sio, config))
+  pad.disconnected_callbacks.append(cancel_jog)
+  generation = pad.generation
+  # Held moves are queued once per repeat interval however many events arrive,
+  # right away when they start or change direction.
+  next_move_at = 0.0
+  move_directions: Tuple[Tuple[command_mapping.MovementAxis, bool], ...] = ()
+  try:
+    while await sio.connected.wait():
+      if watcher is not None and watcher.configs[config.name] is not config:
+        config = watcher.configs[config.name]
+        pending.max_distance = config.max_jog_distance
+        if lane:
+          lane.set_mapping(config.mapped_commands)
+      commands, moves = get_commands(config, sio.state)
+      if pad.generation != generation:
+        # Woken up by new events rather than by the repeat interval
+        generation = pad.generation
+        input_at = pad.last_read_time
+        tracker.record('read', pad.last_update_time - input_at)
+        tracker.record('dispatch', time.perf_counter() - pad.last_update_time)
+      else:
+        input_at = None
+      if commands:
+        pending.put_commands(commands, input_at)
+      timeout = config.repeat_interval if commands else None
+      if moves:
+        now = time.monotonic()
+        directions = tuple((axis, distance > 0) for axis, distance in moves)
+        if now >= next_move_at or directions != move_directions:
+          pending.put_moves(moves, config.repeat_interval, input_at)
+          next_move_at = now + config.repeat_interval
+          move_directions = directions
+        timeout = next_move_at - now
+      else:
+        move_directions = ()
+      # Sleep until the gamepad changes. While something is being held, wake up
+      # again after the repeat interval so held jogs keep moving the machine.
+      await pad.wait_for_update(timeout)
+  finally:
+    sender.cancel()
+    if lane:
+      lane.close()
+    sio.queue.ack_listeners.remove(pending.wake)
+    pad.disconnected_callbacks.remove(cancel_jog)
+
+
+def create_clients(configs: Sequence[config_manager.ConfigObjects]
+                   ) -> Dict[Tuple[str, str], cncjs_sio.CNCjs_SIO]:
+  """Returns a client for each server address and CNC port, shared by the pendants using it.
+
+  CNCjs does not say which port its events come from, so each port gets its
+  own connection, and with it its own machine state and flow control. The
+  pendants of a port share its flow control, with room for the lines of all
+  of them.
+  """
+  max_in_flight = collections.Counter()
+  for config in configs:
+    max_in_flight[config.address, config.cnc_port] += config.max_in_flight
+  return {key: cncjs_sio.CNCjs_SIO(max_in_flight=limit)
+          for key, limit in max_in_flight.items()}
+
+
+async def main(args: argparse.Namespace):
+  timer = startup.StartupTimer(report=args.measure_startup)
+  # The networking libraries are imported in a thread, while the config is
+  # read and the joysticks are opened.
+  imports = asyncio.ensure_future(timer.measure(
+    'network imports', asyncio.get_event_loop().run_in_executor(
+      None, cncjs_sio.import_dependencies)))
+
+  # Open config files
+  with timer.phase('config'):
+    config_path = pathlib.Path('~/.cncjs-py-pendant-config').expanduser().resolve()
+    if not config_path.exists():
+      with config_path.open('w') as config_file:
+        config_manager.write_default_config(config_file)
+
+    with config_path.open('r') as config_file:
+      configs = config_manager.get_configs(config_file)
+  if len(configs) > 1 and (args.record or args.replay):
+    sys.exit('--record and --replay need a config with a single pendant')
+  timer.pendants = len(configs)
+  if args.record:
+    # Set before opening, the evdev api records the initial state on open
+    configs[0].gamepad.recorder = recording.Recorder(args.record.open('wb'))
+
+  gamepads = asyncio.gather(*(
+    timer.measure(f'joystick open {config.name}', config.gamepad.open())
+    for config in configs if not args.replay))
+  await imports
+  with timer.phase('access token'):
+    cncrc_config = pathlib.Path('~/.cncrc').expanduser().resolve()
+    with cncrc_config.open('r') as f:
+      token = cncjs_sio.generate_access_token_from_cncrc(f)
+
+  clients = create_clients(configs)
+  await asyncio.gather(*(timer.measure(f'connect {address} {port}', sio.connect(address, token))
+                         for (address, port), sio in clients.items()))
+  await gamepads
+  for (address, port), sio in clients.items():
+    sio.macros = cncjs_sio.MacroCache(address, token, ttl=min(
+      config.macro_refresh for config in configs
+      if (config.address, config.cnc_port) == (address, port)))
+    sio.macros.start()
+
+  # SIGTERM stops the pendant like Ctrl+C, through the cleanup below
+  loop = asyncio.get_event_loop()
+  loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+  try:
+    # A single pendant uses the latency tracker of its client. With several,
+    # each pendant has its own and the clients only measure the echo stage.
+    trackers: Dict[str, latency.LatencyTracker] = {}
+    for config in configs:
+      sio = clients[config.address, config.cnc_port]
+      if not sio.ports:
+        with timer.phase(f'open port {config.name}'):
+          await sio.open_port(config.cnc_port, config.baudrate, config.controller_type)
+      trackers[config.name] = sio.latency if len(configs) == 1 else latency.LatencyTracker()
+      if config.latency_report:
+        asyncio.ensure_future(log_latency(trackers[config.name], config.latency_report,
+                                          config.name if len(configs) > 1 else ''))
+
+    def log_reports():
+      if len(configs) == 1:
+        trackers[configs[0].name].log_report()
+        return
+      for name, tracker in trackers.items():
+        tracker.log_report(name)
+      for (address, port), sio in clients.items():
+        sio.latency.log_report(f'{address} {port}')
+
+    # Latency statistics are logged on SIGUSR1, and periodically if configured.
+    loop.add_signal_handler(signal.SIGUSR1, log_reports)
+    # The config is reloaded when the file changes, or on SIGHUP
+    watcher = config_watch.ConfigWatcher(config_path, configs)
+    asyncio.ensure_future(watcher.watch())
+    loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(watcher.reload()))
+    await asyncio.gather(*(
+      run_pendant(config, clients[config.address, config.cnc_port], replay=args.replay,
+                  replay_speed=args.replay_speed, tracker=trackers[config.name],
+                  startup_timer=timer, watcher=watcher)
+      for config in configs))
+  finally:
+    await asyncio.gather(*(sio.macros.close() for sio in clients.values()))
+    await asyncio.gather(*(sio.client.disconnect() for sio in clients.values()))
+    if configs[0].gamepad.recorder is not None:
+      configs[0].gamepad.recorder.close()
 
 if __name__ == '__main__':
-  asyncio.run(main())
+  parser = argparse.ArgumentParser(description='CNCjs pendant for joysticks')
+  parser.add_argument('--record', type=pathlib.Path,
+                      help='write the raw joystick events to this file')
+  parser.add_argument('--replay', type=pathlib.Path,
+                      help='read joystick events from this recording instead of the joystick')
+  parser.add_argument('--replay-speed', type=float, default=1.0,
+                      help='replay speed multiplier, 0 replays as fast as possible')
+  parser.add_argument('--measure-startup', action='store_true',
+                      help='log the time spent in each startup phase')
+  asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,129 @@
+"""Priority lane for real-time commands: feed hold, cycle start, soft reset and jog cancel.
+
+Commands from the gamepad normally wait for the next tick of the pendant, then
+in PendingCommands behind the jogs and commands queued before them, which wait
+for room in the controller. That is fine for moves, not for stopping the
+machine. Grbl acts on real-time commands as soon as they reach it and does not
+answer them, so nothing is gained by holding them back.
+
+Buttons mapped only to real-time commands (see MappedCommand.is_realtime) are
+left out of the DispatchTable and handled by a RealtimeLane instead. It sends
+them from the pressed callbacks of the gamepad reader: the press is applied,
+the callback hands the commands to the event loop, which emits them right
+away. Jogs not sent yet are dropped when the machine is told to stop.
+
+The time from reading the press to finishing the emit is recorded in the
+"realtime" latency stage. The pendant only logs commands over LATENCY_BUDGET:
+a late command is still sent, the machine has to stop anyway, and nothing else
+changes at run time. The budget is checked by tests/test_realtime.py, and by
+benchmarks/realtime_benchmark.py, which measures it against a stand-in server
+while jogs keep the controller busy.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+
+from typing import Callable, Dict, Optional, Tuple
+
+import cncjs_sio
+import command_mapping
+import command_queue
+import gamepad
+import latency
+
+
+_logger = logging.getLogger('cncjs-py-pendant')
+
+# Seconds from reading a real-time command press to finishing its emit, only
+# logged when exceeded
+LATENCY_BUDGET = 0.005
+
+# Real-time commands stopping the machine, which make pending jogs pointless
+_STOPPING_COMMANDS = frozenset((command_mapping.FEED_HOLD, command_mapping.SOFT_RESET,
+                                command_mapping.JOG_CANCEL))
+
+
+class RealtimeLane:
+  """Sends the real-time commands mapped to gamepad buttons as soon as they are pressed.
+
+  Attributes:
+    sio: client used to send the commands.
+    port: CNC port the commands are sent to.
+    tracker: records the "realtime" latency stage.
+    pending: commands of the regular path, whose jogs are dropped by stopping
+      commands. None if there are none.
+  """
+
+  def __init__(self, sio: cncjs_sio.CNCjs_SIO, port: str, pad: gamepad.Gamepad,
+               tracker: latency.LatencyTracker,
+               pending: Optional[command_queue.PendingCommands] = None):
+    self.sio = sio
+    self.port = port
+    self.tracker = tracker
+    self.pending = pending
+    self._gamepad = pad
+    self._loop = asyncio.get_event_loop()
+    self._loop_thread_id = threading.get_ident()
+    # Commands of each button number, replaced as a whole by set_mapping
+    self._commands: Dict[int, Tuple[command_mapping.Command, ...]] = {}
+    self._callbacks: Dict[int, Callable[[], None]] = {}
+
+  def set_mapping(self, mapped_commands: Tuple[command_mapping.MappedCommand, ...]) -> None:
+    """Sends the real-time commands of mapped_commands from now on.
+
+    Callbacks are added for new buttons only, so the mapping can be replaced
+    while the gamepad is being read."""
+    commands = {}
+    for action in mapped_commands:
+      if action.is_realtime():
+        button = self._gamepad._get_button_index(action.button)
+        commands[button] = commands.get(button, ()) + action.commands
+    self._commands = commands
+    for button in commands:
+      if button not in self._callbacks:
+        self._callbacks[button] = callback = self._pressed_callback(button)
+        self._gamepad.pressed_event_map.setdefault(button, []).append(callback)
+
+  def close(self) -> None:
+    """Stops sending commands, removing the gamepad callbacks."""
+    for button, callback in self._callbacks.items():
+      self._gamepad.pressed_event_map[button].remove(callback)
+    self._callbacks.clear()
+    self._commands = {}
+
+  def _pressed_callback(self, button: int) -> Callable[[], None]:
+    def pressed():
+      # Runs on the thread reading the gamepad
+      commands = self._commands.get(button)
+      if not commands:
+        return
+      input_at = self._gamepad.last_read_time
+      if threading.get_ident() == self._loop_thread_id:
+        self._send(commands, input_at)
+      else:
+        self._loop.call_soon_threadsafe(self._send, commands, input_at)
+    return pressed
+
+  def _send(self, commands: Tuple[command_mapping.Command, ...], input_at: float) -> None:
+    if not self.sio.connected.is_set():
+      _logger.warning(f'Not connected, dropping {commands}')
+      return
+    if self.pending is not None and any(command in _STOPPING_COMMANDS for command in commands):
+      self.pending.discard_moves()
+    if command_mapping.SOFT_RESET in commands:
+      # Grbl flushes the lines it has not answered, no answer will come for them
+      self.sio.queue.clear()
+    asyncio.ensure_future(self._emit(commands, input_at))
+
+  async def _emit(self, commands: Tuple[command_mapping.Command, ...], input_at: float) -> None:
+    for command in commands:
+      await self.sio.send_realtime(self.port, command)
+    for command in commands:
+      self.sio.state.commanded(command)
+    elapsed = time.perf_counter() - input_at
+    self.tracker.record('realtime', elapsed)
+    if elapsed > LATENCY_BUDGET:
+      _logger.warning(f'Real-time command {commands[0].arguments[0]!r} took '
+                      f'{elapsed * 1e3:.1f} ms, over the {LATENCY_BUDGET * 1e3:.0f} ms budget')
@@ -0,0 +1,105 @@
+"""Capture and replay of raw joystick sessions.
+
+A recording is a short header followed by the raw js events exactly as read
+from the device, or as translated from an event device by evdev_input, 8
+bytes each. Events carry the kernel timestamp in milliseconds, which replay
+uses to reproduce the original timing.
+"""
+
+import asyncio
+import pathlib
+import struct
+import threading
+import time
+
+import gamepad
+
+from typing import BinaryIO, Iterator, List, Tuple
+
+_MAGIC = b'CNCJSPJS'
+_VERSION = 1
+# magic, version, size of each event
+_HEADER = struct.Struct('<8sBB')
+
+
+class RecordingError(Exception):
+  """The file is not a joystick recording this version can read."""
+
+
+class Recorder:
+  """Appends raw joystick events to a recording file.
+
+  Every write is flushed, so a pendant that is killed leaves a complete
+  recording. Events are written by the thread reading the joystick, which may
+  still be running when the recorder is closed: later writes are ignored.
+  """
+
+  def __init__(self, output: BinaryIO):
+    self.output = output
+    self._lock = threading.Lock()
+    self.write(_HEADER.pack(_MAGIC, _VERSION, struct.calcsize(gamepad.Gamepad.EVENT_FORMAT)))
+
+  def write(self, raw_events: bytes) -> None:
+    with self._lock:
+      if self.output.closed:
+        return
+      self.output.write(raw_events)
+      self.output.flush()
+
+  def close(self) -> None:
+    with self._lock:
+      self.output.close()
+
+
+def read_events(recording: BinaryIO) -> Iterator[Tuple[int, int, int, int]]:
+  """Returns the raw events of a recording, in the Gamepad._get_next_event_raw format."""
+  header = recording.read(_HEADER.size)
+  if len(header) != _HEADER.size:
+    raise RecordingError('Recording is truncated')
+  magic, version, event_size = _HEADER.unpack(header)
+  if magic != _MAGIC or version != _VERSION:
+    raise RecordingError('Not a joystick recording')
+  event_struct = struct.Struct(gamepad.Gamepad.EVENT_FORMAT)
+  if event_size != event_struct.size:
+    raise RecordingError(f'Unexpected event size {event_size}')
+  data = recording.read()
+  return event_struct.iter_unpack(data[:len(data) - len(data) % event_size])
+
+
+def _batches(events) -> Iterator[List[Tuple[int, int, int, int]]]:
+  """Groups consecutive events with the same timestamp, as the driver reports them."""
+  batch: List[Tuple[int, int, int, int]] = []
+  for event in events:
+    if batch and event[0] != batch[0][0]:
+      yield batch
+      batch = []
+    batch.append(event)
+  if batch:
+    yield batch
+
+
+async def replay(pad: gamepad.Gamepad, path: pathlib.Path, speed: float = 1.0) -> int:
+  """Feeds a recording into the gamepad, returns the number of events replayed.
+
+  Events are applied on the running loop with their original timing divided by
+  speed, or as fast as possible when speed is 0. The gamepad must be attached
+  to the loop and must not be reading from a device.
+  """
+  with path.open('rb') as recording:
+    events = list(read_events(recording))
+  start = time.monotonic()
+  first_timestamp = events[0][0] if events else 0
+  for batch in _batches(events):
+    if speed:
+      # Kernel timestamps are milliseconds that wrap around at 32 bits
+      elapsed = ((batch[0][0] - first_timestamp) & 0xFFFFFFFF) / 1000 / speed
+      delay = start + elapsed - time.monotonic()
+      if delay > 0:
+        await asyncio.sleep(delay)
+    else:
+      # Let the pendant process each batch, as it would between device reads.
+      await asyncio.sleep(0)
+    pad.last_read_time = time.perf_counter()
+    pad._apply_events(batch)
+    pad._notify_updated()
+  return len(events)
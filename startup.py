@@ -0,0 +1,81 @@
+"""Time spent in each phase of the pendant startup, for pendant.py --measure-startup.
+
+Phases may overlap, for instance the joystick is opened while connecting to
+the server, so each one is reported with its start and end times. Times are
+relative to the start of the process when /proc tells it, to the creation of
+the timer otherwise.
+"""
+
+import contextlib
+import logging
+import os
+import time
+
+from typing import Awaitable, Iterator, List, Optional, Tuple, TypeVar
+
+
+
+_logger = logging.getLogger('cncjs-py-pendant')
+
+_T = TypeVar('_T')
+
+
+def _process_age() -> Optional[float]:
+  """Returns the seconds since the process started, None if unknown."""
+  try:
+    with open('/proc/self/stat') as stat:
+      # The fields after the command name, which may contain spaces
+      fields = stat.read().rsplit(')', 1)[1].split()
+    with open('/proc/uptime') as uptime:
+      uptime_seconds = float(uptime.read().split()[0])
+    # Field 22 of stat, the start time in clock ticks since boot
+    return uptime_seconds - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+  except (OSError, ValueError, IndexError):
+    return None
+
+
+class StartupTimer:
+  """Records startup phases and logs them once every pendant is ready.
+
+  Attributes:
+    phases: (name, start, end) of each finished phase, in seconds since the start.
+    pendants: number of pendant_ready calls to wait for before logging.
+    report: whether to log the phases at all.
+  """
+
+  def __init__(self, pendants: int = 1, report: bool = True):
+    now = time.perf_counter()
+    age = _process_age()
+    self.start = now - (age if age is not None else 0.0)
+    self.phases: List[Tuple[str, float, float]] = []
+    if age is not None:
+      self.phases.append(('interpreter and imports', 0.0, age))
+    self.pendants = pendants
+    self.report = report
+
+  @contextlib.contextmanager
+  def phase(self, name: str) -> Iterator[None]:
+    """Context manager measuring a phase, can be used around awaits."""
+    start = time.perf_counter() - self.start
+    try:
+      yield
+    finally:
+      self.phases.append((name, start, time.perf_counter() - self.start))
+
+  async def measure(self, name: str, awaitable: Awaitable[_T]) -> _T:
+    """Awaits awaitable as a phase, to run phases concurrently with gather."""
+    with self.phase(name):
+      return await awaitable
+
+  def pendant_ready(self) -> None:
+    """Marks a pendant as able to jog, logs the report after the last one."""
+    self.pendants -= 1
+    if self.pendants == 0 and self.report:
+      self.log_report()
+
+  def log_report(self) -> None:
+    total = max((end for _, _, end in self.phases), default=0.0)
+    for name, start, end in sorted(self.phases, key=lambda phase: phase[1]):
+      _logger.info(f'Startup {name:<32} {start * 1e3:8.1f} -> {end * 1e3:8.1f} ms '
+                   f'({(end - start) * 1e3:.1f} ms)')
+    _logger.info(f'Startup total {total * 1e3:.1f} ms')
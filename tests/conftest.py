@@ -0,0 +1,6 @@
+"""The pendant modules live at the top of the repository, like pendant.py imports them."""
+
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
@@ -0,0 +1,15 @@
+"""CNCjs_SIO without a server and pendant configs for the tests, shared with the benchmarks."""
+
+from typing import Dict, Optional
+
+import config_manager
+
+from benchmarks import harness
+
+FakeSIO = harness.StandInSIO
+
+
+def pendant_config(device_options: Optional[Dict[str, str]] = None
+                   ) -> config_manager.ConfigObjects:
+  """Returns the pendant of the default config, with device option overrides."""
+  return harness.pendant_config(None, device_options)
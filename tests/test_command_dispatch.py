@@ -0,0 +1,65 @@
+import command_mapping
+import gamepad
+
+from fake_sio import pendant_config
+
+FILTERS = {'hysteresis': '0.05', 'smoothing': '0.5', 'radial deadzone': '0.15'}
+
+
+def _table(device_options):
+  config = pendant_config(device_options)
+  pad = config.gamepad
+  pad._apply_events(tuple((0, 0, gamepad.Gamepad.EVENT_CODE_INIT_AXIS, index)
+                          for index in pad.axis_names))
+  return pad, config.dispatch
+
+
+def _move(pad, values):
+  pad._apply_events(tuple((0, int(value * gamepad.Gamepad.MAX_AXIS),
+                           gamepad.Gamepad.EVENT_CODE_AXIS, pad.axis_index[label])
+                          for label, value in values.items()))
+
+
+def _distances(moves):
+  return {axis: abs(distance) for axis, distance in moves}
+
+
+def test_filters_pass_a_deliberate_diagonal_unchanged():
+  moves = {}
+  for options in ({}, FILTERS):
+    pad, table = _table(options)
+    _move(pad, {'LEFT-X': 0.5, 'LEFT-Y': -0.5})
+    moves[bool(options)] = table.evaluate()[1]
+  assert moves[True] == moves[False]
+  assert _distances(moves[True]) == {command_mapping.MovementAxis.X: 1,
+                                     command_mapping.MovementAxis.Y: 1}
+
+
+def test_radial_deadzone_ignores_a_stick_resting_off_center():
+  pad, table = _table(FILTERS)
+  _move(pad, {'LEFT-X': 0.11, 'LEFT-Y': -0.08})
+  assert table.evaluate()[1] == ()
+
+
+def test_smoothing_never_delays_a_push_or_a_release():
+  pad, table = _table({'smoothing': '0.5'})
+  _move(pad, {'LEFT-X': 0.9})
+  assert _distances(table.evaluate()[1]) == {command_mapping.MovementAxis.X: 10}
+  # A drop is smoothed over the next ticks
+  _move(pad, {'LEFT-X': 0.5})
+  assert _distances(table.evaluate()[1]) == {command_mapping.MovementAxis.X: 1}
+  _move(pad, {'LEFT-X': 0.0})
+  assert table.evaluate()[1] == ()
+  # Pushing again starts from the new value, not from the release
+  _move(pad, {'LEFT-X': 0.9})
+  assert _distances(table.evaluate()[1]) == {command_mapping.MovementAxis.X: 10}
+
+
+def test_smoothing_keeps_evaluating_until_it_converges():
+  pad, table = _table({'smoothing': '0.5'})
+  _move(pad, {'LEFT-X': 0.9})
+  table.evaluate()
+  _move(pad, {'LEFT-X': 0.3})
+  distances = [_distances(table.evaluate()[1]) for _ in range(4)]
+  # 0.6, then 0.45, 0.375 and below: the gamepad did not change in between
+  assert [distance[command_mapping.MovementAxis.X] for distance in distances] == [1, 1, 0.1, 0.1]
@@ -0,0 +1,93 @@
+import pytest
+
+import command_mapping
+
+CURVES = (
+  command_mapping.ResponseCurve('linear'),
+  command_mapping.ResponseCurve('exponential'),
+  # Unsorted points, and a vertical step at 0.3
+  command_mapping.ResponseCurve('piecewise', ((0.8, 0.4), (0.0, 0.2), (0.3, 0.3),
+                                              (0.3, 0.6), (1.0, 1.0))),
+  command_mapping.ResponseCurve('piecewise', ((0.2, 0.1), (0.9, 0.7))),
+)
+RAW_VALUES = (-32768, -32767, -20000, -3277, -3276, -1, 0, 1, 3276, 3277, 16384, 32766, 32767)
+
+
+def _expected(curve, raw, slow, fast, start, use_absolute_input):
+  value = raw / 32767
+  value = abs(value) if use_absolute_input else (value + 1) / 2
+  return curve.step((value - start) / (1 - start), slow, fast)
+
+
+@pytest.mark.parametrize('curve', CURVES)
+@pytest.mark.parametrize('start,use_absolute_input', [(0.1, True), (0.0, True), (0.0, False),
+                                                      (0.25, False)])
+def test_distance_table_matches_curve(curve, start, use_absolute_input):
+  table = command_mapping._distance_table(curve, 0.01, 20.0, start, use_absolute_input)
+  assert len(table) == 65536
+  for raw in RAW_VALUES:
+    assert table[raw + 32768] == pytest.approx(
+      _expected(curve, raw, 0.01, 20.0, start, use_absolute_input), abs=1e-9)
+
+
+def test_piecewise_interpolates_sorted_points():
+  curve = CURVES[2]
+  assert curve.step(-1, 0, 1) == 0.2
+  assert curve.step(0.15, 0, 1) == pytest.approx(0.25)
+  assert curve.step(0.3, 0, 1) == pytest.approx(0.3)
+  assert curve.step(0.55, 0, 1) == pytest.approx(0.5)
+  assert curve.step(2, 0, 1) == 1.0
+
+
+def test_exponential_curve_ends_at_steps():
+  curve = command_mapping.ResponseCurve('exponential')
+  assert curve.step(0, 0.1, 10) == pytest.approx(0.1)
+  assert curve.step(0.5, 0.1, 10) == pytest.approx(1.0)
+  assert curve.step(1, 0.1, 10) == pytest.approx(10)
+
+
+def test_travel_distance_uses_table():
+  axis = command_mapping.MagnitudeAxis(label='X', slow_move_step=1, fast_move_step=3,
+                                       trigger_if_above=0.5, use_absolute_input=True,
+                                       curve=command_mapping.ResponseCurve('linear'))
+  assert axis.travel_distance(0.2) == 1
+  assert axis.travel_distance(-0.75) == pytest.approx(2, abs=1e-3)
+  assert axis.travel_distance(1.0) == 3
+
+
+def test_hysteresis_delays_leaving_the_trigger_only():
+  axis = command_mapping.MagnitudeAxis(trigger_if_above=0.1, use_absolute_input=True,
+                                       hysteresis=0.05)
+  # Crossing forward triggers at the threshold itself
+  assert axis.has_triggered(0.11)
+  assert not axis.has_triggered(0.09)
+  # Once triggered, the input must go back past the threshold minus hysteresis
+  assert axis.has_triggered(0.07, was_triggered=True)
+  assert axis.has_triggered(-0.07, was_triggered=True)
+  assert not axis.has_triggered(0.04, was_triggered=True)
+
+
+def test_hysteresis_delays_going_back_to_a_slower_step():
+  axis = command_mapping.MagnitudeAxis(slow_when_below=0.4, fast_when_above=0.8,
+                                       hysteresis=0.05)
+  # Going up changes steps at the thresholds, as without hysteresis
+  assert axis.travel_distance(0.41, previous=axis.slow_move_step) == axis.mid_move_step
+  assert axis.travel_distance(0.81, previous=axis.mid_move_step) == axis.fast_move_step
+  # Going down needs hysteresis more
+  assert axis.travel_distance(0.78, previous=axis.fast_move_step) == axis.fast_move_step
+  assert axis.travel_distance(0.74, previous=axis.fast_move_step) == axis.mid_move_step
+  assert axis.travel_distance(0.38, previous=axis.mid_move_step) == axis.mid_move_step
+  assert axis.travel_distance(0.34, previous=axis.mid_move_step) == axis.slow_move_step
+  assert axis.travel_distance(0.34, previous=axis.fast_move_step) == axis.slow_move_step
+  # Staying on a step is not affected
+  assert axis.travel_distance(0.78, previous=axis.mid_move_step) == axis.mid_move_step
+  assert axis.travel_distance(0.39, previous=axis.slow_move_step) == axis.slow_move_step
+
+
+def test_radial_deadzone_centers_drift_and_passes_a_diagonal():
+  deadzone = command_mapping.RadialDeadzone(x='LEFT-X', y='LEFT-Y', radius=0.15)
+  assert deadzone.apply(0.08, -0.08) == (0.0, 0.0)
+  assert deadzone.apply(0.12, 0.12) == (0.12, 0.12)
+  assert deadzone.apply(-0.5, 0.5) == (-0.5, 0.5)
+  with pytest.raises(ValueError):
+    command_mapping.RadialDeadzone(x='LEFT-X', y='LEFT-Y', radius=1.0)
@@ -0,0 +1,133 @@
+import asyncio
+
+import pytest
+
+import command_mapping
+import command_queue
+
+JOG = command_mapping.Command(('gcode', 'G91 X1 F100'))
+
+
+async def _waits(queue, lines=1):
+  """Whether wait_for_room is still waiting after the loop ran a few times."""
+  waiting = asyncio.ensure_future(queue.wait_for_room(lines))
+  for _ in range(3):
+    await asyncio.sleep(0)
+  done = waiting.done()
+  waiting.cancel()
+  return not done
+
+
+@pytest.mark.parametrize('command,acks', [
+  (command_mapping.Command(('gcode', 'G91 X1 F100')), 1),
+  (command_mapping.Command(('gcode', 'G91\nG0 X1\n\n  \nG90\n')), 3),
+  (command_mapping.Command(('homing',)), 1),
+  (command_mapping.Command(('unlock',)), 1),
+  (command_mapping.FEED_HOLD, 0),
+  (command_mapping.JOG_CANCEL, 0),
+  # CNCjs feeds the lines of macros itself
+  (command_mapping.macro('CROSS', 'Probe').commands[0], 0),
+])
+def test_expected_acks(command, acks):
+  assert command_queue.expected_acks(command) == acks
+
+
+def test_ok_and_error_answer_one_line_each():
+  queue = command_queue.CommandQueue()
+  queue.sent(command_mapping.Command(('gcode', 'G0 X1\nG0 X2\nG0 X3')))
+  assert queue.depth == 3
+  queue.serial_read('ok')
+  queue.serial_read('error:20')
+  queue.serial_read('<Idle|MPos:0.000,0.000,0.000>')
+  assert queue.depth == 1
+  queue.serial_read('ok')
+  # Answers nothing was sent for are ignored
+  queue.serial_read('ok')
+  assert queue.depth == 0
+
+
+def test_wait_for_room_blocks_at_max_in_flight():
+  async def run():
+    queue = command_queue.CommandQueue(max_in_flight=2)
+    queue.sent(JOG)
+    assert not await _waits(queue)
+    queue.sent(JOG)
+    assert not queue.has_room()
+    assert await _waits(queue)
+    waiting = asyncio.ensure_future(queue.wait_for_room())
+    await asyncio.sleep(0)
+    queue.serial_read('ok')
+    await asyncio.wait_for(waiting, 1)
+    # A command larger than the limit waits until nothing is outstanding
+    assert await _waits(queue, 5)
+    queue.serial_read('ok')
+    assert not await _waits(queue, 5)
+  asyncio.run(run())
+
+
+def test_unanswered_lines_are_released_after_the_timeout():
+  async def run():
+    queue = command_queue.CommandQueue(max_in_flight=1, ack_timeout=0.05)
+    queue.sent(JOG)
+    assert queue.depth == 1
+    await asyncio.wait_for(queue.wait_for_room(), 1)
+    assert queue.depth == 0
+  asyncio.run(run())
+
+
+def test_clear_forgets_lines_and_wakes_waiters():
+  async def run():
+    queue = command_queue.CommandQueue(max_in_flight=1)
+    queue.sent(JOG)
+    waiting = asyncio.ensure_future(queue.wait_for_room())
+    await asyncio.sleep(0)
+    queue.clear()
+    await asyncio.wait_for(waiting, 1)
+    assert queue.depth == 0
+  asyncio.run(run())
+
+
+X = command_mapping.MovementAxis.X
+Y = command_mapping.MovementAxis.Y
+HOMING = (command_mapping.Command(('homing',)),)
+
+
+def test_consecutive_moves_are_merged():
+  pending = command_queue.PendingCommands()
+  pending.put_moves(((X, 1.0),), 0.1)
+  pending.put_moves(((X, 1.0), (Y, -0.1)), 0.1)
+  assert len(pending) == 1
+  jog = pending.pop()
+  assert jog.distances == {X: 2.0, Y: -0.1}
+  assert jog.duration == pytest.approx(0.2)
+
+
+def test_merged_moves_are_limited_to_max_distance():
+  pending = command_queue.PendingCommands(max_distance=10)
+  for _ in range(3):
+    pending.put_moves(((X, 4.0), (Y, -4.0)), 0.1)
+  jog = pending.pop()
+  assert jog.distances == {X: 10, Y: -10}
+  # The clamped move does not add to the jogging time
+  assert jog.duration == pytest.approx(0.2)
+
+
+def test_moves_are_not_merged_across_commands():
+  pending = command_queue.PendingCommands()
+  pending.put_moves(((X, 1.0),), 0.1)
+  pending.put_commands(HOMING)
+  pending.put_moves(((X, 1.0),), 0.1)
+  pending.put_moves(((X, 1.0),), 0.1)
+  assert len(pending) == 3
+  assert pending.pop().distances == {X: 1.0}
+  assert pending.pop() == HOMING
+  assert pending.pop().distances == {X: 2.0}
+
+
+def test_jog_cancel_drops_moves_not_sent_yet():
+  pending = command_queue.PendingCommands()
+  pending.put_moves(((X, 1.0),), 0.1)
+  pending.put_commands(HOMING)
+  pending.put_moves(((X, 1.0),), 0.1)
+  pending.put_commands((command_mapping.JOG_CANCEL,))
+  assert [pending.pop() for _ in range(len(pending))] == [HOMING, (command_mapping.JOG_CANCEL,)]
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import os
+import signal
+
+import pytest
+
+import config_manager
+import config_watch
+
+
+@pytest.fixture
+def config_path(tmp_path):
+  path = tmp_path / 'pendant.ini'
+  with path.open('w') as config_file:
+    config_manager.write_default_config(config_file)
+  return path
+
+
+def _edit(path, old, new):
+  text = path.read_text()
+  assert old in text
+  path.write_text(text.replace(old, new))
+
+
+def _watcher(path):
+  with path.open() as config_file:
+    return config_watch.ConfigWatcher(path, config_manager.get_configs(config_file),
+                                      interval=0.01)
+
+
+async def _wait_for_swap(watcher, configs):
+  for _ in range(100):
+    if watcher.configs is not configs:
+      return
+    await asyncio.sleep(0.01)
+  raise AssertionError('The config was not reloaded')
+
+
+def test_check_accepts_settings_applied_between_ticks(config_path):
+  watcher = _watcher(config_path)
+  _edit(config_path, 'repeat interval = 0.1', 'repeat interval = 0.2')
+  configs = watcher._load()
+  assert watcher._check(configs) is None
+  # The running gamepad is reused
+  assert configs[0].gamepad is watcher.configs['default'].gamepad
+
+
+@pytest.mark.parametrize('old,new,field', [
+  ('cnc port = /dev/ttyACM0', 'cnc port = /dev/ttyUSB0', 'cnc_port'),
+  ('max in flight = 4', 'max in flight = 8', 'max_in_flight'),
+  ('reader = thread', 'reader = asyncio', 'reader'),
+])
+def test_check_rejects_settings_that_need_a_restart(config_path, old, new, field):
+  watcher = _watcher(config_path)
+  _edit(config_path, old, new)
+  assert field in watcher._check(watcher._load())
+
+
+def test_check_rejects_adding_a_pendant(config_path):
+  watcher = _watcher(config_path)
+  with config_path.open('a') as config_file:
+    config_file.write('\n[pendant second]\ncnc port = /dev/ttyUSB0\n')
+  assert 'adding or removing' in watcher._check(watcher._load())
+
+
+def test_changed_file_is_swapped_in_between_ticks(config_path):
+  async def run():
+    watcher = _watcher(config_path)
+    configs = watcher.configs
+    previous = configs['default']
+    watching = asyncio.ensure_future(watcher.watch())
+    _edit(config_path, 'max jog distance = 10', 'max jog distance = 2.5')
+    # Pendants read watcher.configs once per tick: the dict they read is never changed
+    await _wait_for_swap(watcher, configs)
+    watching.cancel()
+    assert configs['default'] is previous
+    return watcher.configs['default'], previous
+  config, previous = asyncio.run(run())
+  assert config.max_jog_distance == 2.5
+  assert config.gamepad is previous.gamepad
+
+
+def test_sighup_reloads_an_unchanged_version(config_path):
+  async def run():
+    watcher = _watcher(config_path)
+    configs = watcher.configs
+    version = watcher._version
+    _edit(config_path, 'repeat interval = 0.1', 'repeat interval = 0.2')
+    # Same version as when the watcher started, so only SIGHUP can notice it
+    os.utime(config_path, ns=(version[0], version[0]))
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(watcher.reload()))
+    watching = asyncio.ensure_future(watcher.watch())
+    try:
+      await asyncio.sleep(0.05)
+      assert watcher.configs is configs
+      os.kill(os.getpid(), signal.SIGHUP)
+      await _wait_for_swap(watcher, configs)
+    finally:
+      watching.cancel()
+      loop.remove_signal_handler(signal.SIGHUP)
+    return watcher
+  assert asyncio.run(run()).configs['default'].repeat_interval == 0.2
+
+
+@pytest.mark.parametrize('old,new', [
+  ('repeat interval = 0.1', 'repeat interval = fast'),
+  ('[device]', '[device'),
+  ('cnc port = /dev/ttyACM0', 'cnc port = /dev/ttyUSB0'),
+])
+def test_reload_keeps_the_last_good_config(config_path, caplog, old, new):
+  async def run():
+    watcher = _watcher(config_path)
+    configs = watcher.configs
+    _edit(config_path, old, new)
+    with caplog.at_level(logging.ERROR):
+      assert not await watcher.reload()
+    assert watcher.configs is configs
+  asyncio.run(run())
+  assert 'Keeping the last good config' in caplog.text
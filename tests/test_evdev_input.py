@@ -0,0 +1,125 @@
+import errno
+import struct
+import time
+
+import pytest
+
+import evdev_input
+
+FD = 7
+BTN_A = 0x130
+BTN_B = 0x131
+BTN_MODE = 0x13c
+BTN_MISC = 0x100
+ABS_X = 0x00
+ABS_Y = 0x01
+JS_BUTTON = evdev_input._JS_EVENT_BUTTON
+JS_AXIS = evdev_input._JS_EVENT_AXIS
+JS_INIT = evdev_input._JS_EVENT_INIT
+
+
+class FakeDevice:
+  """Answers the ioctls of open_device and EvdevDevice like an event device would."""
+
+  def __init__(self, clock_id_supported=True):
+    self.keys = {BTN_MISC, BTN_A, BTN_B, BTN_MODE}
+    self.pressed = {BTN_B}
+    # code: value, minimum, maximum, fuzz, flat, resolution
+    self.absinfo = {ABS_X: [128, 0, 255, 0, 15, 0], ABS_Y: [0, -100, 100, 0, 0, 0]}
+    self.clock_id_supported = clock_id_supported
+    self.clock_id = None
+
+  @staticmethod
+  def _fill(buffer, codes):
+    for code in codes:
+      buffer[code // 8] |= 1 << code % 8
+
+  def ioctl(self, fd, request, argument):
+    assert fd == FD
+    assert request >> 8 & 0xff == ord('E')
+    number = request & 0xff
+    size = request >> 16 & 0x3fff
+    if request == evdev_input._EVIOCSCLOCKID:
+      if not self.clock_id_supported:
+        raise OSError(errno.EINVAL, 'Invalid argument')
+      (self.clock_id,) = struct.unpack('i', argument)
+      return 0
+    assert size == len(argument)
+    if number == evdev_input._EVIOCGBIT + evdev_input._EV_KEY:
+      self._fill(argument, self.keys)
+    elif number == evdev_input._EVIOCGBIT + evdev_input._EV_ABS:
+      self._fill(argument, self.absinfo)
+    elif number == evdev_input._EVIOCGKEY:
+      self._fill(argument, self.pressed)
+    elif 0x40 <= number < 0x40 + evdev_input._ABS_MAX + 1:
+      argument[:] = evdev_input._ABSINFO_STRUCT.pack(*self.absinfo[number - 0x40])
+    else:
+      raise OSError(errno.ENOTTY, 'Inappropriate ioctl for device')
+    return 0
+
+
+@pytest.fixture
+def device(monkeypatch):
+  device = FakeDevice()
+  monkeypatch.setattr(evdev_input.fcntl, 'ioctl', device.ioctl)
+  return device
+
+
+def _events(*events):
+  return memoryview(b''.join(evdev_input.EVENT_STRUCT.pack(*event) for event in events))
+
+
+def test_open_device_numbers_inputs_like_joydev(device):
+  opened = evdev_input.open_device(FD)
+  # Joystick buttons first, then the miscellaneous ones
+  assert opened.buttons == {BTN_A: 0, BTN_B: 1, BTN_MODE: 2, BTN_MISC: 3}
+  assert [(code, axis.number) for code, axis in opened.axes.items()] == [(ABS_X, 0), (ABS_Y, 1)]
+  assert opened.axes[ABS_X].flat == 15
+  assert opened.monotonic
+  assert device.clock_id == time.CLOCK_MONOTONIC
+
+
+def test_open_device_keeps_the_wall_clock_when_it_cannot_be_changed(monkeypatch):
+  device = FakeDevice(clock_id_supported=False)
+  monkeypatch.setattr(evdev_input.fcntl, 'ioctl', device.ioctl)
+  assert not evdev_input.open_device(FD).monotonic
+
+
+def test_open_device_rejects_other_devices(monkeypatch):
+  def ioctl(fd, request, argument):
+    raise OSError(errno.ENOTTY, 'Inappropriate ioctl for device')
+  monkeypatch.setattr(evdev_input.fcntl, 'ioctl', ioctl)
+  with pytest.raises(OSError):
+    evdev_input.open_device(FD)
+
+
+def test_initial_events_read_the_current_state(device):
+  device.absinfo[ABS_Y][0] = 100
+  events = evdev_input.open_device(FD).initial_events()
+  assert [event[1:] for event in events] == [
+    (0, JS_BUTTON | JS_INIT, 0), (1, JS_BUTTON | JS_INIT, 1), (0, JS_BUTTON | JS_INIT, 2),
+    (0, JS_BUTTON | JS_INIT, 3), (0, JS_AXIS | JS_INIT, 0), (32767, JS_AXIS | JS_INIT, 1)]
+
+
+def test_decode_keeps_frames_whole(device):
+  opened = evdev_input.open_device(FD)
+  data = _events((5, 250999, evdev_input._EV_KEY, BTN_A, 1),
+                 (5, 250999, evdev_input._EV_ABS, ABS_Y, -100),
+                 (5, 250999, evdev_input._EV_SYN, evdev_input._SYN_REPORT, 0),
+                 (5, 260000, evdev_input._EV_KEY, BTN_A, 0))
+  events, consumed = opened.decode(data)
+  assert events == [(5250, 1, JS_BUTTON, 0), (5250, -32767, JS_AXIS, 1)]
+  assert consumed == 3 * evdev_input.EVENT_SIZE
+  assert opened.frame_time == pytest.approx(5.250999)
+
+
+def test_decode_resyncs_after_dropped_events(device):
+  opened = evdev_input.open_device(FD)
+  opened.initial_events()
+  device.pressed = {BTN_A}
+  events, _ = opened.decode(_events(
+    (6, 0, evdev_input._EV_SYN, evdev_input._SYN_DROPPED, 0),
+    (6, 0, evdev_input._EV_KEY, BTN_MODE, 1),
+    (6, 0, evdev_input._EV_SYN, evdev_input._SYN_REPORT, 0)))
+  # The events of the dropped frame are replaced by the changes read from the device
+  assert [event[1:] for event in events] == [(1, JS_BUTTON, 0), (0, JS_BUTTON, 1)]
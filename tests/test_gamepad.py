@@ -0,0 +1,69 @@
+import pytest
+
+import gamepad
+
+AXIS = 0
+
+
+class Clock:
+  def __init__(self):
+    self.now = 100.0
+
+  def __call__(self):
+    return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+  clock = Clock()
+  monkeypatch.setattr(gamepad.time, 'perf_counter', clock)
+  return clock
+
+
+@pytest.fixture
+def pad():
+  pad = gamepad.PS3()
+  # Held back callbacks run from the reading thread, as with the update thread
+  pad._reader_mode = 'thread'
+  pad._apply_events(((0, 0, gamepad.Gamepad.EVENT_CODE_INIT_AXIS, AXIS),))
+  return pad
+
+
+def _move(pad, *values):
+  pad._apply_events(tuple((0, value, gamepad.Gamepad.EVENT_CODE_AXIS, AXIS) for value in values))
+
+
+@pytest.mark.parametrize('coalesce', (False, True))
+def test_moved_callbacks_are_rate_limited_across_reads(clock, pad, coalesce):
+  pad.coalesce_axes = coalesce
+  pad.moved_callback_interval = 0.02
+  moves = []
+  pad.moved_event_map[AXIS] = [moves.append]
+  _move(pad, 100)
+  for value in (200, 300, 400):
+    clock.now += 0.005
+    _move(pad, value)
+  assert moves == [100 / gamepad.Gamepad.MAX_AXIS]
+  assert pad.axis(AXIS) == 400 / gamepad.Gamepad.MAX_AXIS
+
+  assert pad._run_moved_callbacks() == pytest.approx(0.005)
+  clock.now += 0.01
+  assert pad._run_moved_callbacks() is None
+  assert moves == [100 / gamepad.Gamepad.MAX_AXIS, 400 / gamepad.Gamepad.MAX_AXIS]
+
+
+def test_moved_callbacks_run_per_event_without_interval(pad):
+  moves = []
+  pad.moved_event_map[AXIS] = [moves.append]
+  _move(pad, 100, 200)
+  _move(pad, 300)
+  assert len(moves) == 3
+
+
+def test_events_applied_counts_coalesced_events(pad):
+  pad.coalesce_axes = True
+  applied = pad.events_applied
+  generation = pad.generation
+  _move(pad, 100, 200, 300)
+  assert pad.events_applied - applied == 3
+  assert pad.generation - generation == 1
@@ -0,0 +1,218 @@
+import pytest
+
+import command_mapping
+import machine_state
+
+X = command_mapping.MovementAxis.X
+Y = command_mapping.MovementAxis.Y
+ENVELOPE = command_mapping.WorkEnvelope(minimum=(-100, -100, -50), maximum=(0, 0, 0))
+SET_ZERO = command_mapping.Command(('gcode', 'G10 L20 P1 X0 Y0 Z0'))
+
+
+class Clock:
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self) -> float:
+    return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+  clock = Clock()
+  monkeypatch.setattr(machine_state.time, 'monotonic', clock)
+  return clock
+
+
+def _grbl_state(active_state, position=(-50.0, -50.0, -10.0)):
+  x, y, z = position
+  return {'status': {'activeState': active_state,
+                     'mpos': {'x': x, 'y': y, 'z': z}}}
+
+
+def _idle(position=(-50.0, -50.0, -10.0)):
+  """Returns the state of a machine that was homed, then moved to position."""
+  state = machine_state.MachineState()
+  state.controller_state('Grbl', _grbl_state('Home', (0.0, 0.0, 0.0)))
+  state.controller_state('Grbl', _grbl_state('Idle', position))
+  assert state.homed
+  return state
+
+
+def test_limit_jog_clamps_to_envelope(clock):
+  state = _idle((-1.0, -99.5, -10.0))
+  distances = {X: 10.0, Y: -10.0}
+  state.limit_jog(distances, ENVELOPE)
+  assert distances == {X: 1.0, Y: -0.5}
+
+
+def test_limit_jog_keeps_moves_inside_envelope(clock):
+  state = _idle()
+  distances = {X: 10.0, Y: -10.0}
+  state.limit_jog(distances, ENVELOPE)
+  assert distances == {X: 10.0, Y: -10.0}
+
+
+def test_limit_jog_starts_from_planned_position(clock):
+  state = _idle((-10.0, -50.0, -10.0))
+  state.jogged({X: 8.0})
+  distances = {X: 5.0}
+  state.limit_jog(distances, ENVELOPE)
+  assert distances == {X: 2.0}
+  # Moving away from the limit starts from the reported position
+  distances = {X: -95.0}
+  state.limit_jog(distances, ENVELOPE)
+  assert distances == {X: -90.0}
+
+
+def test_limit_jog_never_moves_further_out(clock):
+  state = _idle((1.0, -50.0, -10.0))
+  distances = {X: 5.0}
+  state.limit_jog(distances, ENVELOPE)
+  assert distances == {X: 0.0}
+
+
+def test_limit_jog_unknown_position_leaves_jog(clock):
+  state = machine_state.MachineState()
+  distances = {X: 500.0}
+  state.limit_jog(distances, ENVELOPE)
+  assert distances == {X: 500.0}
+
+
+def test_unhomed_machine_leaves_jogs(clock):
+  # Powered on or unlocked with $X, MPos starts at 0,0,0 wherever the machine is
+  state = machine_state.MachineState()
+  state.status_report('<Idle|MPos:0.000,0.000,0.000|FS:0,0>')
+  assert not state.homed
+  distances = {X: 10.0, Y: 10.0}
+  state.limit_jog(distances, ENVELOPE)
+  assert distances == {X: 10.0, Y: 10.0}
+
+
+def test_alarm_forgets_homing(clock):
+  state = _idle((0.0, 0.0, 0.0))
+  state.status_report('<Alarm|MPos:0.000,0.000,0.000|FS:0,0>')
+  state.status_report('<Idle|MPos:0.000,0.000,0.000|FS:0,0>')
+  assert not state.homed
+  distances = {X: 10.0}
+  state.limit_jog(distances, ENVELOPE)
+  assert distances == {X: 10.0}
+
+
+@pytest.mark.parametrize('command', [command_mapping.Command(('homing',)),
+                                     command_mapping.Command(('gcode', '$H'))])
+def test_homing_command_homes_once_idle(clock, command):
+  state = machine_state.MachineState()
+  state.status_report('<Idle|MPos:0.000,0.000,0.000|FS:0,0>')
+  state.commanded(command)
+  # An Idle report sent before the cycle started does not count
+  clock.now += 0.1
+  state.status_report('<Idle|MPos:0.000,0.000,0.000|FS:0,0>')
+  assert not state.homed
+  clock.now += machine_state._RESYNC_DELAY
+  state.status_report('<Idle|MPos:-1.000,-1.000,-1.000|FS:0,0>')
+  assert state.homed
+  distances = {X: 10.0}
+  state.limit_jog(distances, ENVELOPE)
+  assert distances == {X: 1.0}
+
+
+def test_stale_position_drops_jogs(clock):
+  state = _idle()
+  state.commanded(command_mapping.Command(('homing',)))
+  state.controller_state('Grbl', _grbl_state('Home'))
+  clock.now += 1
+  distances = {X: 5.0}
+  state.limit_jog(distances, ENVELOPE)
+  assert distances == {X: 0.0}
+  assert state.position_stale
+
+
+def test_idle_report_after_command_resyncs(clock):
+  state = _idle()
+  state.commanded(command_mapping.Command(('homing',)))
+  state.controller_state('Grbl', _grbl_state('Home'))
+  clock.now += 2
+  state.controller_state('Grbl', _grbl_state('Idle', (-5.0, -5.0, -5.0)))
+  assert not state.position_stale
+  distances = {X: 10.0}
+  state.limit_jog(distances, ENVELOPE)
+  assert distances == {X: 5.0}
+
+
+def test_idle_report_right_after_command_is_not_trusted(clock):
+  state = _idle()
+  state.commanded(SET_ZERO)
+  clock.now += 0.1
+  state.status_report('<Idle|MPos:-50.000,-50.000,-10.000|FS:0,0>')
+  assert state.position_stale
+
+
+def test_command_not_moving_the_machine_resyncs_without_new_report(clock):
+  state = _idle()
+  state.commanded(SET_ZERO)
+  distances = {X: -5.0}
+  state.limit_jog(distances, ENVELOPE)
+  assert distances == {X: 0.0}
+  # CNCjs reports no state change, the last Idle report is trusted after a while
+  clock.now += machine_state._RESYNC_DELAY + 0.1
+  distances = {X: -5.0}
+  state.limit_jog(distances, ENVELOPE)
+  assert distances == {X: -5.0}
+  assert not state.position_stale
+
+
+def test_no_resync_while_moving(clock):
+  state = _idle()
+  state.commanded(command_mapping.Command(('gcode', 'G0 X-90')))
+  state.controller_state('Grbl', _grbl_state('Run'))
+  clock.now += 5
+  distances = {X: -5.0}
+  state.limit_jog(distances, ENVELOPE)
+  assert distances == {X: 0.0}
+
+
+def test_held_back_jogs_are_logged_once(clock, caplog):
+  state = _idle()
+  state.commanded(SET_ZERO)
+  for _ in range(3):
+    state.limit_jog({X: 1.0}, ENVELOPE)
+  assert len([record for record in caplog.records if 'Holding back' in record.message]) == 1
+
+
+@pytest.mark.parametrize('active_state,jogs,moves,gcode', [
+  ('Idle', True, True, True),
+  ('Jog', True, True, True),
+  ('Run', False, True, True),
+  ('Hold', False, False, True),
+  ('Door', False, False, True),
+  ('Alarm', False, False, False),
+])
+def test_blocking_states(clock, active_state, jogs, moves, gcode):
+  state = machine_state.MachineState()
+  state.controller_state('Grbl', _grbl_state(active_state))
+  assert (state.jogs_allowed, state.moves_allowed, state.gcode_allowed) == (jogs, moves, gcode)
+
+
+def test_running_program_blocks_jogs_and_moves(clock):
+  state = _idle()
+  state.workflow('running')
+  assert not state.jogs_allowed
+  assert not state.moves_allowed
+  state.workflow('idle')
+  assert state.jogs_allowed and state.moves_allowed
+
+
+def test_alarm_only_accepts_recovery_and_realtime_commands(clock):
+  state = machine_state.MachineState()
+  state.status_report('<Alarm|MPos:0.000,0.000,0.000|FS:0,0>')
+  assert not state.accepts(command_mapping.Command(('gcode', 'G91 X1')))
+  assert not state.accepts(command_mapping.Command((command_mapping.MACRO_RUN, 'id')))
+  assert state.accepts(command_mapping.Command(('homing',)))
+  assert state.accepts(command_mapping.Command(('unlock',)))
+  assert state.accepts(command_mapping.JOG_CANCEL)
+
+
+def test_unknown_state_allows_everything():
+  state = machine_state.MachineState()
+  assert state.jogs_allowed and state.moves_allowed and state.gcode_allowed
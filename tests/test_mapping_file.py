@@ -0,0 +1,78 @@
+import json
+
+import pytest
+
+import mapping_file
+
+BUNDLED = mapping_file.DEFAULT_MAPPING_FILE
+
+
+def _cache_files(directory):
+  return sorted(directory.glob('*.json'))
+
+
+def test_cached_mappings_equal_parsed_ones(tmp_path):
+  parsed = mapping_file.parse_mappings(BUNDLED.read_bytes())
+  assert mapping_file.load_mappings(BUNDLED, tmp_path) == parsed
+  assert len(_cache_files(tmp_path)) == 1
+  assert mapping_file.load_mappings(BUNDLED, tmp_path) == parsed
+
+
+def test_cache_is_plain_json(tmp_path):
+  mapping_file.load_mappings(BUNDLED, tmp_path)
+  cached = json.loads(_cache_files(tmp_path)[0].read_bytes())
+  assert [mapping['gamepad'] for mapping in cached] == [
+    mapping.gamepad for mapping in mapping_file.parse_mappings(BUNDLED.read_bytes())]
+
+
+def test_cache_read_does_not_parse(tmp_path, monkeypatch):
+  mapping_file.load_mappings(BUNDLED, tmp_path)
+
+  def parse(content):
+    raise AssertionError('parsed again')
+  monkeypatch.setattr(mapping_file, 'parse_mappings', parse)
+  mapping_file.load_mappings(BUNDLED, tmp_path)
+
+
+@pytest.mark.parametrize('content', [b'', b'not json', b'[{"gamepad": "PS4"}]',
+                                     b'\x80\x04\x95pickle', b'[{"magnitudes": [[1, 2]]}]'])
+def test_broken_cache_is_a_miss(tmp_path, content):
+  mapping_file.load_mappings(BUNDLED, tmp_path)
+  cache = _cache_files(tmp_path)[0]
+  cache.write_bytes(content)
+  assert mapping_file.load_mappings(BUNDLED, tmp_path) == mapping_file.parse_mappings(
+    BUNDLED.read_bytes())
+  # Written again
+  assert json.loads(cache.read_bytes())
+
+
+def test_cache_key_depends_on_sources(tmp_path, monkeypatch):
+  mapping_file.load_mappings(BUNDLED, tmp_path)
+  monkeypatch.setattr(mapping_file, '_sources_hash', lambda: 'changed')
+  mapping_file.load_mappings(BUNDLED, tmp_path)
+  names = [cache.name for cache in _cache_files(tmp_path)]
+  assert len(names) == 2
+  assert any(name.endswith('-changed.json') for name in names)
+
+
+def test_edited_file_is_checked_again(tmp_path):
+  path = tmp_path / 'mappings.json'
+  document = json.loads(BUNDLED.read_bytes())
+  path.write_text(json.dumps(document))
+  mapping_file.load_mappings(path, tmp_path / 'cache')
+  document['mappings'][0]['commands'][0]['button'] = 'NOT-A-BUTTON'
+  path.write_text(json.dumps(document))
+  with pytest.raises(mapping_file.InvalidMappingError, match='unknown button'):
+    mapping_file.load_mappings(path, tmp_path / 'cache')
+
+
+def test_in_memory_cache_follows_edits(tmp_path, monkeypatch):
+  monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+  path = tmp_path / 'mappings.json'
+  document = json.loads(BUNDLED.read_bytes())
+  path.write_text(json.dumps(document))
+  first = mapping_file.load_mappings(path)
+  assert mapping_file.load_mappings(path) is first
+  document['mappings'][0]['cnc'] = 'Other'
+  path.write_text(json.dumps(document))
+  assert mapping_file.load_mappings(path)[0].cnc == 'Other'
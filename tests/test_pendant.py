@@ -0,0 +1,146 @@
+import asyncio
+import dataclasses
+
+import pytest
+
+import command_mapping
+import command_queue
+import pendant
+
+from fake_sio import FakeSIO, pendant_config
+
+PORT = '/dev/ttyACM0'
+X = command_mapping.MovementAxis.X
+Y = command_mapping.MovementAxis.Y
+Z = command_mapping.MovementAxis.Z
+
+
+def _emitted_commands(sio):
+  return [arguments[1] for _, arguments in sio.emitted]
+
+
+def test_stop_motion_cancels_continuous_jogs():
+  async def run():
+    sio = FakeSIO()
+    await pendant.stop_motion(sio, pendant_config({'jog mode': 'continuous'}))
+    return sio
+  sio = asyncio.run(run())
+  assert sio.emitted == [('write', (PORT, '\x85'))]
+
+
+def test_stop_motion_holds_then_resets_step_moves():
+  async def run():
+    sio = FakeSIO(answer=False)
+    sio.state.status_report('<Run|MPos:0.000,0.000,0.000|FS:500,0>')
+    sio.queue.sent(command_mapping.Command(('gcode', 'G91 X10')))
+    stop = asyncio.ensure_future(pendant.stop_motion(sio, pendant_config()))
+    await asyncio.sleep(0.01)
+    held = _emitted_commands(sio)
+    sio.state.status_report('<Hold:1|MPos:1.000,0.000,0.000|FS:100,0>')
+    await asyncio.sleep(pendant._HOLD_POLL_INTERVAL * 2)
+    decelerating = _emitted_commands(sio)
+    sio.state.status_report('<Hold:0|MPos:1.500,0.000,0.000|FS:0,0>')
+    await asyncio.wait_for(stop, 1)
+    return sio, held, decelerating
+  sio, held, decelerating = asyncio.run(run())
+  assert held == ['feedhold']
+  # A reset before the machine stopped would lose its position
+  assert decelerating == ['feedhold']
+  assert _emitted_commands(sio) == ['feedhold', 'reset']
+  assert sio.queue.depth == 0
+
+
+def test_stop_motion_keeps_feed_held_when_hold_does_not_complete(monkeypatch, caplog):
+  monkeypatch.setattr(pendant, '_HOLD_TIMEOUT', 0.1)
+
+  async def run():
+    sio = FakeSIO()
+    sio.state.status_report('<Run|MPos:0.000,0.000,0.000|FS:500,0>')
+    await pendant.stop_motion(sio, pendant_config())
+    return sio
+  sio = asyncio.run(run())
+  assert _emitted_commands(sio) == ['feedhold']
+  assert 'resume or reset' in caplog.text
+
+
+def test_stop_motion_leaves_idle_machine_alone():
+  async def run():
+    sio = FakeSIO()
+    sio.state.status_report('<Idle|MPos:0.000,0.000,0.000|FS:0,0>')
+    await asyncio.wait_for(pendant.stop_motion(sio, pendant_config()), 1)
+    return sio
+  # A feed hold would leave an Idle machine in Hold:0, blocking jogs and G-code
+  assert asyncio.run(run()).emitted == []
+
+
+def test_stop_motion_resets_idle_machine_with_unanswered_lines():
+  async def run():
+    sio = FakeSIO(answer=False)
+    sio.state.status_report('<Idle|MPos:0.000,0.000,0.000|FS:0,0>')
+    sio.queue.sent(command_mapping.Command(('gcode', 'G91 X10')))
+    stop = asyncio.ensure_future(pendant.stop_motion(sio, pendant_config()))
+    await asyncio.sleep(0.01)
+    # Grbl enters Hold:0 right away when the hold reaches it in Idle
+    sio.state.status_report('<Hold:0|MPos:0.000,0.000,0.000|FS:0,0>')
+    await asyncio.wait_for(stop, 1)
+    return sio
+  assert _emitted_commands(asyncio.run(run())) == ['feedhold', 'reset']
+
+
+def test_stop_motion_leaves_running_program_alone():
+  async def run():
+    sio = FakeSIO()
+    sio.state.workflow('running')
+    await pendant.stop_motion(sio, pendant_config())
+    return sio
+  assert asyncio.run(run()).emitted == []
+
+
+def test_create_clients_opens_a_connection_per_port(monkeypatch):
+  monkeypatch.setattr(pendant.cncjs_sio, 'CNCjs_SIO', lambda max_in_flight: max_in_flight)
+  config = pendant_config()
+  configs = [dataclasses.replace(config, cnc_port=port) for port in (PORT, '/dev/ttyUSB0', PORT)]
+  assert pendant.create_clients(configs) == {
+    ('127.0.0.1:8000', PORT): 8, ('127.0.0.1:8000', '/dev/ttyUSB0'): 4}
+
+
+@pytest.mark.parametrize('distance,word', [
+  (-300, 'X-0.3'), (10000, 'X10'), (-10000, 'X-10'), (1, 'X0.001'), (12340, 'X12.34'),
+  (-999, 'X-0.999'), (0, 'X0'),
+])
+def test_gcode_word(distance, word):
+  assert pendant._gcode_word(X, distance) == word
+
+
+def test_quantize_rounds_to_the_decimals_sent_and_drops_zeros():
+  assert pendant._quantize(((X, -0.3), (Y, 0.0004), (Z, 10.0))) == ((X, -300), (Z, 10000))
+  assert pendant._quantize(((X, 0.0004), (Y, -0.0004))) == ()
+
+
+def test_jog_commands_skip_moves_rounded_to_zero():
+  config = pendant_config()
+  jog = command_queue.PendingJog(distances={X: 0.0004, Y: -0.3}, duration=0.1)
+  assert pendant.jog_commands(config, jog) == (
+    command_mapping.Command(('gcode', 'G91 Y-0.3')), pendant._ABSOLUTE_MODE)
+  jog.distances[Y] = 0.0001
+  assert pendant.jog_commands(config, jog) == ()
+
+
+def test_jog_feed_rate_follows_the_quantized_length():
+  # 0.0304 and 0.0396 round to 0.03 and 0.04: 0.05 mm in 0.1 s is 30 mm/min
+  command = pendant.jog_command(((X, 0.0304), (Y, -0.0396)), 0.1)
+  assert command == command_mapping.Command(('gcode', '$J=G91 X0.03 Y-0.04 F30'))
+
+
+def test_cached_jog_commands_are_equal_to_new_ones():
+  moves = pendant._quantize(((X, 1.0), (Y, -0.25)))
+  pendant._continuous_jog_command.cache_clear()
+  pendant._step_jog_commands.cache_clear()
+  first = pendant._jog_command(moves, 0.1), pendant._step_jog_commands(moves)
+  second = (pendant._jog_command(pendant._quantize(((X, 1.0), (Y, -0.25))), 0.1),
+            pendant._step_jog_commands(pendant._quantize(((X, 1.0), (Y, -0.25)))))
+  assert second == first
+  assert second[0] is first[0] and second[1] is first[1]
+  assert pendant._continuous_jog_command.cache_info().hits == 1
+  assert pendant._step_jog_commands.cache_info().hits == 1
+  assert first[0].arguments == ('gcode', '$J=G91 X1 Y-0.25 F618')
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import threading
+import time
+
+import command_mapping
+import command_queue
+import gamepad
+import latency
+import realtime
+
+from fake_sio import FakeSIO, pendant_config
+
+PORT = '/dev/ttyACM0'
+JOG = ((command_mapping.MovementAxis.X, 1.0),)
+HOMING = (command_mapping.Command(('homing',)),)
+
+
+def _lane(sio, pending=None):
+  """Returns a PS3 gamepad and a lane sending the real-time commands of the default config."""
+  pad = gamepad.PS3()
+  pad._apply_events(tuple((0, 0, gamepad.Gamepad.EVENT_CODE_INIT_BUTTON, index)
+                          for index in pad.button_names))
+  lane = realtime.RealtimeLane(sio, PORT, pad, latency.LatencyTracker(), pending)
+  lane.set_mapping(pendant_config().mapped_commands)
+  return pad, lane
+
+
+def _press(pad, button):
+  pad.last_read_time = time.perf_counter()
+  index = pad.button_index[button]
+  pad._apply_events(((0, 1, gamepad.Gamepad.EVENT_CODE_BUTTON, index),
+                     (0, 0, gamepad.Gamepad.EVENT_CODE_BUTTON, index)))
+
+
+async def _settle():
+  for _ in range(3):
+    await asyncio.sleep(0)
+
+
+def test_press_on_the_loop_sends_right_away_and_drops_pending_jogs():
+  async def run():
+    sio = FakeSIO()
+    pending = command_queue.PendingCommands()
+    pending.put_moves(JOG, 0.1)
+    pending.put_commands(HOMING)
+    pending.put_moves(JOG, 0.1)
+    pad, lane = _lane(sio, pending)
+    _press(pad, 'SELECT')
+    await _settle()
+    return sio, pending, lane
+  sio, pending, lane = asyncio.run(run())
+  assert sio.emitted == [('command', (PORT, 'feedhold'))]
+  # The homing command stays, only the jogs are dropped
+  assert len(pending) == 1
+  assert lane.tracker.report()['realtime']['count'] == 1
+
+
+def test_cycle_start_keeps_pending_jogs():
+  async def run():
+    sio = FakeSIO()
+    pending = command_queue.PendingCommands()
+    pending.put_moves(JOG, 0.1)
+    pad, _ = _lane(sio, pending)
+    _press(pad, 'START')
+    await _settle()
+    return sio, pending
+  sio, pending = asyncio.run(run())
+  assert sio.emitted == [('command', (PORT, 'cyclestart'))]
+  assert len(pending) == 1
+
+
+def test_press_from_the_reader_thread_is_sent_from_the_loop():
+  async def run():
+    sio = FakeSIO()
+    pad, lane = _lane(sio)
+    send = lane._send
+    sent_from = []
+
+    def recording_send(*arguments):
+      sent_from.append(threading.get_ident())
+      send(*arguments)
+    lane._send = recording_send
+    reader = threading.Thread(target=_press, args=(pad, 'SELECT'))
+    reader.start()
+    reader.join()
+    # Nothing is sent from the reader thread, the loop sends it once it runs
+    assert sent_from == [] and sio.emitted == []
+    await _settle()
+    return sio, sent_from
+  sio, sent_from = asyncio.run(run())
+  assert sent_from == [threading.get_ident()]
+  assert sio.emitted == [('command', (PORT, 'feedhold'))]
+
+
+def test_soft_reset_forgets_unanswered_lines():
+  async def run():
+    sio = FakeSIO(answer=False)
+    pad, lane = _lane(sio)
+    lane.set_mapping((command_mapping.soft_reset('CIRCLE'),))
+    await sio.send(PORT, command_mapping.Command(('gcode', 'G0 X1')))
+    assert sio.queue.depth == 1
+    _press(pad, 'CIRCLE')
+    await _settle()
+    return sio
+  sio = asyncio.run(run())
+  assert sio.emitted[-1] == ('command', (PORT, 'reset'))
+  assert sio.queue.depth == 0
+
+
+def test_set_mapping_replaces_commands_and_close_removes_callbacks():
+  async def run():
+    sio = FakeSIO()
+    pad, lane = _lane(sio)
+    select = pad.button_index['SELECT']
+    callbacks = len(pad.pressed_event_map[select])
+    lane.set_mapping(pendant_config().mapped_commands)
+    assert len(pad.pressed_event_map[select]) == callbacks
+    lane.set_mapping((command_mapping.jog_cancel('SELECT'),))
+    _press(pad, 'SELECT')
+    _press(pad, 'START')
+    await _settle()
+    lane.close()
+    assert len(pad.pressed_event_map[select]) == callbacks - 1
+    _press(pad, 'SELECT')
+    await _settle()
+    return sio
+  sio = asyncio.run(run())
+  assert sio.emitted == [('write', (PORT, '\x85'))]
+
+
+def test_commands_are_dropped_while_disconnected(caplog):
+  async def run():
+    sio = FakeSIO()
+    sio.connected.clear()
+    pad, _ = _lane(sio)
+    _press(pad, 'SELECT')
+    await _settle()
+    return sio
+  sio = asyncio.run(run())
+  assert sio.emitted == []
+  assert 'Not connected' in caplog.text
+
+
+def test_presses_over_the_budget_are_logged(monkeypatch, caplog):
+  monkeypatch.setattr(realtime, 'LATENCY_BUDGET', 0.0)
+
+  async def run():
+    pad, _ = _lane(FakeSIO())
+    _press(pad, 'SELECT')
+    await _settle()
+  with caplog.at_level(logging.WARNING):
+    asyncio.run(run())
+  assert 'over the 0 ms budget' in caplog.text
+
+
+def test_presses_from_the_reader_thread_stay_within_the_budget():
+  async def run():
+    pad, lane = _lane(FakeSIO())
+    for press in range(20):
+      reader = threading.Thread(target=_press, args=(pad, ('SELECT', 'START')[press % 2]))
+      reader.start()
+      reader.join()
+      await _settle()
+    return lane.tracker.report()['realtime']
+  report = asyncio.run(run())
+  assert report['count'] == 20
+  assert report['p50'] < realtime.LATENCY_BUDGET * 1e3
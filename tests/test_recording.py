@@ -0,0 +1,44 @@
+import io
+import struct
+
+import gamepad
+import recording
+
+EVENTS = ((1000, 1, gamepad.Gamepad.EVENT_CODE_BUTTON, 3),
+          (1004, -200, gamepad.Gamepad.EVENT_CODE_AXIS, 0))
+
+
+class Output(io.BytesIO):
+  """BytesIO keeping its value after close, counting flushes."""
+
+  def __init__(self):
+    super().__init__()
+    self.flushes = 0
+    self.value = b''
+
+  def flush(self):
+    super().flush()
+    self.flushes += 1
+    self.value = self.getvalue()
+
+
+def _raw(events):
+  return b''.join(struct.pack(gamepad.Gamepad.EVENT_FORMAT, *event) for event in events)
+
+
+def test_recorder_flushes_every_write():
+  output = Output()
+  recorder = recording.Recorder(output)
+  recorder.write(_raw(EVENTS[:1]))
+  assert output.flushes == 2
+  recorder.write(_raw(EVENTS[1:]))
+  assert list(recording.read_events(io.BytesIO(output.value))) == list(EVENTS)
+
+
+def test_recorder_ignores_writes_after_close():
+  output = Output()
+  recorder = recording.Recorder(output)
+  recorder.write(_raw(EVENTS[:1]))
+  recorder.close()
+  recorder.write(_raw(EVENTS[1:]))
+  assert list(recording.read_events(io.BytesIO(output.value))) == list(EVENTS[:1])